@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of page parsing in the spiders.
+
+Measures pages per second of text extraction and link extraction of
+'BaseSpider.parse', before (XPath over all text nodes and a new
+LinkExtractor for each response) and after (a single walk over the lxml
+tree and a LinkExtractor built once per spider).
+
+Pages are read from a directory of saved HTML fixtures, which can be saved
+with for example 'scrapy fetch --nolog https://www.is.fi > is.html', or
+generated synthetically if no directory is given.
+
+Example:
+    python -m crawling.benchmark --fixtures ./fixtures --out parse.json
+"""
+
+
+import argparse
+import glob
+import logging
+import os
+import random
+import time
+import ujson as json
+
+from scrapy.http import HtmlResponse
+from scrapy.linkextractors import LinkExtractor
+
+from crawling.spiders.all_spiders import extract_text
+from crawling.synthetic import WORDS
+
+
+logger = logging.getLogger(__name__)
+
+
+def extract_text_xpath(resp, min_tokens=3):
+    """Extract text like 'extract_text' did before, as the baseline.
+
+    Args:
+        resp (scrapy.Response): Response from HTTP request.
+        min_tokens (int): Minimum number of tokens that must occur in page.
+
+    Returns:
+        list: Text elements found from the page.
+    """
+    selector = '//body/descendant-or-self::*[not(self::script)]/text()'
+    texts = resp.selector.xpath(selector).extract()
+    ret = []
+    for text in texts:
+        css_count = (text.count(';') + text.count(':') + text.count('#')
+                     + text.count('{') + text.count('}'))
+        if ((len(text) > 0)
+            and (len(text.split()) >= min_tokens)
+            and (css_count < 4)):
+            ret.append(text.strip())
+    return ret
+
+
+def generate_page(rng, n_paragraphs=30, n_links=60):
+    """Generate a synthetic news page with navigation, scripts and styles.
+
+    Args:
+        rng (random.Random): Random number generator.
+        n_paragraphs (int, optional): Number of paragraphs. Defaults to 30.
+        n_links (int, optional): Number of links. Defaults to 60.
+
+    Returns:
+        str: HTML of the page.
+    """
+    def sentence():
+        return ' '.join(rng.choices(WORDS, k=rng.randint(3, 15))) + '.'
+
+    links = ''.join(f'<li><a href="/uutiset/{rng.randint(0, 10 ** 6)}?'
+                    f'ref=nav">{sentence()}</a></li>' for _ in range(n_links))
+    paragraphs = ''.join(
+        f'<p>{sentence()} <b>{sentence()}</b> {sentence()}<!-- ad -->'
+        f'<a href="/a/{i}">{sentence()}</a> {sentence()}</p>'
+        for i in range(n_paragraphs))
+    return (
+        '<html><head><title>Uutiset</title>'
+        '<style>body { margin: 0; } .nav { color: #333; }</style></head>'
+        f'<body><nav><ul>{links}</ul></nav>'
+        '<script>var tracker = {id: 1}; function f() { return 0; }</script>'
+        f'<noscript>{sentence()} {sentence()}</noscript>'
+        f'<div class="article"><h1>{sentence()}</h1>{paragraphs}</div>'
+        '<style>.footer { display: none; }</style>'
+        f'<footer>{sentence()} © 2019</footer></body></html>'
+    )
+
+
+def load_pages(fixture_dir=None, n_pages=200, seed=0):
+    """Load saved HTML fixtures, or generate synthetic pages.
+
+    Args:
+        fixture_dir (str, optional): Directory of '*.html' fixtures. Defaults
+            to None, which means synthetic pages.
+        n_pages (int, optional): Number of synthetic pages. Defaults to 200.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: Pages as tuples of URL and body bytes.
+    """
+    if fixture_dir is not None:
+        filepaths = sorted(glob.glob(os.path.join(fixture_dir, '*.html')))
+        pages = []
+        for path in filepaths:
+            with open(path, 'rb') as f:
+                name = os.path.basename(path)
+                pages.append((f'https://fixtures.local/{name}', f.read()))
+        return pages
+    rng = random.Random(seed)
+    return [(f'https://www.uutiset.fi/{i}', generate_page(rng).encode('utf8'))
+            for i in range(n_pages)]
+
+
+def time_pages(pages, func, repeat=3):
+    """Measure pages per second of a function over parsed responses.
+
+    Parsing of the HTML is left out, as both before and after share it.
+
+    Args:
+        pages (list): Pages as tuples of URL and body bytes.
+        func (callable): Function called with each response.
+        repeat (int, optional): Number of repeats, of which the fastest is
+            reported. Defaults to 3.
+
+    Returns:
+        float: Pages per second.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        responses = [HtmlResponse(url, body=body, encoding='utf8')
+                     for url,body in pages]
+        for resp in responses:
+            resp.selector
+        start_time = time.perf_counter()
+        for resp in responses:
+            func(resp)
+        best = min(best, time.perf_counter() - start_time)
+    return len(pages) / best
+
+
+def run_benchmarks(fixture_dir=None, n_pages=200, repeat=3):
+    """Benchmark text and link extraction before and after.
+
+    Args:
+        fixture_dir (str, optional): Directory of '*.html' fixtures. Defaults
+            to None, which means synthetic pages.
+        n_pages (int, optional): Number of synthetic pages. Defaults to 200.
+        repeat (int, optional): Number of repeats. Defaults to 3.
+
+    Returns:
+        dict: Report with pages per second of each measurement, and number
+            of texts extracted before and after.
+    """
+    pages = load_pages(fixture_dir, n_pages=n_pages)
+    link_kwargs = {'allow_domains': (), 'deny_domains': (), 'allow': (),
+                   'deny': ()}
+    link_extractor = LinkExtractor(**link_kwargs)
+
+    def parse_before(resp):
+        extract_text_xpath(resp)
+        LinkExtractor(**link_kwargs).extract_links(resp)
+
+    def parse_after(resp):
+        extract_text(resp)
+        link_extractor.extract_links(resp)
+
+    report = {
+        'pages': len(pages),
+        'fixtures': fixture_dir,
+        'text_before_pages_per_s': time_pages(pages, extract_text_xpath,
+                                              repeat),
+        'text_after_pages_per_s': time_pages(pages, extract_text, repeat),
+        'links_before_pages_per_s': time_pages(
+            pages, lambda resp: LinkExtractor(**link_kwargs)
+            .extract_links(resp), repeat),
+        'links_after_pages_per_s': time_pages(
+            pages, link_extractor.extract_links, repeat),
+        'parse_before_pages_per_s': time_pages(pages, parse_before, repeat),
+        'parse_after_pages_per_s': time_pages(pages, parse_after, repeat)
+    }
+
+    # Script, style and noscript texts are no longer extracted
+    n_texts_before = 0
+    n_texts_after = 0
+    for url,body in pages:
+        resp = HtmlResponse(url, body=body, encoding='utf8')
+        n_texts_before += len(extract_text_xpath(resp))
+        n_texts_after += len(extract_text(resp))
+    report.update(texts_before=n_texts_before, texts_after=n_texts_after)
+
+    for name in ['text', 'links', 'parse']:
+        before = report[f'{name}_before_pages_per_s']
+        after = report[f'{name}_after_pages_per_s']
+        logger.info(f'{name}: {before:.0f} -> {after:.0f} pages/s '
+                    f'({after / before:.2f}x)')
+    return report
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', default=None,
+                        help='Directory of saved *.html pages')
+    parser.add_argument('--pages', type=int, default=200,
+                        help='Number of synthetic pages without fixtures')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', default=None,
+                        help='Filepath of the JSON report')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.fixtures, n_pages=args.pages,
+                            repeat=args.repeat)
+    print(json.dumps(report, indent=2))
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
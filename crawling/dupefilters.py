@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""Duplicate request filter backed by a scalable Bloom filter.
+
+'scrapy.dupefilters.RFPDupeFilter' keeps every request fingerprint as a hex
+string in a Python set, and appends it into 'requests.seen' in the JOBDIR,
+which is read back into the set when a job resumes. Memory therefore grows by
+well over 100 bytes per request.
+
+'BloomDupeFilter' keeps fingerprints in a scalable Bloom filter instead: a
+series of Bloom filters, each twice as large as the previous one and with a
+tighter false positive rate, so that the total false positive rate stays
+below DUPEFILTER_ERROR_RATE however many requests are seen. A false positive
+means that a request is never sent. Memory is about 4 bytes per request at
+the default rate of 1e-6. The filter is saved as a binary snapshot
+'requests.bloom' in the JOBDIR, and a 'requests.seen' of an earlier job is
+read into it once.
+"""
+
+
+import logging
+import math
+import os
+import time
+import ujson as json
+
+import numpy as np
+
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.utils.job import job_dir
+
+try:
+    from scrapy.utils.request import request_fingerprint
+except ImportError:
+    # Newer Scrapy, where the crawler provides the fingerprints
+    request_fingerprint = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_hashes(fingerprint):
+    """Get two 64-bit hashes of a request fingerprint for double hashing.
+
+    Args:
+        fingerprint (bytes): SHA1 fingerprint of a request.
+
+    Returns:
+        tuple: Two-element tuple with the hashes, the second one odd.
+    """
+    return (int.from_bytes(fingerprint[:8], 'little'),
+            int.from_bytes(fingerprint[8:16], 'little') | 1)
+
+
+class BloomFilter(object):
+    """Bloom filter of fixed capacity.
+
+    Args:
+        capacity (int): Number of items, up to which the false positive rate
+            holds.
+        error_rate (float): False positive rate at capacity.
+        bits (bytearray, optional): Bits to continue from. Defaults to None.
+        count (int, optional): Number of items added into the bits. Defaults
+            to 0.
+    """
+
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = math.ceil(-capacity * math.log(error_rate)
+                                / math.log(2) ** 2)
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        if bits is None:
+            bits = bytearray((self.n_bits + 7) // 8)
+        self.bits = bits
+        self.count = count
+
+    def __contains__(self, hashes):
+        h1, h2 = hashes
+        bits = self.bits
+        for i in range(self.n_hashes):
+            position = (h1 + i * h2) % self.n_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    @property
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def add(self, hashes):
+        """Add an item.
+
+        Args:
+            hashes (tuple): Two hashes of the item from 'get_hashes'.
+        """
+        h1, h2 = hashes
+        bits = self.bits
+        for i in range(self.n_hashes):
+            position = (h1 + i * h2) % self.n_bits
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def add_many(self, h1, h2):
+        """Add items at once.
+
+        Args:
+            h1 (numpy.ndarray): uint64 first hashes of the items.
+            h2 (numpy.ndarray): uint64 second hashes of the items.
+        """
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        n_bits = np.uint64(self.n_bits)
+        for i in range(self.n_hashes):
+            # Same positions as in 'add', without overflow as n_bits < 2 ** 58
+            positions = ((h1 % n_bits) + np.uint64(i) * (h2 % n_bits)) % n_bits
+            offsets = (positions >> np.uint64(3)).astype(np.int64)
+            masks = np.left_shift(np.uint8(1),
+                                  (positions & np.uint64(7)).astype(np.uint8))
+            np.bitwise_or.at(bits, offsets, masks)
+        self.count += len(h1)
+
+
+class ScalableBloomFilter(object):
+    """Bloom filter that grows with the number of items.
+
+    Filter i has capacity 'initial_capacity' * 'growth' ** i and false
+    positive rate 'error_rate' * (1 - 'tightening') * 'tightening' ** i, so
+    that the false positive rate of all filters together is below
+    'error_rate'.
+
+    Args:
+        initial_capacity (int, optional): Capacity of the first filter.
+            Defaults to 1000000.
+        error_rate (float, optional): Maximum false positive rate. Defaults
+            to 1e-6.
+        growth (int, optional): Growth of capacity of each next filter.
+            Defaults to 2.
+        tightening (float, optional): Ratio of false positive rates of
+            consecutive filters. Defaults to 0.5.
+    """
+
+    def __init__(self, initial_capacity=1000000, error_rate=1e-6, growth=2,
+                 tightening=0.5):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def __contains__(self, hashes):
+        return any(hashes in f for f in self.filters)
+
+    @property
+    def nbytes(self):
+        return sum(f.nbytes for f in self.filters)
+
+    def get_filter(self):
+        """Get filter that new items are added into."""
+        if not self.filters or self.filters[-1].is_full:
+            i = len(self.filters)
+            self.filters.append(BloomFilter(
+                capacity=self.initial_capacity * self.growth ** i,
+                error_rate=(self.error_rate * (1 - self.tightening)
+                            * self.tightening ** i)))
+        return self.filters[-1]
+
+    def add(self, hashes):
+        """Add an item unless it is already in the filter.
+
+        Args:
+            hashes (tuple): Two hashes of the item from 'get_hashes'.
+
+        Returns:
+            bool: Whether the item was already in the filter.
+        """
+        if hashes in self:
+            return True
+        self.get_filter().add(hashes)
+        return False
+
+    def add_many(self, h1, h2):
+        """Add items at once, without checking for existing ones.
+
+        Args:
+            h1 (numpy.ndarray): uint64 first hashes of the items.
+            h2 (numpy.ndarray): uint64 second hashes of the items.
+        """
+        start = 0
+        while start < len(h1):
+            f = self.get_filter()
+            end = start + f.capacity - f.count
+            f.add_many(h1[start:end], h2[start:end])
+            start = end
+
+    def save(self, filepath):
+        """Save snapshot of the filter atomically.
+
+        Args:
+            filepath (str): Filepath of the snapshot.
+        """
+        meta = {
+            'initial_capacity': self.initial_capacity,
+            'error_rate': self.error_rate,
+            'growth': self.growth,
+            'tightening': self.tightening,
+            'counts': [f.count for f in self.filters]
+        }
+        arrays = {f'bits_{i}': np.frombuffer(f.bits, dtype=np.uint8)
+                  for i,f in enumerate(self.filters)}
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        """Load snapshot of a filter.
+
+        Args:
+            filepath (str): Filepath of the snapshot.
+
+        Returns:
+            ScalableBloomFilter: Loaded filter.
+        """
+        with np.load(filepath) as data:
+            meta = json.loads(str(data['meta']))
+            sbf = cls(initial_capacity=meta['initial_capacity'],
+                      error_rate=meta['error_rate'], growth=meta['growth'],
+                      tightening=meta['tightening'])
+            for i,count in enumerate(meta['counts']):
+                f = sbf.get_filter()
+                f.bits = bytearray(data[f'bits_{i}'].tobytes())
+                f.count = count
+        return sbf
+
+
+class BloomDupeFilter(BaseDupeFilter):
+    """Request fingerprint duplicates filter backed by a Bloom filter.
+
+    Drop-in replacement of 'scrapy.dupefilters.RFPDupeFilter', configured
+    with settings DUPEFILTER_ERROR_RATE, DUPEFILTER_INITIAL_CAPACITY and
+    DUPEFILTER_SNAPSHOT_INTERVAL.
+
+    Args:
+        path (str, optional): JOBDIR of the crawl. Defaults to None, which
+            means that the filter is kept only in memory.
+        debug (bool, optional): Whether to log all filtered requests.
+            Defaults to False.
+        error_rate (float, optional): Maximum false positive rate. Defaults
+            to 1e-6.
+        initial_capacity (int, optional): Capacity of the first Bloom filter.
+            Defaults to 1000000.
+        snapshot_interval (int, optional): Number of new requests after which
+            a snapshot is saved, in addition to when the crawl closes.
+            Defaults to 100000.
+        fingerprinter (object, optional): Request fingerprinter of newer
+            Scrapy versions. Defaults to None, which means
+            'scrapy.utils.request.request_fingerprint'.
+    """
+
+    def __init__(self, path=None, debug=False, error_rate=1e-6,
+                 initial_capacity=1000000, snapshot_interval=100000,
+                 fingerprinter=None):
+        self.debug = debug
+        self.logdupes = True
+        self.snapshot_interval = snapshot_interval
+        self.fingerprinter = fingerprinter
+        self.n_lookups = 0
+        self.n_new = 0
+        self.lookup_time = 0
+        self.filepath = None
+        if path:
+            self.filepath = os.path.join(path, 'requests.bloom')
+
+        if self.filepath is not None and os.path.exists(self.filepath):
+            self.filter = ScalableBloomFilter.load(self.filepath)
+            logger.info(f'Loaded {len(self.filter)} request fingerprints '
+                        f'from "{self.filepath}"')
+        else:
+            self.filter = ScalableBloomFilter(
+                initial_capacity=initial_capacity, error_rate=error_rate)
+            if path and os.path.exists(os.path.join(path, 'requests.seen')):
+                self.seed(os.path.join(path, 'requests.seen'))
+
+    @classmethod
+    def from_settings(cls, settings, fingerprinter=None):
+        return cls(
+            job_dir(settings),
+            debug=settings.getbool('DUPEFILTER_DEBUG'),
+            error_rate=settings.getfloat('DUPEFILTER_ERROR_RATE', 1e-6),
+            initial_capacity=settings.getint('DUPEFILTER_INITIAL_CAPACITY',
+                                             1000000),
+            snapshot_interval=settings.getint('DUPEFILTER_SNAPSHOT_INTERVAL',
+                                              100000),
+            fingerprinter=fingerprinter
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls.from_settings(
+            crawler.settings,
+            fingerprinter=getattr(crawler, 'request_fingerprinter', None))
+
+    def seed(self, filepath):
+        """Add fingerprints of 'requests.seen' written by RFPDupeFilter.
+
+        Args:
+            filepath (str): Filepath of 'requests.seen', with one hex
+                fingerprint per line.
+        """
+        start_time = time.perf_counter()
+        prefixes = []
+        n_invalid = 0
+        with open(filepath, 'r', encoding='utf8', errors='replace') as f:
+            for line in f:
+                try:
+                    prefixes.append(bytes.fromhex(line.strip()[:32]))
+                except ValueError:
+                    n_invalid += 1
+        prefixes = [prefix for prefix in prefixes if len(prefix) == 16]
+        hashes = np.frombuffer(b''.join(prefixes), dtype='<u8').reshape(-1, 2)
+        self.filter.add_many(hashes[:, 0].astype(np.uint64),
+                             hashes[:, 1].astype(np.uint64) | np.uint64(1))
+        logger.info(f'Seeded {len(prefixes)} request fingerprints from '
+                    f'"{filepath}" in {time.perf_counter() - start_time:.1f} '
+                    f'seconds, {n_invalid} invalid lines skipped')
+
+    def get_fingerprint(self, request):
+        if self.fingerprinter is not None:
+            return self.fingerprinter.fingerprint(request)
+        return bytes.fromhex(request_fingerprint(request))
+
+    def request_seen(self, request):
+        start_time = time.perf_counter()
+        seen = self.filter.add(get_hashes(self.get_fingerprint(request)))
+        self.lookup_time += time.perf_counter() - start_time
+        self.n_lookups += 1
+        if not seen:
+            self.n_new += 1
+            if (self.filepath is not None
+                    and self.n_new % self.snapshot_interval == 0):
+                self.filter.save(self.filepath)
+        return seen
+
+    def close(self, reason):
+        if self.filepath is not None:
+            self.filter.save(self.filepath)
+        lookups_per_s = self.n_lookups / max(self.lookup_time, 1e-9)
+        logger.info(f'Request fingerprints: {len(self.filter)} in '
+                    f'{len(self.filter.filters)} Bloom filters taking '
+                    f'{self.filter.nbytes / 1e6:.1f} MB, '
+                    f'{self.n_lookups} lookups at {lookups_per_s:.0f} '
+                    'lookups/s')
+
+    def log(self, request, spider):
+        if self.debug:
+            logger.debug('Filtered duplicate request: %(request)s',
+                         {'request': request}, extra={'spider': spider})
+        elif self.logdupes:
+            logger.debug('Filtered duplicate request: %(request)s'
+                         ' - no more duplicates will be shown'
+                         ' (see DUPEFILTER_DEBUG to show all duplicates)',
+                         {'request': request}, extra={'spider': spider})
+            self.logdupes = False
+        spider.crawler.stats.inc_value('dupefilter/filtered', spider=spider)
@@ -6,6 +6,15 @@
 # https://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
 from scrapy import signals
+from scrapy.core.downloader.handlers.http11 import TunnelError
+from scrapy.exceptions import IgnoreRequest
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import defer
+from twisted.internet.error import (ConnectError, ConnectionDone,
+                                    ConnectionLost, ConnectionRefusedError,
+                                    DNSLookupError, TCPTimedOutError,
+                                    TimeoutError)
+from twisted.web.client import ResponseFailed
 
 
 class FweSpiderMiddleware(object):
@@ -57,47 +66,182 @@ class FweSpiderMiddleware(object):
 
 
 class FweDownloaderMiddleware(object):
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    """Per-domain concurrency limits and adaptive throttling.
+
+    The concurrency of each downloader slot, which is a host, is limited by
+    DOMAIN_CONCURRENCY, a dictionary from domains to their maximum number of
+    concurrent requests, or by CONCURRENT_REQUESTS_PER_DOMAIN otherwise.
+    Domains match their subdomains as well.
+
+    Within the limit, concurrency and download delay of each slot are
+    adapted to exponentially weighted moving averages of its latency and
+    error rate:
+
+    * On an error (a network exception, such as a timeout or a refused
+      connection, or a status in THROTTLE_ERROR_STATUSES)
+      with the error rate over THROTTLE_MAX_ERROR_RATE, concurrency is
+      halved and delay doubled, up to THROTTLE_MAX_DELAY
+    * With latency over THROTTLE_TARGET_LATENCY seconds, concurrency is
+      decreased by one
+    * Otherwise, delay is decreased towards THROTTLE_MIN_DELAY, and if the
+      error rate is below THROTTLE_MAX_ERROR_RATE, concurrency is increased
+      by one
+
+    Isolated errors are tolerated, since a single error raises the error
+    rate by only 'alpha'.
+
+    The limit is applied on 'request_reached_downloader', right after the
+    downloader has created the slot of a request and before the slot starts
+    downloading, so that even the first requests to a host stay within it.
+    Scrapy removes slots that have been idle for a while, and creates new
+    ones with the default concurrency. The limit and the adapted
+    concurrency and delay are applied again to a new slot of a host.
+
+    Current concurrency and delay of each slot are in the crawl stats as
+    'throttle/<slot>/concurrency' and 'throttle/<slot>/delay'. Should run
+    before RetryMiddleware sees the responses, so that retried errors are
+    counted as well.
+    """
+
+    NETWORK_EXCEPTIONS = (defer.TimeoutError, TimeoutError, DNSLookupError,
+                          ConnectionRefusedError, ConnectionDone,
+                          ConnectError, ConnectionLost, TCPTimedOutError,
+                          ResponseFailed, IOError, TunnelError)
+
+    def __init__(self, crawler, domain_concurrency=None,
+                 default_concurrency=8, enabled=True, target_latency=2.0,
+                 max_error_rate=0.05, min_delay=0.0, max_delay=30.0,
+                 error_delay=1.0, error_statuses=(429, 500, 502, 503, 504),
+                 alpha=0.05):
+        self.crawler = crawler
+        self.domain_concurrency = domain_concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.enabled = enabled
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.error_delay = error_delay
+        self.error_statuses = frozenset(error_statuses)
+        self.alpha = alpha
+        self.states = {}
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
+        settings = crawler.settings
+        s = cls(
+            crawler,
+            domain_concurrency=settings.getdict('DOMAIN_CONCURRENCY'),
+            default_concurrency=settings.getint(
+                'CONCURRENT_REQUESTS_PER_DOMAIN'),
+            enabled=settings.getbool('THROTTLE_ENABLED', True),
+            target_latency=settings.getfloat('THROTTLE_TARGET_LATENCY', 2.0),
+            max_error_rate=settings.getfloat('THROTTLE_MAX_ERROR_RATE', 0.05),
+            min_delay=settings.getfloat('THROTTLE_MIN_DELAY', 0.0),
+            max_delay=settings.getfloat('THROTTLE_MAX_DELAY', 30.0),
+            error_delay=settings.getfloat('THROTTLE_ERROR_DELAY', 1.0),
+            error_statuses=[int(status) for status in settings.getlist(
+                'THROTTLE_ERROR_STATUSES', [429, 500, 502, 503, 504])]
+        )
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.request_reached_downloader,
+                                signal=signals.request_reached_downloader)
         return s
 
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
-        return None
+    def get_max_concurrency(self, host):
+        """Get concurrency limit of a host from its most specific domain."""
+        parts = host.split('.')
+        for i in range(len(parts)):
+            limit = self.domain_concurrency.get('.'.join(parts[i:]))
+            if limit is not None:
+                return int(limit)
+        return self.default_concurrency
+
+    def get_slot(self, request):
+        """Get key and downloader slot of a request, if the slot exists."""
+        key = request.meta.get('download_slot')
+        if key is None:
+            key = urlparse_cached(request).hostname or ''
+        return key,self.crawler.engine.downloader.slots.get(key)
+
+    def get_state(self, key, slot):
+        """Get throttling state of a slot, limiting concurrency of new slots.
+
+        When Scrapy has replaced an idle slot of the key with a new one,
+        concurrency and delay of the previous slot are carried over.
+        """
+        state = self.states.get(key)
+        if state is None:
+            max_concurrency = self.get_max_concurrency(key)
+            slot.concurrency = max_concurrency
+            state = self.states[key] = {
+                'slot': slot,
+                'max_concurrency': max_concurrency,
+                'latency': None,
+                'error_rate': 0.0
+            }
+        elif state['slot'] is not slot:
+            old_slot = state['slot']
+            slot.concurrency = min(state['max_concurrency'],
+                                   old_slot.concurrency)
+            slot.delay = max(slot.delay, old_slot.delay)
+            state['slot'] = slot
+        return state
+
+    def request_reached_downloader(self, request, spider):
+        # Slot of the request exists, but it has not started downloading yet
+        key, slot = self.get_slot(request)
+        if slot is not None:
+            self.get_state(key, slot)
 
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
-
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+        self.update(request, spider, response.status in self.error_statuses,
+                    request.meta.get('download_latency'))
         return response
 
     def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        # Requests dropped by other middlewares are not errors of the host
+        if isinstance(exception, IgnoreRequest):
+            return None
+        if isinstance(exception, self.NETWORK_EXCEPTIONS):
+            self.update(request, spider, True)
+        return None
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+    def update(self, request, spider, error, latency=None):
+        """Adapt concurrency and delay of the slot of a request."""
+        key, slot = self.get_slot(request)
+        if slot is None:
+            return
+        state = self.get_state(key, slot)
+        if not self.enabled:
+            return
+
+        a = self.alpha
+        state['error_rate'] = (1 - a) * state['error_rate'] + a * error
+        if latency is not None:
+            if state['latency'] is None:
+                state['latency'] = latency
+            state['latency'] = (1 - a) * state['latency'] + a * latency
+
+        if error and state['error_rate'] > self.max_error_rate:
+            slot.concurrency = max(1, slot.concurrency // 2)
+            slot.delay = min(self.max_delay,
+                             max(2 * slot.delay, self.error_delay))
+        elif (state['latency'] is not None
+                and state['latency'] > self.target_latency):
+            slot.concurrency = max(1, slot.concurrency - 1)
+        else:
+            if state['error_rate'] < self.max_error_rate:
+                slot.concurrency = min(state['max_concurrency'],
+                                       slot.concurrency + 1)
+            slot.delay = max(self.min_delay, 0.9 * slot.delay)
+            if slot.delay < 0.01:
+                slot.delay = self.min_delay
+
+        stats = self.crawler.stats
+        stats.set_value(f'throttle/{key}/concurrency', slot.concurrency,
+                        spider=spider)
+        stats.set_value(f'throttle/{key}/delay', slot.delay, spider=spider)
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
@@ -5,30 +5,462 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
-import json
+import gzip
 import os
+import time
+import ujson as json
+import zlib
+
+from scrapy import signals
+from scrapy.exceptions import DropItem
+from scrapy.utils.job import job_dir
+from twisted.internet import task
+
+from crawling.simhash import SimHashIndex, simhash
+from crawling.sketch import CountMinSketch
+
+
+def get_index_filepath(feed_dir, name):
+    """Get filepath of the shard index of a spider.
+
+    Args:
+        feed_dir (pathlib.Path): Directory of the feeds.
+        name (str): Name of the spider.
+
+    Returns:
+        pathlib.Path: Filepath of the index, like 'iltalehti.shards.json'.
+    """
+    return feed_dir / f'{name}.shards.json'
+
+
+def load_shard_index(filepath):
+    """Load index of closed feed shards.
+
+    Args:
+        filepath (pathlib.Path): Filepath of the index.
+
+    Returns:
+        list: Shards as dictionaries with keys 'file', 'first_item', 'items',
+            'bytes', 'compressed_bytes', 'opened' and 'closed', in the order
+            they were written. Empty if the index doesn't exist.
+    """
+    if not os.path.exists(filepath):
+        return []
+    with open(filepath, 'r', encoding='utf8') as f:
+        return json.load(f)['shards']
+
+
+def save_shard_index(filepath, shards):
+    """Save index of closed feed shards atomically.
+
+    Args:
+        filepath (pathlib.Path): Filepath of the index.
+        shards (list): Shards as returned by 'load_shard_index'.
+    """
+    tmp_filepath = f'{filepath}.tmp'
+    with open(tmp_filepath, 'w', encoding='utf8') as f:
+        json.dump({'shards': shards}, f, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+def find_complete_members(data):
+    """Find the end of the last complete gzip member in a partial shard.
+
+    Shards are written as one gzip member per batch, so a shard left open by
+    a crashed crawler can be truncated into its complete batches.
+
+    Args:
+        data (bytes): Contents of the shard.
+
+    Returns:
+        tuple: Three-element tuple with the byte offset where the last
+            complete member ends, and the number of lines and uncompressed
+            bytes in the complete members.
+    """
+    offset = 0
+    n_lines = 0
+    n_bytes = 0
+    while offset < len(data):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            lines = decompressor.decompress(data[offset:])
+        except zlib.error:
+            break
+        if not decompressor.eof:
+            break
+        offset = len(data) - len(decompressor.unused_data)
+        n_lines += lines.count(b'\n')
+        n_bytes += len(lines)
+    return offset,n_lines,n_bytes
+
+
+class BoilerplatePipeline(object):
+    """Leave text blocks repeated across pages out of the content of items.
+
+    Navigation, footers and cookie banners are repeated on every page of a
+    site. The number of pages each text block occurs on is counted with a
+    count-min sketch of bounded memory, and blocks that have occurred on at
+    least BOILERPLATE_MIN_PAGES pages are left out of 'content'. Items left
+    without any content are dropped. Blocks are learned while crawling, so
+    the first pages of a site keep their boilerplate.
+
+    Blocks of an item are counted only once the item has passed all of the
+    pipelines, on 'item_scraped'. Otherwise, the paragraphs of a page reached
+    through many URL variants would be learned as boilerplate before
+    NearDuplicatePipeline drops the variants, and stripped from the variants
+    and from later pages. The sketch is kept in
+    the JOBDIR of the spider ('boilerplate.npy'), so that it is not lost
+    when a job resumes.
+
+    Number of blocks dropped and kept are in the crawl stats as
+    'boilerplate/blocks_dropped' and 'boilerplate/blocks_kept'.
+
+    Args:
+        stats (scrapy.statscollectors.StatsCollector): Stats of the crawl.
+        min_pages (int, optional): Number of pages a block has to occur on to
+            be considered boilerplate. Defaults to 10.
+        width (int, optional): Number of counters per row of the sketch, a
+            power of two. Defaults to 2 ** 20.
+        depth (int, optional): Number of rows of the sketch. Defaults to 4.
+        jobdir (str, optional): Directory of the crawl state. Defaults to
+            None, which means that the sketch is kept only in memory.
+    """
+
+    def __init__(self, stats, min_pages=10, width=1 << 20, depth=4,
+                 jobdir=None):
+        self.stats = stats
+        self.min_pages = min_pages
+        self.width = width
+        self.depth = depth
+        self.filepath = None
+        if jobdir is not None:
+            self.filepath = os.path.join(jobdir, 'boilerplate.npy')
+        self.sketch = None
+        # Blocks of items in the pipelines by item id, counted once scraped
+        self.pending = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        s = cls(
+            crawler.stats,
+            min_pages=settings.getint('BOILERPLATE_MIN_PAGES', 10),
+            width=settings.getint('BOILERPLATE_SKETCH_WIDTH', 1 << 20),
+            depth=settings.getint('BOILERPLATE_SKETCH_DEPTH', 4),
+            jobdir=job_dir(settings)
+        )
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_dropped, signal=signals.item_dropped)
+        return s
+
+    def open_spider(self, spider):
+        if self.filepath is not None and os.path.exists(self.filepath):
+            self.sketch = CountMinSketch.load(self.filepath)
+            spider.logger.info(f'Loaded boilerplate sketch from '
+                               f'"{self.filepath}"')
+        else:
+            self.sketch = CountMinSketch(width=self.width, depth=self.depth)
+
+    def close_spider(self, spider):
+        if self.filepath is not None:
+            self.sketch.save(self.filepath)
+        n_dropped = self.stats.get_value('boilerplate/blocks_dropped', 0,
+                                         spider=spider)
+        n_kept = self.stats.get_value('boilerplate/blocks_kept', 0,
+                                      spider=spider)
+        spider.logger.info(f'Dropped {n_dropped} boilerplate text blocks and '
+                           f'kept {n_kept}, sketch takes '
+                           f'{self.sketch.nbytes / 1e6:.1f} MB')
+
+    def process_item(self, item, spider):
+        content = item.get('content')
+        if not content:
+            return item
+        normalized = [' '.join(text.lower().split()) for text in content]
+        blocks = list(dict.fromkeys(normalized))
+        self.pending[id(item)] = blocks
+
+        # Counts including this page, if it is kept
+        counts = dict(zip(blocks,
+                          self.sketch.estimate(blocks).astype(int) + 1))
+        item['content'] = [text for text,block in zip(content, normalized)
+                           if counts[block] < self.min_pages]
+        n_dropped = len(content) - len(item['content'])
+        self.stats.inc_value('boilerplate/blocks_dropped', n_dropped,
+                             spider=spider)
+        self.stats.inc_value('boilerplate/blocks_kept', len(item['content']),
+                             spider=spider)
+        if not item['content']:
+            raise DropItem(f'Only boilerplate: {item.get("url")}')
+        return item
+
+    def item_scraped(self, item, spider):
+        blocks = self.pending.pop(id(item), None)
+        if blocks is not None:
+            self.sketch.add(blocks)
+
+    def item_dropped(self, item, spider):
+        self.pending.pop(id(item), None)
+
+
+class NearDuplicatePipeline(object):
+    """Drop items whose text is a near-duplicate of an earlier item.
+
+    The same page is often reached through many URL variants, such as ones
+    with 'replytocom=' or 'quote=' parameters. The content of each item is
+    fingerprinted with SimHash over word shingles, and items whose
+    fingerprint is within the Hamming distance of NEARDUP_SIMILARITY from an
+    earlier one are dropped. Fingerprints are kept in the JOBDIR of the
+    spider ('neardup.npy'), so that they are not lost when a job resumes.
+
+    Number of items dropped and kept are in the crawl stats as
+    'neardup/dropped' and 'neardup/kept'.
+
+    Args:
+        stats (scrapy.statscollectors.StatsCollector): Stats of the crawl.
+        similarity (float, optional): Minimum similarity, as the fraction of
+            equal fingerprint bits, for an item to be dropped. Lower values
+            make lookups slower, see 'crawling.simhash'. Defaults to 0.95.
+        shingle_size (int, optional): Number of consecutive words hashed
+            together. Defaults to 3.
+        jobdir (str, optional): Directory of the crawl state. Defaults to
+            None, which means that fingerprints are kept only in memory.
+    """
+
+    def __init__(self, stats, similarity=0.95, shingle_size=3, jobdir=None):
+        self.stats = stats
+        self.max_distance = int((1 - similarity) * 64)
+        self.shingle_size = shingle_size
+        self.filepath = None
+        if jobdir is not None:
+            self.filepath = os.path.join(jobdir, 'neardup.npy')
+        self.index = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            crawler.stats,
+            similarity=settings.getfloat('NEARDUP_SIMILARITY', 0.95),
+            shingle_size=settings.getint('NEARDUP_SHINGLE_SIZE', 3),
+            jobdir=job_dir(settings)
+        )
+
+    def open_spider(self, spider):
+        if self.filepath is not None and os.path.exists(self.filepath):
+            self.index = SimHashIndex.load(self.filepath,
+                                           max_distance=self.max_distance)
+            spider.logger.info(f'Loaded {len(self.index)} near-duplicate '
+                               f'fingerprints from "{self.filepath}"')
+        else:
+            self.index = SimHashIndex(max_distance=self.max_distance)
+
+    def close_spider(self, spider):
+        if self.filepath is not None:
+            self.index.save(self.filepath)
+        n_dropped = self.stats.get_value('neardup/dropped', 0, spider=spider)
+        n_kept = self.stats.get_value('neardup/kept', 0, spider=spider)
+        spider.logger.info(f'Dropped {n_dropped} near-duplicate items and '
+                           f'kept {n_kept}, index of {len(self.index)} '
+                           f'fingerprints takes {self.index.nbytes / 1e6:.1f} '
+                           'MB and compared '
+                           f'{self.index.mean_candidates:.0f} candidates '
+                           'per lookup')
+
+    def process_item(self, item, spider):
+        tokens = ' '.join(item.get('content', ())).lower().split()
+        fingerprint = simhash(tokens, shingle_size=self.shingle_size)
+        if fingerprint is None:
+            return item
+        distance = self.index.find(fingerprint)
+        if distance is not None:
+            self.stats.inc_value('neardup/dropped', spider=spider)
+            raise DropItem(f'Near-duplicate at distance {distance}: '
+                           f'{item.get("url")}')
+        self.index.add(fingerprint)
+        self.stats.inc_value('neardup/kept', spider=spider)
+        return item
 
 
 class CrawlingPipeline(object):
+    """Write items into rotating, gzip compressed JSON line shards.
+
+    Items are buffered and serialized in batches, and each batch is appended
+    into the open shard of the spider as its own gzip member. A batch is
+    written once it has FEED_SHARD_BATCH_ITEMS items, or once its first item
+    has been buffered for FEED_SHARD_BATCH_SECONDS, so that a crash loses
+    only the last few seconds of items of a slow spider. The open shard
+    is named like 'iltalehti.00001.jl.gz.part', and it is renamed into
+    'iltalehti.00001.jl.gz' once it is closed, either when it grows over
+    FEED_SHARD_MAX_BYTES of uncompressed data, has been open for
+    FEED_SHARD_MAX_SECONDS or the spider closes. Closed shards never change,
+    and they are listed with their item offsets and counts in the index of
+    the spider, like 'iltalehti.shards.json'.
 
-    def __init__(self, feed_dir):
+    Args:
+        feed_dir (pathlib.Path): Directory of the feeds.
+        batch_items (int, optional): Number of items serialized and written
+            at once. Defaults to 1000.
+        batch_seconds (float, optional): Maximum number of seconds items are
+            buffered before they are written. Defaults to 5.
+        max_bytes (int, optional): Uncompressed size in bytes after which the
+            shard is rotated. Defaults to 64 MiB.
+        max_seconds (float, optional): Seconds after which the shard is
+            rotated. Defaults to 3600.
+        compresslevel (int, optional): Gzip compression level. Defaults to 6.
+    """
+
+    def __init__(self, feed_dir, batch_items=1000, batch_seconds=5,
+                 max_bytes=1 << 26, max_seconds=3600, compresslevel=6):
         self.feed_dir = feed_dir
+        self.batch_items = batch_items
+        self.batch_seconds = batch_seconds
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compresslevel = compresslevel
+        self.shards = {}
 
     @classmethod
     def from_crawler(cls, crawler):
-        feed_dir = crawler.settings['DATA_DIR'] / 'feed'
-        return cls(feed_dir)
+        settings = crawler.settings
+        feed_dir = settings['DATA_DIR'] / 'feed'
+        return cls(
+            feed_dir,
+            batch_items=settings.getint('FEED_SHARD_BATCH_ITEMS', 1000),
+            batch_seconds=settings.getfloat('FEED_SHARD_BATCH_SECONDS', 5),
+            max_bytes=settings.getint('FEED_SHARD_MAX_BYTES', 1 << 26),
+            max_seconds=settings.getfloat('FEED_SHARD_MAX_SECONDS', 3600),
+            compresslevel=settings.getint('FEED_SHARD_COMPRESSLEVEL', 6)
+        )
 
     def open_spider(self, spider):
         if not os.path.exists(self.feed_dir):
             os.makedirs(self.feed_dir)
-        self.file = open(self.feed_dir / f'{spider.name + ".jl"}',
-                         mode='a', encoding='utf-8')
+        index_filepath = get_index_filepath(self.feed_dir, spider.name)
+        self.shards[spider.name] = {
+            'index_filepath': index_filepath,
+            'index': load_shard_index(index_filepath),
+            'buffer': [],
+            'buffered': None,
+            'file': None,
+            'timer': task.LoopingCall(self.write_due_batch, spider)
+        }
+        self.recover_shard(spider)
+        # Writes the items of a spider that has stopped producing them
+        self.shards[spider.name]['timer'].start(self.batch_seconds,
+                                                now=False)
 
     def close_spider(self, spider):
-        self.file.close()
-    
+        state = self.shards[spider.name]
+        if state['timer'].running:
+            state['timer'].stop()
+        self.write_batch(spider)
+        self.close_shard(spider)
+        del self.shards[spider.name]
+
     def process_item(self, item, spider):
-        self.file.write(json.dumps(item) + '\n')
+        state = self.shards[spider.name]
+        if not state['buffer']:
+            state['buffered'] = time.time()
+        state['buffer'].append(dict(item))
+        if len(state['buffer']) >= self.batch_items:
+            self.write_batch(spider)
+        else:
+            self.write_due_batch(spider)
         return item
 
+    def write_due_batch(self, spider):
+        """Write buffered items if they are due, or rotate an old shard."""
+        state = self.shards[spider.name]
+        now = time.time()
+        if ((state['buffer']
+                and now - state['buffered'] >= self.batch_seconds)
+                or (state['file'] is not None
+                    and now - state['opened'] >= self.max_seconds)):
+            self.write_batch(spider)
+
+    def get_shard_filepath(self, name, number):
+        return self.feed_dir / f'{name}.{number:05d}.jl.gz'
+
+    def recover_shard(self, spider):
+        """Close shard left open by a crashed crawler.
+
+        Incomplete batches at the end of the shard are dropped.
+        """
+        state = self.shards[spider.name]
+        number = len(state['index']) + 1
+        part_filepath = f'{self.get_shard_filepath(spider.name, number)}.part'
+        if not os.path.exists(part_filepath):
+            return
+        with open(part_filepath, 'rb') as f:
+            data = f.read()
+        end_offset, n_lines, n_bytes = find_complete_members(data)
+        if n_lines == 0:
+            os.remove(part_filepath)
+            return
+        with open(part_filepath, 'r+b') as f:
+            f.truncate(end_offset)
+        mtime = os.path.getmtime(part_filepath)
+        state.update(file=open(part_filepath, 'ab'), number=number,
+                     items=n_lines, bytes=n_bytes, compressed_bytes=end_offset,
+                     opened=mtime)
+        spider.logger.warning(f'Recovered {n_lines} items from shard '
+                              f'"{part_filepath}" left open')
+        self.close_shard(spider)
+
+    def open_shard(self, spider):
+        state = self.shards[spider.name]
+        number = len(state['index']) + 1
+        part_filepath = f'{self.get_shard_filepath(spider.name, number)}.part'
+        state.update(file=open(part_filepath, 'wb'), number=number, items=0,
+                     bytes=0, compressed_bytes=0, opened=time.time())
+
+    def close_shard(self, spider):
+        state = self.shards[spider.name]
+        if state['file'] is None:
+            return
+        state['file'].close()
+        state['file'] = None
+        filepath = self.get_shard_filepath(spider.name, state['number'])
+        os.replace(f'{filepath}.part', filepath)
+
+        index = state['index']
+        first_item = 0
+        if index:
+            first_item = index[-1]['first_item'] + index[-1]['items']
+        index.append({
+            'file': filepath.name,
+            'first_item': first_item,
+            'items': state['items'],
+            'bytes': state['bytes'],
+            'compressed_bytes': state['compressed_bytes'],
+            'opened': state['opened'],
+            'closed': time.time()
+        })
+        save_shard_index(state['index_filepath'], index)
+        spider.logger.info(f'Closed shard "{filepath}" with '
+                           f'{state["items"]} items')
+
+    def write_batch(self, spider):
+        """Serialize buffered items and append them into the open shard."""
+        state = self.shards[spider.name]
+        if state['file'] is not None and (
+                time.time() - state['opened'] >= self.max_seconds):
+            self.close_shard(spider)
+        if not state['buffer']:
+            return
+        if state['file'] is None:
+            self.open_shard(spider)
+
+        data = ''.join(json.dumps(item, ensure_ascii=False,
+                                  escape_forward_slashes=False) + '\n'
+                       for item in state['buffer']).encode('utf8')
+        compressed = gzip.compress(data, compresslevel=self.compresslevel)
+        state['file'].write(compressed)
+        state['file'].flush()
+        state['items'] += len(state['buffer'])
+        state['bytes'] += len(data)
+        state['compressed_bytes'] += len(compressed)
+        state['buffer'] = []
+        if state['bytes'] >= self.max_bytes:
+            self.close_shard(spider)
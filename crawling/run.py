@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+"""Run several spiders at once in one process.
+
+All given spiders are crawled concurrently in a single CrawlerProcess, with
+per-domain concurrency limits and adaptive throttling of
+'FweDownloaderMiddleware'. Pages and bytes per second of each spider are
+logged periodically and reported when all spiders have finished.
+
+With '--standin', the spiders crawl a local HTTP stand-in site instead of
+the real one, with optional latency and errors, into a temporary DATA_DIR.
+
+Example:
+    python -m crawling.run iltalehti yle suomi24
+    python -m crawling.run all -s DOMAIN_CONCURRENCY='{"yle.fi": 2}'
+    python -m crawling.run iltalehti vauva --standin --standin-error-rate 0.05
+"""
+
+
+import argparse
+import logging
+import random
+import tempfile
+import threading
+import time
+import ujson as json
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.settings import SETTINGS_PRIORITIES
+from scrapy.utils.project import get_project_settings
+from twisted.internet import task
+
+from crawling.synthetic import WORDS
+
+
+logger = logging.getLogger(__name__)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Handler of the stand-in site.
+
+    Each spider gets its own site under '/<spiderName>/' with pages
+    '/<spiderName>/<i>' for i < 'n_pages' of the server. Pages are generated
+    from the path, and have navigation and footer repeated on every page,
+    links to other pages and to URL variants of them.
+    """
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/robots.txt':
+            self.send_body(200, b'User-agent: *\nDisallow:\n', 'text/plain')
+            return
+        if server.error_rate > 0 and random.random() < server.error_rate:
+            self.send_body(503, b'Service Unavailable', 'text/plain')
+            return
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        site, _, page = self.path.strip('/').partition('/')
+        page = page.split('?')[0]
+        if not page.isdigit() or int(page) >= server.n_pages:
+            self.send_body(404, b'Not Found', 'text/plain')
+            return
+        html = generate_standin_page(site, int(page), server.n_pages)
+        self.send_body(200, html.encode('utf8'), 'text/html; charset=utf-8')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def generate_standin_page(site, page, n_pages, n_links=10):
+    """Generate a page of the stand-in site.
+
+    Args:
+        site (str): Name of the site.
+        page (int): Number of the page.
+        n_pages (int): Number of pages in the site.
+        n_links (int, optional): Number of links to other pages. Defaults
+            to 10.
+
+    Returns:
+        str: HTML of the page.
+    """
+    rng = random.Random(zlib.crc32(f'{site}/{page}'.encode('utf8')))
+
+    def sentence():
+        return ' '.join(rng.choices(WORDS, k=rng.randint(5, 15))) + '.'
+
+    links = ''.join(
+        f'<a href="/{site}/{rng.randrange(n_pages)}">{sentence()}</a>'
+        f'<a href="/{site}/{rng.randrange(n_pages)}?replytocom=1">x</a>'
+        for _ in range(n_links))
+    paragraphs = ''.join(f'<p>{sentence()} {sentence()}</p>'
+                         for _ in range(rng.randint(5, 30)))
+    return (
+        f'<html><body><nav>Etusivu Uutiset Urheilu Viihde {site}</nav>'
+        f'<h1>{sentence()}</h1>{paragraphs}<div>{links}</div>'
+        f'<footer>Kaikki oikeudet pidätetään © {site} Oy</footer>'
+        '</body></html>'
+    )
+
+
+def start_standin_site(n_pages=500, latency=0.0, error_rate=0.0, port=0):
+    """Start the stand-in site in a background thread.
+
+    Args:
+        n_pages (int, optional): Number of pages per spider. Defaults to 500.
+        latency (float, optional): Seconds to wait before each response.
+            Defaults to 0.
+        error_rate (float, optional): Fraction of requests that get a 503
+            error. Defaults to 0.
+        port (int, optional): Port to listen on. Defaults to 0, which means
+            any free port.
+
+    Returns:
+        http.server.ThreadingHTTPServer: Running server, which can be
+            stopped with 'shutdown'.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    server.daemon_threads = True
+    server.n_pages = n_pages
+    server.latency = latency
+    server.error_rate = error_rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Stand-in site with {n_pages} pages per spider at '
+                f'http://127.0.0.1:{server.server_address[1]}/')
+    return server
+
+
+def make_standin_spider(spidercls, base_url, data_dir):
+    """Create a spider class that crawls the stand-in site instead.
+
+    Args:
+        spidercls (type): Spider class, such as 'Yle'.
+        base_url (str): URL of the stand-in site.
+        data_dir (pathlib.Path): DATA_DIR of the crawl.
+
+    Returns:
+        type: Subclass of the spider that starts from the stand-in site of
+            the spider, without domain or URL rules.
+    """
+    name = spidercls.name
+    custom_settings = dict(spidercls.custom_settings or {},
+                           JOBDIR=str(data_dir / 'crawl' / name))
+    return type(f'{spidercls.__name__}StandIn', (spidercls,), {
+        'start_urls': [f'{base_url}/{name}/0'],
+        'allowed_domains': (),
+        'deny_domains': (),
+        'allow': (),
+        'deny': (),
+        'custom_settings': custom_settings
+    })
+
+
+class CrawlReport(object):
+    """Pages and bytes per second of each crawler.
+
+    Args:
+        crawlers (list): Crawlers of the spiders.
+    """
+
+    def __init__(self, crawlers):
+        self.crawlers = crawlers
+        self.start_time = time.perf_counter()
+        self.finish_times = {}
+        self.last_time = self.start_time
+        self.last_totals = {}
+        for crawler in crawlers:
+            crawler.signals.connect(self.spider_closed,
+                                    signal=signals.spider_closed)
+
+    def spider_closed(self, spider):
+        self.finish_times[spider.name] = time.perf_counter()
+
+    def get_totals(self, crawler):
+        stats = crawler.stats
+        if stats is None:
+            return {'pages': 0, 'bytes': 0, 'items': 0}
+        return {
+            'pages': stats.get_value('response_received_count', 0),
+            'bytes': stats.get_value('downloader/response_bytes', 0),
+            'items': stats.get_value('item_scraped_count', 0)
+        }
+
+    def log_rates(self):
+        """Log rates of each spider since the previous call."""
+        now = time.perf_counter()
+        time_passed = max(now - self.last_time, 1e-9)
+        for crawler in self.crawlers:
+            name = crawler.spidercls.name
+            if name in self.finish_times:
+                continue
+            totals = self.get_totals(crawler)
+            last = self.last_totals.get(name, {'pages': 0, 'bytes': 0})
+            pages_per_s = (totals['pages'] - last['pages']) / time_passed
+            bytes_per_s = (totals['bytes'] - last['bytes']) / time_passed
+            logger.info(f'{name}: {pages_per_s:.1f} pages/s, '
+                        f'{bytes_per_s / 1e3:.0f} kB/s, '
+                        f'{totals["items"]} items')
+            self.last_totals[name] = totals
+        self.last_time = now
+
+    def summary(self):
+        """Summarize the whole crawl.
+
+        Returns:
+            dict: Pages, bytes and items, and pages and bytes per second of
+                each spider by name.
+        """
+        report = {}
+        for crawler in self.crawlers:
+            name = crawler.spidercls.name
+            totals = self.get_totals(crawler)
+            finish_time = self.finish_times.get(name, time.perf_counter())
+            seconds = max(finish_time - self.start_time, 1e-9)
+            report[name] = dict(totals, seconds=seconds,
+                                pages_per_s=totals['pages'] / seconds,
+                                bytes_per_s=totals['bytes'] / seconds)
+            logger.info(f'{name}: {totals["pages"]} pages and '
+                        f'{totals["items"]} items in {seconds:.0f} seconds, '
+                        f'{report[name]["pages_per_s"]:.1f} pages/s, '
+                        f'{report[name]["bytes_per_s"] / 1e3:.0f} kB/s')
+        return report
+
+
+def run_spiders(names, settings=None, report_interval=10, standin=False,
+                standin_pages=500, standin_latency=0.0,
+                standin_error_rate=0.0):
+    """Crawl spiders concurrently in one process until all have finished.
+
+    Args:
+        names (list): Names of the spiders, or ['all'] for all spiders.
+        settings (scrapy.settings.Settings, optional): Settings. Defaults to
+            None, which means the project settings.
+        report_interval (float, optional): Seconds between logs of pages and
+            bytes per second. Defaults to 10.
+        standin (bool, optional): Whether to crawl a local stand-in site
+            instead of the real ones. Unless DATA_DIR is set explicitly, data
+            is written into a temporary directory. Defaults to False.
+        standin_pages (int, optional): Number of pages per spider in the
+            stand-in site. Defaults to 500.
+        standin_latency (float, optional): Seconds to wait before each
+            response of the stand-in site. Defaults to 0.
+        standin_error_rate (float, optional): Fraction of 503 errors of the
+            stand-in site. Defaults to 0.
+
+    Returns:
+        dict: Report of each spider, as returned by 'CrawlReport.summary'.
+
+    Raises:
+        KeyError: If a spider is not found.
+    """
+    if settings is None:
+        settings = get_project_settings()
+    server = None
+    if standin:
+        if settings.getpriority('DATA_DIR') < SETTINGS_PRIORITIES['cmdline']:
+            settings.set('DATA_DIR', tempfile.mkdtemp(prefix='fwe-standin-'))
+        server = start_standin_site(n_pages=standin_pages,
+                                    latency=standin_latency,
+                                    error_rate=standin_error_rate)
+    settings.set('DATA_DIR', Path(settings['DATA_DIR']),
+                 priority=settings.getpriority('DATA_DIR'))
+
+    process = CrawlerProcess(settings)
+    if names == ['all']:
+        names = process.spider_loader.list()
+    crawlers = []
+    for name in names:
+        spidercls = process.spider_loader.load(name)
+        if standin:
+            base_url = f'http://127.0.0.1:{server.server_address[1]}'
+            spidercls = make_standin_spider(spidercls, base_url,
+                                            settings['DATA_DIR'])
+        crawler = process.create_crawler(spidercls)
+        process.crawl(crawler)
+        crawlers.append(crawler)
+    logger.info(f'Crawling {len(crawlers)} spiders: {", ".join(names)}')
+
+    report = CrawlReport(crawlers)
+    loop = task.LoopingCall(report.log_rates)
+    loop.start(report_interval, now=False)
+    try:
+        process.start()
+    finally:
+        if loop.running:
+            loop.stop()
+        if server is not None:
+            server.shutdown()
+    return report.summary()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('spiders', nargs='+',
+                        help='Names of the spiders, or "all"')
+    parser.add_argument('-s', '--set', action='append', default=[],
+                        metavar='NAME=VALUE', help='Override a setting')
+    parser.add_argument('--report-interval', type=float, default=10)
+    parser.add_argument('--out', default=None,
+                        help='Filepath of the JSON report')
+    parser.add_argument('--standin', action='store_true',
+                        help='Crawl a local stand-in site instead')
+    parser.add_argument('--standin-pages', type=int, default=500)
+    parser.add_argument('--standin-latency', type=float, default=0.0)
+    parser.add_argument('--standin-error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings = get_project_settings()
+    for override in args.set:
+        name, _, value = override.partition('=')
+        settings.set(name, value, priority='cmdline')
+
+    report = run_spiders(
+        args.spiders, settings=settings,
+        report_interval=args.report_interval, standin=args.standin,
+        standin_pages=args.standin_pages,
+        standin_latency=args.standin_latency,
+        standin_error_rate=args.standin_error_rate)
+    print(json.dumps(report, indent=2))
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
@@ -20,8 +20,20 @@ NEWSPIDER_MODULE = 'crawling.spiders'
 # Data director
 DATA_DIR = Path(__file__).absolute().parent.parent / 'data'
 
-# Duplicate filter
-DUPEFILTER_CLASS = 'scrapy.dupefilters.RFPDupeFilter'
+# Duplicate filter, with a Bloom filter snapshot of seen requests in JOBDIR
+DUPEFILTER_CLASS = 'crawling.dupefilters.BloomDupeFilter'
+DUPEFILTER_ERROR_RATE = 1e-6
+DUPEFILTER_INITIAL_CAPACITY = 1000000
+DUPEFILTER_SNAPSHOT_INTERVAL = 100000
+
+# Crawled items are written into gzip compressed JSON line shards, which are
+# rotated by uncompressed size or age (see CrawlingPipeline). Items are
+# buffered for at most FEED_SHARD_BATCH_SECONDS before they are written
+FEED_SHARD_BATCH_ITEMS = 1000
+FEED_SHARD_BATCH_SECONDS = 5
+FEED_SHARD_MAX_BYTES = 1 << 26
+FEED_SHARD_MAX_SECONDS = 3600
+FEED_SHARD_COMPRESSLEVEL = 6
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'crawling (+http://www.yourdomain.com)'
@@ -60,9 +72,29 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable downloader middlewares
 # See https://doc.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'crawling.middlewares.crawlingDownloaderMiddleware': 543,
-#}
+# FweDownloaderMiddleware runs before RetryMiddleware (550) sees responses
+DOWNLOADER_MIDDLEWARES = {
+    'crawling.middlewares.FweDownloaderMiddleware': 560,
+}
+
+# Maximum concurrent requests per domain, including its subdomains, and
+# CONCURRENT_REQUESTS_PER_DOMAIN for other domains (see
+# FweDownloaderMiddleware)
+DOMAIN_CONCURRENCY = {
+    'suomi24.fi': 4,
+    'vauva.fi': 4,
+    'demi.fi': 4
+}
+
+# Adaptive throttling of each domain by latency and error rate, within the
+# concurrency limits (see FweDownloaderMiddleware)
+THROTTLE_ENABLED = True
+THROTTLE_TARGET_LATENCY = 2.0
+THROTTLE_MAX_ERROR_RATE = 0.05
+THROTTLE_MIN_DELAY = 0.0
+THROTTLE_MAX_DELAY = 30.0
+THROTTLE_ERROR_DELAY = 1.0
+THROTTLE_ERROR_STATUSES = [429, 500, 502, 503, 504]
 
 # Enable or disable extensions
 # See https://doc.scrapy.org/en/latest/topics/extensions.html
@@ -73,9 +105,24 @@ ROBOTSTXT_OBEY = True
 # Configure item pipelines
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+    'crawling.pipelines.BoilerplatePipeline': 100,
+    'crawling.pipelines.NearDuplicatePipeline': 200,
     'crawling.pipelines.CrawlingPipeline': 300,
 }
 
+# Items whose text is at least this similar to an earlier item are dropped
+# (see NearDuplicatePipeline). Lower values compare each item against more
+# candidates: 0.006% of the kept items at 0.95 and 1.3% at 0.9 (see
+# crawling.simhash)
+NEARDUP_SIMILARITY = 0.95
+NEARDUP_SHINGLE_SIZE = 3
+
+# Text blocks found on at least this many pages of a spider are left out of
+# the items, counted in 2 * WIDTH * DEPTH bytes (see BoilerplatePipeline)
+BOILERPLATE_MIN_PAGES = 10
+BOILERPLATE_SKETCH_WIDTH = 1 << 20
+BOILERPLATE_SKETCH_DEPTH = 4
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://doc.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Count-min sketch for counting text blocks in bounded memory.
+
+A count-min sketch is a table of 'depth' rows of 'width' counters. Each item
+is hashed into one counter per row, and its count is estimated as the
+minimum of those counters, which never underestimates and overestimates
+only when all of the counters are shared with other items. Counters are
+incremented with conservative update, which raises only the counters equal
+to the estimate, and they saturate instead of overflowing.
+"""
+
+
+import hashlib
+import os
+
+import numpy as np
+
+
+def hash_blocks(blocks):
+    """Hash text blocks into two 64-bit integers each.
+
+    Args:
+        blocks (list): Text blocks.
+
+    Returns:
+        numpy.ndarray: uint64 array of shape (number of blocks, 2).
+    """
+    digests = b''.join(
+        hashlib.blake2b(block.encode('utf8'), digest_size=16).digest()
+        for block in blocks)
+    return np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+
+
+class CountMinSketch(object):
+    """Count-min sketch of text blocks.
+
+    Memory usage is 2 * 'depth' * 'width' bytes.
+
+    Args:
+        width (int, optional): Number of counters per row, a power of two.
+            Defaults to 2 ** 20.
+        depth (int, optional): Number of rows. Defaults to 4.
+        table (numpy.ndarray, optional): uint16 counters of shape (depth,
+            width) to continue from. Defaults to None.
+
+    Raises:
+        ValueError: If width is not a power of two.
+    """
+
+    def __init__(self, width=1 << 20, depth=4, table=None):
+        if table is not None:
+            depth, width = table.shape
+        if width & (width - 1) != 0:
+            raise ValueError(f'Width {width} is not a power of two!')
+        self.width = width
+        self.depth = depth
+        if table is None:
+            table = np.zeros((depth, width), dtype=np.uint16)
+        self.table = table
+        self.rows = np.arange(depth)[:, None]
+        self.max_count = np.iinfo(table.dtype).max
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+    @classmethod
+    def load(cls, filepath):
+        """Load sketch from a file.
+
+        Args:
+            filepath (str): Filepath of the '.npy' counters.
+
+        Returns:
+            CountMinSketch: Loaded sketch.
+        """
+        return cls(table=np.load(filepath))
+
+    def save(self, filepath):
+        """Save counters of the sketch atomically.
+
+        Args:
+            filepath (str): Filepath of the '.npy' counters.
+        """
+        tmp_filepath = filepath + '.tmp.npy'
+        np.save(tmp_filepath, self.table)
+        os.replace(tmp_filepath, filepath)
+
+    def get_cells(self, blocks):
+        """Get counter indices of text blocks.
+
+        Args:
+            blocks (list): Text blocks.
+
+        Returns:
+            numpy.ndarray: Column of each block in each row, with shape
+                (depth, number of blocks).
+        """
+        hashes = hash_blocks(blocks)
+        steps = np.arange(self.depth, dtype=np.uint64)[:, None]
+        cells = hashes[:, 0] + steps * (hashes[:, 1] | np.uint64(1))
+        return (cells & np.uint64(self.width - 1)).astype(np.int64)
+
+    def estimate(self, blocks):
+        """Estimate counts of text blocks.
+
+        Args:
+            blocks (list): Text blocks.
+
+        Returns:
+            numpy.ndarray: Estimated count of each block.
+        """
+        if not blocks:
+            return np.zeros(0, dtype=self.table.dtype)
+        return self.table[self.rows, self.get_cells(blocks)].min(axis=0)
+
+    def add(self, blocks):
+        """Count text blocks once each and estimate their counts.
+
+        Args:
+            blocks (list): Distinct text blocks.
+
+        Returns:
+            numpy.ndarray: Estimated count of each block, including this one.
+        """
+        if not blocks:
+            return np.zeros(0, dtype=self.table.dtype)
+        cells = self.get_cells(blocks)
+        counts = self.table[self.rows, cells]
+        new_counts = np.minimum(counts.min(axis=0).astype(np.int64) + 1,
+                                self.max_count)
+        self.table[self.rows, cells] = np.maximum(counts, new_counts)
+        return new_counts
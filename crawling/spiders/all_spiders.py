@@ -2,6 +2,7 @@
 
 
 import os
+import re
 
 from scrapy import Request
 from scrapy.spiders import CrawlSpider, Rule, Spider
@@ -12,6 +13,41 @@ from scrapy.utils.project import get_project_settings
 CRAWL_DIR = get_project_settings()['DATA_DIR'] / 'crawl'
 
 
+# Elements whose text is never content, skipped with their subtrees
+SKIP_TAGS = frozenset(['script', 'style', 'noscript'])
+
+# Characters typical of CSS, counted in one pass
+CSS_CHARS_RE = re.compile('[;:#{}]')
+
+
+def iter_texts(root):
+    """Iterate text nodes under an element in document order.
+
+    The tree is walked once with an explicit stack, and subtrees of SKIP_TAGS
+    elements and comments are skipped, but not the text that follows them.
+
+    Args:
+        root (lxml.etree._Element): Element to start from.
+
+    Yields:
+        str: Text nodes.
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            yield node
+            continue
+        if not isinstance(node.tag, str) or node.tag in SKIP_TAGS:
+            continue
+        if node.text:
+            yield node.text
+        for child in reversed(node):
+            if child.tail:
+                stack.append(child.tail)
+            stack.append(child)
+
+
 def extract_text(resp, min_tokens=3):
     """Extract all text from a web page.
 
@@ -22,16 +58,12 @@ def extract_text(resp, min_tokens=3):
     Returns:
         List of strings with individual text elements found from the page.
     """
-    selector = '//body/descendant-or-self::*[not(self::script)]/text()'
-    texts = resp.selector.xpath(selector).extract()
     ret = []
-    for text in texts:
-        css_count = (text.count(';') + text.count(':') + text.count('#')
-                     + text.count('{') + text.count('}'))
-        if ((len(text) > 0)
-            and (len(text.split()) >= min_tokens)
-            and (css_count < 4)): # Avoid css styling as text
-            ret.append(text.strip())
+    for body in resp.selector.root.iter('body'):
+        for text in iter_texts(body):
+            if (len(text.split()) >= min_tokens
+                    and len(CSS_CHARS_RE.findall(text)) < 4):
+                ret.append(text.strip())
     return ret
 
 
@@ -42,16 +74,21 @@ class BaseSpider(Spider):
     deny_domains = ()
     allowed_domains = ()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.link_extractor = LinkExtractor(
+            allow_domains=self.allowed_domains,
+            deny_domains=self.deny_domains,
+            allow=self.allow,
+            deny=self.deny
+        )
+
     def parse(self, resp):
         yield {
             'url': resp.url,
             'content': extract_text(resp)
         }
-        for link in (LinkExtractor(allow_domains=self.allowed_domains,
-                                   deny_domains=self.deny_domains,
-                                   allow=self.allow,
-                                   deny=self.deny)
-                     .extract_links(resp)):
+        for link in self.link_extractor.extract_links(resp):
             yield Request(link.url, callback=self.parse)
 
 
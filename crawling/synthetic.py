@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+"""Vocabulary of synthetic Finnish text.
+
+Used for generating pages in the parsing benchmark and on the stand-in site
+of 'crawling.run'.
+"""
+
+
+WORDS = ['koira', 'kissa', 'talo', 'auto', 'päivä', 'tänään', 'sää', 'on',
+         'ja', 'hallitus', 'eduskunta', 'kunta', 'uutinen', 'kesä', 'talvi',
+         'ihminen', 'työ', 'raha', 'koulu', 'lapsi', 'peli', 'ottelu',
+         'mukaan', 'vuonna', 'myös', 'mutta', 'kun', 'kertoo', 'sanoo']
@@ -0,0 +1,384 @@
+"""Module for approximate nearest neighbor search over word embeddings.
+
+The index is an inverted file (IVF) index: normalized word vectors are
+clustered with spherical k-means, and each word is stored in the inverted list
+of its nearest centroid. A query is compared against centroids first, and then
+only against the words in its 'n_probe' nearest lists. 'n_lists' and 'n_probe'
+trade recall for speed: more lists with fewer probes is faster, more probes
+gives higher recall.
+"""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import re
+import time
+import ujson as json
+
+import numpy as np
+
+from bundle import get_bundle_dir
+from query import SimilarityIndex, merge_top_k, normalize_rows
+
+
+def assign_clusters(x, centroids, spherical=True, rows_per_block=None):
+    """Assign rows of a matrix to their nearest centroids.
+
+    Args:
+        x (numpy.ndarray): Matrix, one row per point.
+        centroids (numpy.ndarray): Centroids, one row per cluster.
+        spherical (bool, optional): Whether to use cosine similarity of
+            normalized rows instead of Euclidean distance. Defaults to True.
+        rows_per_block (int, optional): Number of rows assigned at once.
+            Defaults to None, which means as many as fit 256 MiB of scores.
+
+    Returns:
+        numpy.ndarray: Cluster index of each row.
+    """
+    bias = 0 if spherical else -0.5 * np.einsum('ij,ij->i', centroids,
+                                                centroids)
+    if rows_per_block is None:
+        rows_per_block = max((1 << 28) // (4 * len(centroids)), 1)
+    labels = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), rows_per_block):
+        block = np.asarray(x[start:start + rows_per_block], dtype=np.float32)
+        labels[start:start + len(block)] = np.argmax(
+            block @ centroids.T + bias, axis=1)
+    return labels
+
+
+def kmeans(x, n_clusters, n_iter=20, sample_size=None,
+           max_sample_bytes=1 << 28, spherical=True, seed=0):
+    """Cluster rows of a matrix with Lloyd's k-means.
+
+    Args:
+        x (numpy.ndarray): Matrix, one row per point, may be memory-mapped.
+        n_clusters (int): Number of clusters.
+        n_iter (int, optional): Number of iterations. Defaults to 20.
+        sample_size (int, optional): Number of random rows to train on.
+            Defaults to None, which means 256 rows per cluster, but at most
+            'max_sample_bytes' of rows.
+        max_sample_bytes (int, optional): Maximum size of the default
+            training sample in bytes. Defaults to 256 MiB.
+        spherical (bool, optional): Whether to cluster by cosine similarity
+            and keep centroids normalized. Defaults to True.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        numpy.ndarray: float32 centroids, one row per cluster.
+    """
+    rng = np.random.RandomState(seed)
+    if sample_size is None:
+        max_rows = max_sample_bytes // (4 * x.shape[1])
+        sample_size = max(min(256 * n_clusters, max_rows), n_clusters)
+    sample_size = min(sample_size, len(x))
+    n_clusters = min(n_clusters, sample_size)
+    sample_idx = np.sort(rng.choice(len(x), sample_size, replace=False))
+    sample = np.asarray(x[sample_idx], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, n_clusters, replace=False)]
+
+    for _ in range(n_iter):
+        labels = assign_clusters(sample, centroids, spherical=spherical)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+
+        # Empty clusters are restarted from random points
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(sample_size, empty.sum())]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+        if spherical:
+            centroids = normalize_rows(centroids)
+    return centroids
+
+
+def build_inverted_lists(labels, n_lists):
+    """Group row indices by their cluster.
+
+    Args:
+        labels (numpy.ndarray): Cluster index of each row.
+        n_lists (int): Number of clusters.
+
+    Returns:
+        tuple: Two-element tuple with start offset of each list in the ids,
+            plus the end, and the row ids grouped by list.
+    """
+    list_ids = np.argsort(labels, kind='stable')
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_lists), out=list_offsets[1:])
+    return list_offsets,list_ids
+
+
+class IVFIndex(SimilarityIndex):
+    """Approximate similarity queries with an inverted file index.
+
+    Supports the same queries as query.SimilarityIndex, but compares each
+    query only against the words in its 'n_probe' nearest inverted lists.
+
+    Args:
+        vectors (numpy.ndarray): Normalized float32 vectors, may be memory-
+            mapped.
+        index (callable): Function that returns index of a word, raising
+            KeyError for unknown words.
+        word (callable): Function that returns word of an index.
+        centroids (numpy.ndarray): Normalized centroids of the lists.
+        list_offsets (numpy.ndarray): Start offset of each list in
+            'list_ids', plus the end.
+        list_ids (numpy.ndarray): Word indices grouped by list.
+        n_probe (int, optional): Number of lists searched per query. Defaults
+            to 8.
+        **kwargs: Keyword arguments passed to query.SimilarityIndex.
+    """
+
+    def __init__(self, vectors, index, word, centroids, list_offsets,
+                 list_ids, n_probe=8, **kwargs):
+        super().__init__(vectors, index, word, **kwargs)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.n_probe = n_probe
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, exact, n_lists=None, n_iter=20, n_probe=8, seed=0):
+        """Build index over the vectors of an exact index.
+
+        Args:
+            exact (query.SimilarityIndex): Exact index to build on.
+            n_lists (int, optional): Number of inverted lists. Defaults to
+                None, which means 4 * sqrt(number of words).
+            n_iter (int, optional): Number of k-means iterations. Defaults to
+                20.
+            n_probe (int, optional): Number of lists searched per query.
+                Defaults to 8.
+            seed (int, optional): Random seed. Defaults to 0.
+
+        Returns:
+            IVFIndex: Built index.
+        """
+        start_time = time.perf_counter()
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(len(exact))))
+        centroids = kmeans(exact.vectors, n_lists, n_iter=n_iter, seed=seed)
+        labels = assign_clusters(exact.vectors, centroids)
+        list_offsets, list_ids = build_inverted_lists(labels, len(centroids))
+        logger.info(f'Built IVF index with {len(centroids)} lists over '
+                    f'{len(exact)} words in '
+                    f'{time.perf_counter() - start_time:.0f} seconds')
+        return cls(exact.vectors, exact.index, exact.word, centroids,
+                   list_offsets, list_ids, n_probe=n_probe,
+                   max_block_bytes=exact.max_block_bytes)
+
+    @classmethod
+    def load(cls, filepath, exact, n_probe=8):
+        """Load index saved with 'save'.
+
+        Args:
+            filepath (str): Filepath of the index.
+            exact (query.SimilarityIndex): Exact index of the same vectors.
+            n_probe (int, optional): Number of lists searched per query.
+                Defaults to 8.
+
+        Returns:
+            IVFIndex: Loaded index.
+        """
+        with np.load(filepath) as data:
+            return cls(exact.vectors, exact.index, exact.word,
+                       data['centroids'], data['list_offsets'],
+                       data['list_ids'], n_probe=n_probe,
+                       max_block_bytes=exact.max_block_bytes)
+
+    def save(self, filepath):
+        """Save centroids and inverted lists of the index.
+
+        Args:
+            filepath (str): Filepath of the index, ending with '.npz'.
+        """
+        np.savez(filepath, centroids=self.centroids,
+                 list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    def exact_top_k(self, queries, k=10, exclude=None):
+        """Find the most similar vocabulary entries with exact search.
+
+        See query.SimilarityIndex.top_k.
+        """
+        return super().top_k(queries, k=k, exclude=exclude)
+
+    def top_k(self, queries, k=10, exclude=None, n_probe=None):
+        """Find approximately the most similar vocabulary entries of queries.
+
+        Args:
+            queries (numpy.ndarray): Query vectors, one row per query. Should
+                be normalized for the scores to be cosine similarities.
+            k (int, optional): Number of results per query. Defaults to 10.
+            exclude (list, optional): Lists of indices to leave out of the
+                results, one per query. Defaults to None.
+            n_probe (int, optional): Number of lists searched per query.
+                Defaults to None, which means 'self.n_probe'.
+
+        Returns:
+            tuple: Two-element tuple with arrays of indices and scores, both
+                of shape (number of queries, k), best first. Missing results
+                have index -1 and score -inf.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        n_queries = len(queries)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        n_extra = max((len(e) for e in exclude), default=0) if exclude else 0
+        k_search = k + n_extra
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1,
+                                 axis=1)[:, :n_probe]
+
+        best_idx = np.full((n_queries, k_search), -1, dtype=np.int64)
+        best_scores = np.full((n_queries, k_search), -np.inf,
+                              dtype=np.float32)
+
+        # Queries are grouped by the lists they probe, so that each list is
+        # scored against all of its queries with one matrix product
+        query_ids = np.repeat(np.arange(n_queries), n_probe)
+        order = np.argsort(probes.ravel(), kind='stable')
+        lists, starts = np.unique(probes.ravel()[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for l,start,end in zip(lists, starts, ends):
+            ids = self.list_ids[self.list_offsets[l]:self.list_offsets[l + 1]]
+            if not len(ids):
+                continue
+            list_vectors = np.asarray(self.vectors[ids])
+            group = query_ids[order[start:end]]
+            rows_per_block = max(self.max_block_bytes // (4 * len(ids)), 1)
+            for i in range(0, len(group), rows_per_block):
+                rows = group[i:i + rows_per_block]
+                scores = queries[rows] @ list_vectors.T
+                best_idx[rows], best_scores[rows] = merge_top_k(
+                    np.hstack([best_idx[rows],
+                               np.broadcast_to(ids, scores.shape)]),
+                    np.hstack([best_scores[rows], scores]), k_search)
+
+        if exclude:
+            excluded = np.full((n_queries, n_extra), -2, dtype=np.int64)
+            for i,e in enumerate(exclude):
+                excluded[i, :len(e)] = e
+            mask = (best_idx[:, :, None] == excluded[:, None, :]).any(axis=2)
+            best_idx[mask] = -1
+            best_scores[mask] = -np.inf
+            best_idx, best_scores = merge_top_k(best_idx, best_scores,
+                                                k_search)
+        return best_idx[:, :k],best_scores[:, :k]
+
+
+def get_ann_filepath(filepath):
+    """Get filepath of the index that corresponds to a word2vec format file.
+
+    Args:
+        filepath (str): Path to a word2vec format file, such as
+            'fasttext.fi.all.1045M.100d.bin.gz'.
+
+    Returns:
+        str: Path like 'fasttext.fi.all.1045M.100d.ivf.npz'.
+    """
+    return re.sub(r'\.(bin|vec)(\.gz|\.zst)?$', '', filepath) + '.ivf.npz'
+
+
+def evaluate_ann(ann, n_queries=1000, k=10, n_probes=(1, 2, 4, 8, 16, 32, 64),
+                 seed=0):
+    """Measure recall@k and latency of an index against exact search.
+
+    Queries are random words of the vocabulary, leaving the word itself out
+    of the results. Exact search is timed on the whole batch and approximate
+    search query by query, so that latencies are per single query.
+
+    Args:
+        ann (IVFIndex): Index to evaluate.
+        n_queries (int, optional): Number of queries. Defaults to 1000.
+        k (int, optional): Number of neighbors. Defaults to 10.
+        n_probes (tuple, optional): Values of 'n_probe' to evaluate. Defaults
+            to (1, 2, 4, 8, 16, 32, 64).
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict: Report with 'k', 'n_queries', 'n_lists', exact search latency
+            'exact_ms' and list of 'results' with 'n_probe', 'recall' and
+            'latency_ms' for each value of 'n_probe'.
+    """
+    rng = np.random.RandomState(seed)
+    query_idx = rng.choice(len(ann), min(n_queries, len(ann)), replace=False)
+    queries = np.asarray(ann.vectors[np.sort(query_idx)])
+    exclude = [[i] for i in np.sort(query_idx).tolist()]
+
+    start_time = time.perf_counter()
+    exact_idx, _ = ann.exact_top_k(queries, k=k, exclude=exclude)
+    exact_ms = 1000 * (time.perf_counter() - start_time) / len(queries)
+
+    report = {'k': k, 'n_queries': len(queries), 'n_lists': ann.n_lists,
+              'exact_ms': exact_ms, 'results': []}
+    for n_probe in n_probes:
+        if n_probe > ann.n_lists:
+            break
+        start_time = time.perf_counter()
+        approx_idx = np.concatenate([
+            ann.top_k(queries[i:i + 1], k=k, exclude=exclude[i:i + 1],
+                      n_probe=n_probe)[0]
+            for i in range(len(queries))])
+        latency_ms = 1000 * (time.perf_counter() - start_time) / len(queries)
+        recall = np.mean([len(np.intersect1d(a, e)) / k
+                          for a,e in zip(approx_idx, exact_idx)])
+        report['results'].append({'n_probe': n_probe,
+                                  'recall': float(recall),
+                                  'latency_ms': latency_ms})
+        logger.info(f'IVF n_probe={n_probe}: recall@{k} {recall:.3f}, '
+                    f'{latency_ms:.2f} ms/query (exact {exact_ms:.2f} '
+                    'ms/query)')
+    return report
+
+
+def build_ann_index(filepath, n_lists=None, n_probe=8, evaluate=True):
+    """Build and save index for word vectors exported with a bundle.
+
+    The index is saved next to the word2vec format file, and the recall@k
+    versus latency report next to it with '.json' extension.
+
+    Args:
+        filepath (str): Path to a word2vec format file, such as
+            'fasttext.fi.all.1045M.100d.bin.gz', with a bundle next to it.
+        n_lists (int, optional): Number of inverted lists. Defaults to None,
+            which means 4 * sqrt(number of words).
+        n_probe (int, optional): Default number of lists searched per query.
+            Defaults to 8.
+        evaluate (bool, optional): Whether to write the recall and latency
+            report. Defaults to True.
+
+    Returns:
+        str: Filepath of the index.
+    """
+    exact = SimilarityIndex.from_bundle(get_bundle_dir(filepath))
+    ann = IVFIndex.build(exact, n_lists=n_lists, n_probe=n_probe)
+    ann_filepath = get_ann_filepath(filepath)
+    ann.save(ann_filepath)
+    logger.info(f'Saved IVF index into "{ann_filepath}"')
+    if evaluate:
+        report_filepath = re.sub(r'\.npz$', '.json', ann_filepath)
+        with open(report_filepath, 'w', encoding='utf8') as f:
+            json.dump(evaluate_ann(ann), f, indent=2)
+        logger.info(f'Saved IVF recall report into "{report_filepath}"')
+    return ann_filepath
+
+
+def load_ann_index(filepath, n_probe=8):
+    """Load index of word vectors exported with a bundle.
+
+    Args:
+        filepath (str): Path to the word2vec format file that the index was
+            built for.
+        n_probe (int, optional): Number of lists searched per query. Defaults
+            to 8.
+
+    Returns:
+        IVFIndex: Loaded index.
+    """
+    exact = SimilarityIndex.from_bundle(get_bundle_dir(filepath))
+    return IVFIndex.load(get_ann_filepath(filepath), exact, n_probe=n_probe)
@@ -0,0 +1,616 @@
+"""Module for benchmarking parts of the pipeline.
+
+Runs a benchmark suite on a synthetic corpus and saves the results as JSON,
+or compares two saved runs and flags regressions:
+
+    python benchmark.py run --items 20000 --out results.json
+    python benchmark.py compare baseline.json results.json --threshold 0.1
+"""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import argparse
+import glob
+import itertools
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import ujson as json
+
+import numpy as np
+
+from gensim.models import FastText,Word2Vec
+from gensim.models.keyedvectors import Word2VecKeyedVectors
+
+from corpus import build_vocab
+from preprocess import (check_token_cleaning, generate_tokens,
+                        get_tokenizers, is_valid_token, preprocess_all_files,
+                        reference_is_valid_token)
+from query import SimilarityIndex
+from sentences import count_lines
+from train import get_n_workers, save_word_vectors, train_model
+
+
+# Syllables for generating Finnish-like words
+SYLLABLES = [
+    'ka', 'ko', 'ku', 'ta', 'te', 'ti', 'to', 'la', 'lä', 'le', 'li', 'lo',
+    'pa', 'pi', 'po', 'sa', 'se', 'si', 'su', 'ma', 'me', 'mi', 'mu', 'na',
+    'ne', 'ni', 'va', 've', 'vi', 'ra', 're', 'ri', 'ro', 'ju', 'jo', 'hä',
+    'he', 'hy', 'yö', 'öl', 'kää', 'taa', 'tii', 'suu', 'nen', 'kin', 'han',
+    'ssa', 'ssä', 'lla', 'llä', 'sta', 'stä', 'ksi', 'lle', 'ja', 'jä'
+]
+
+# Paragraphs repeated on many pages, like navigation and cookie notices
+BOILERPLATE = [
+    'Käytämme evästeitä parantaaksemme käyttökokemusta sivustollamme.',
+    'Lue lisää tietosuojaselosteestamme ja hallitse asetuksiasi täällä.',
+    'Tilaa uutiskirje ja saat päivän tärkeimmät uutiset sähköpostiisi!'
+]
+
+def benchmark_token_cleaning(tokens=None, n_repeats=5):
+    """Measure token cleaning throughput against the reference.
+
+    Args:
+        tokens (list, optional): Tokens to clean. Defaults to None, which means
+            a set of generated tokens.
+        n_repeats (int, optional): Number of repeats, of which the fastest is
+            reported. Defaults to 5.
+
+    Returns:
+        dict: Tokens per second for 'reference' and 'current' implementation.
+    """
+    if tokens is None:
+        tokens = generate_tokens()
+
+    def current(tokens):
+        return [token for token in tokens
+                if token.isalnum() or is_valid_token(token)]
+
+    def reference(tokens):
+        return [token for token in tokens if reference_is_valid_token(token)]
+
+    results = {}
+    for name,func in [('reference', reference), ('current', current)]:
+        best_time = float('inf')
+        for _ in range(n_repeats):
+            start_time = time.perf_counter()
+            func(tokens)
+            best_time = min(best_time, time.perf_counter() - start_time)
+        results[name] = len(tokens) / best_time
+        logger.info(f'Token cleaning ({name}): '
+                    f'{results[name] / 1e6:.2f}M tokens/s')
+    return results
+
+
+def generate_words(n_words=50000, seed=0):
+    """Generate Finnish-like words from syllables.
+
+    Args:
+        n_words (int, optional): Number of unique words. Defaults to 50000.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: List of unique words.
+    """
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < n_words:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(1, 5))))
+    return sorted(words)
+
+
+def generate_sentences(n_sentences=100000, words=None, min_len=5, max_len=25,
+                       seed=0):
+    """Generate sentences with Zipf-distributed word frequencies.
+
+    Args:
+        n_sentences (int, optional): Number of sentences. Defaults to 100000.
+        words (list, optional): Words to use. Defaults to None, which means
+            'generate_words' with the same seed.
+        min_len (int, optional): Minimum sentence length in tokens. Defaults
+            to 5.
+        max_len (int, optional): Maximum sentence length in tokens. Defaults
+            to 25.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Yields:
+        list: Tokens of a sentence.
+    """
+    rng = random.Random(seed)
+    if words is None:
+        words = generate_words(seed=seed)
+    words = list(words)
+    rng.shuffle(words)
+    cum_weights = list(itertools.accumulate(1 / (i + 1)
+                                            for i in range(len(words))))
+    for _ in range(n_sentences):
+        yield rng.choices(words, cum_weights=cum_weights,
+                          k=rng.randint(min_len, max_len))
+
+
+def write_sentlines(filepath, sentences):
+    """Write sentences into a sentence lines file.
+
+    Args:
+        filepath (str): Filepath of the sentence lines file.
+        sentences (iterable): Sentences as lists of tokens.
+
+    Returns:
+        int: Number of tokens written.
+    """
+    n_tokens = 0
+    with open(filepath, 'w', encoding='utf8') as f:
+        for sent in sentences:
+            f.write(' '.join(sent) + '\n')
+            n_tokens += len(sent)
+    return n_tokens
+
+
+def generate_paragraph(rng, sentences):
+    """Generate paragraph of text from tokenized sentences.
+
+    Args:
+        rng (random.Random): Random number generator.
+        sentences (iterator): Sentences as lists of tokens.
+
+    Returns:
+        str: Paragraph with capitalized sentences, punctuation and some URLs,
+            numbers and emojis.
+    """
+    sents = []
+    for _ in range(rng.randint(1, 5)):
+        tokens = list(next(sentences))
+        if rng.random() < 0.1:
+            tokens.insert(rng.randrange(len(tokens)),
+                          f'https://www.example.fi/{rng.choice(tokens)}')
+        if rng.random() < 0.1:
+            tokens.insert(rng.randrange(len(tokens)),
+                          rng.choice(['2019', '12,5', '😀', '(kuva)', '–']))
+        if rng.random() < 0.2:
+            tokens[rng.randrange(len(tokens))] += ','
+        sents.append(' '.join(tokens).capitalize()
+                     + rng.choice(['.', '.', '.', '!', '?']))
+    return ' '.join(sents)
+
+
+def generate_feed(filepath, n_items=10000, min_paragraphs=3,
+                  max_paragraphs=15, boilerplate_prob=0.3, seed=0):
+    """Write synthetic crawled JSON lines like 'CrawlingPipeline' output.
+
+    Args:
+        filepath (str): Filepath of the JSON lines file.
+        n_items (int, optional): Number of crawled pages. Defaults to 10000.
+        min_paragraphs (int, optional): Minimum number of paragraphs per page.
+            Defaults to 3.
+        max_paragraphs (int, optional): Maximum number of paragraphs per page.
+            Defaults to 15.
+        boilerplate_prob (float, optional): Probability of a page to have a
+            boilerplate paragraph. Defaults to 0.3.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        int: Number of bytes written.
+    """
+    rng = random.Random(seed)
+    sentences = generate_sentences(n_sentences=n_items * max_paragraphs * 5,
+                                   seed=seed)
+    with open(filepath, 'w', encoding='utf8') as f:
+        for i in range(n_items):
+            content = [generate_paragraph(rng, sentences)
+                       for _ in range(rng.randint(min_paragraphs,
+                                                  max_paragraphs))]
+            if rng.random() < boilerplate_prob:
+                content.append(rng.choice(BOILERPLATE))
+            f.write(json.dumps({
+                'url': f'https://www.example.fi/uutiset/{seed}-{i}',
+                'content': content
+            }, ensure_ascii=False, escape_forward_slashes=False) + '\n')
+        return f.tell()
+
+
+def benchmark_training_scaling(model_name='word2vec', n_sentences=200000,
+                               max_workers=None, training_mode='corpus_file',
+                               size=100, epochs=1):
+    """Measure training throughput with 1, 2, 4, 8... workers.
+
+    Args:
+        model_name (str, optional): Either 'word2vec' or 'fasttext'. Defaults
+            to 'word2vec'.
+        n_sentences (int, optional): Number of synthetic sentences. Defaults to
+            200000.
+        max_workers (int, optional): Maximum number of workers. Defaults to
+            None, which means the number of available CPUs.
+        training_mode (str, optional): Either 'corpus_file' or 'sentences'.
+            Defaults to 'corpus_file'.
+        size (int, optional): Word embeddings vector dimension. Defaults to
+            100.
+        epochs (int, optional): Number of training epochs. Defaults to 1.
+
+    Returns:
+        dict: Training words per second by number of workers.
+    """
+    model_class = {'word2vec': Word2Vec, 'fasttext': FastText}[model_name]
+    max_workers = get_n_workers(max_workers)
+    n_workers = [2 ** i for i in range(max_workers.bit_length())]
+    if n_workers[-1] != max_workers:
+        n_workers.append(max_workers)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sentlines_path = os.path.join(tmp_dir, 'synthetic.sl')
+        write_sentlines(sentlines_path, generate_sentences(n_sentences))
+        for workers in n_workers:
+            model = model_class(size=size, min_count=5, workers=workers,
+                                iter=epochs)
+            results[workers] = train_model(model, sentlines_path,
+                                           training_mode=training_mode)
+            logger.info(f'{model_name} ({training_mode}) with {workers} '
+                        f'workers: {results[workers] / 1e3:.0f}k words/s, '
+                        f'speedup {results[workers] / results[1]:.1f}x')
+    return results
+
+
+def benchmark_similarity_queries(n_words=200000, dim=300,
+                                 batch_sizes=(1, 10, 100, 1000, 10000),
+                                 topn=10, max_gensim_queries=200, seed=0):
+    """Measure 'most_similar' queries per second against gensim.
+
+    Gensim answers one query at a time, so it is timed on at most
+    'max_gensim_queries' queries of each batch.
+
+    Args:
+        n_words (int, optional): Number of random word vectors. Defaults to
+            200000.
+        dim (int, optional): Word vector dimension. Defaults to 300.
+        batch_sizes (tuple, optional): Query batch sizes. Defaults to
+            (1, 10, 100, 1000, 10000).
+        topn (int, optional): Number of results per query. Defaults to 10.
+        max_gensim_queries (int, optional): Maximum number of queries timed
+            with gensim per batch. Defaults to 200.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict: Queries per second of 'gensim' and 'batched' by batch size.
+    """
+    rng = np.random.RandomState(seed)
+    words = [f'w{i}' for i in range(n_words)]
+    vectors = rng.standard_normal((n_words, dim)).astype(np.float32)
+    kv = Word2VecKeyedVectors(dim)
+    kv.add(words, vectors)
+    kv.init_sims()
+    index = SimilarityIndex.from_keyedvectors(kv)
+
+    results = {}
+    for batch_size in batch_sizes:
+        queries = [words[i] for i in rng.randint(n_words, size=batch_size)]
+
+        start_time = time.perf_counter()
+        for word in queries[:max_gensim_queries]:
+            kv.most_similar(word, topn=topn)
+        gensim_qps = (min(batch_size, max_gensim_queries)
+                      / (time.perf_counter() - start_time))
+
+        start_time = time.perf_counter()
+        index.most_similar(queries, topn=topn)
+        batched_qps = batch_size / (time.perf_counter() - start_time)
+
+        results[batch_size] = {'gensim': gensim_qps, 'batched': batched_qps}
+        logger.info(f'most_similar with batch size {batch_size}: gensim '
+                    f'{gensim_qps:.0f} queries/s, batched {batched_qps:.0f} '
+                    f'queries/s, speedup {batched_qps / gensim_qps:.1f}x')
+    return results
+
+
+def metric(value, unit, higher_is_better=True):
+    return {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def benchmark_tokenization(feed_filepath, max_lines=2000):
+    """Measure cost of sentence and word tokenization of crawled pages.
+
+    Args:
+        feed_filepath (str): Filepath of crawled JSON lines.
+        max_lines (int, optional): Maximum number of lines to tokenize.
+            Defaults to 2000.
+
+    Returns:
+        dict: Metrics 'sent_tokenize_chars_per_s' and 'tokenize_tokens_per_s'.
+    """
+    word_tokenizer, sent_tokenizer = get_tokenizers()
+    with open(feed_filepath, 'r', encoding='utf8') as f:
+        docs = [doc for line in itertools.islice(f, max_lines)
+                for doc in json.loads(line)['content']]
+
+    start_time = time.perf_counter()
+    sents = [sent for doc in docs for sent in sent_tokenizer.tokenize(doc)]
+    sent_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    n_tokens = sum(len(word_tokenizer.tokenize(sent)) for sent in sents)
+    token_time = time.perf_counter() - start_time
+    return {
+        'sent_tokenize_chars_per_s': metric(
+            sum(map(len, docs)) / sent_time, 'chars/s'),
+        'tokenize_tokens_per_s': metric(n_tokens / token_time, 'tokens/s')
+    }
+
+
+def benchmark_preprocess(feed_dir, out_filepath, n_jobs=3):
+    """Measure throughput of 'preprocess_all_files'.
+
+    Args:
+        feed_dir (str): Directory of crawled JSON line files.
+        out_filepath (str): Filepath of the output sentence lines.
+        n_jobs (int, optional): Number of worker processes. Defaults to 3.
+
+    Returns:
+        dict: Metrics 'preprocess_seconds', 'preprocess_lines_per_s',
+            'preprocess_sentences_per_s' and 'preprocess_mb_per_s'.
+    """
+    feed_filepaths = glob.glob(os.path.join(feed_dir, '*.jl'))
+    n_lines = sum(map(count_lines, feed_filepaths))
+    n_bytes = sum(map(os.path.getsize, feed_filepaths))
+
+    start_time = time.perf_counter()
+    preprocess_all_files(os.path.join(feed_dir, ''), out_filepath,
+                         variants=(), n_jobs=n_jobs)
+    time_passed = time.perf_counter() - start_time
+    n_sents = count_lines(out_filepath)
+    return {
+        'preprocess_seconds': metric(time_passed, 's', False),
+        'preprocess_lines_per_s': metric(n_lines / time_passed, 'lines/s'),
+        'preprocess_sentences_per_s': metric(n_sents / time_passed,
+                                             'sentences/s'),
+        'preprocess_mb_per_s': metric(n_bytes / 1e6 / time_passed, 'MB/s')
+    }
+
+
+def benchmark_vocab(sentlines_path):
+    """Measure time to count the shared vocabulary of a sentence lines file.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+
+    Returns:
+        dict: Metrics 'vocab_seconds' and 'vocab_tokens_per_s'.
+    """
+    start_time = time.perf_counter()
+    build_vocab(sentlines_path)
+    time_passed = time.perf_counter() - start_time
+    with open(sentlines_path, 'r', encoding='utf8') as f:
+        n_tokens = sum(len(line.split()) for line in f)
+    return {
+        'vocab_seconds': metric(time_passed, 's', False),
+        'vocab_tokens_per_s': metric(n_tokens / time_passed, 'tokens/s')
+    }
+
+
+def benchmark_train_and_export(sentlines_path, out_dir, size=100, epochs=1,
+                               workers=None):
+    """Measure training and export speed of Word2Vec and FastText.
+
+    Export is timed with and without gzip compression, and with the bundle,
+    so that compression time is the difference of the first two.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        out_dir (str): Directory to export word vectors into.
+        size (int, optional): Word embeddings vector dimension. Defaults to
+            100.
+        epochs (int, optional): Number of training epochs. Defaults to 1.
+        workers (int, optional): Number of worker threads. Defaults to None,
+            which means the number of available CPUs.
+
+    Returns:
+        dict: Metrics '<model>_train_words_per_s', '<model>_export_seconds',
+            '<model>_compress_seconds' and '<model>_bundle_seconds'.
+    """
+    results = {}
+    for model_name,model_class in [('word2vec', Word2Vec),
+                                   ('fasttext', FastText)]:
+        model = model_class(size=size, min_count=5, iter=epochs,
+                            workers=get_n_workers(workers))
+        results[f'{model_name}_train_words_per_s'] = metric(
+            train_model(model, sentlines_path), 'words/s')
+
+        timings = {}
+        for name,kwargs in [('raw', {'compress': False, 'save_bundle': False}),
+                            ('gzip', {'save_bundle': False}),
+                            ('bundle', {'compress': False})]:
+            start_time = time.perf_counter()
+            save_word_vectors(sentlines_path, out_dir, model, **kwargs)
+            timings[name] = time.perf_counter() - start_time
+        results[f'{model_name}_export_seconds'] = metric(
+            timings['gzip'], 's', False)
+        results[f'{model_name}_compress_seconds'] = metric(
+            max(timings['gzip'] - timings['raw'], 0), 's', False)
+        results[f'{model_name}_bundle_seconds'] = metric(
+            max(timings['bundle'] - timings['raw'], 0), 's', False)
+    return results
+
+
+BENCHMARK_STAGES = ['token_cleaning', 'tokenize', 'preprocess', 'vocab',
+                    'train', 'scaling', 'queries']
+
+
+def run_benchmarks(stages=BENCHMARK_STAGES, n_items=10000, n_files=2,
+                   n_jobs=3, workers=None, seed=0):
+    """Run benchmark suite on a synthetic corpus.
+
+    Stages 'preprocess', 'vocab' and 'train' run on the output of the
+    previous stage, or on synthetic sentence lines if 'preprocess' is not
+    run. 'train' includes export and compression. 'scaling' trains word2vec
+    on n_items * 20 synthetic sentences with 1, 2, 4, 8... up to 'workers'
+    workers.
+
+    Args:
+        stages (list, optional): Stages from BENCHMARK_STAGES to run.
+            Defaults to all of them.
+        n_items (int, optional): Number of synthetic crawled pages. Defaults
+            to 10000.
+        n_files (int, optional): Number of crawled JSON line files. Defaults
+            to 2.
+        n_jobs (int, optional): Number of preprocessing worker processes.
+            Defaults to 3.
+        workers (int, optional): Number of training worker threads. Defaults
+            to None, which means the number of available CPUs.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict: Results with run parameters in 'meta' and metrics by name in
+            'metrics', each with 'value', 'unit' and 'higher_is_better'.
+
+    Raises:
+        ValueError: If a stage is not supported.
+    """
+    unknown = set(stages) - set(BENCHMARK_STAGES)
+    if unknown:
+        raise ValueError(f'Unknown stages {sorted(unknown)}, should be in '
+                         f'{BENCHMARK_STAGES}!')
+
+    metrics = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        feed_dir = os.path.join(tmp_dir, 'feed')
+        os.makedirs(feed_dir)
+        sentlines_path = os.path.join(tmp_dir, 'processed', 'all.sl')
+        if {'tokenize', 'preprocess'} & set(stages):
+            start_time = time.perf_counter()
+            for i in range(n_files):
+                generate_feed(os.path.join(feed_dir, f'synthetic{i}.jl'),
+                              n_items=n_items // n_files, seed=seed + i)
+            logger.info(f'Generated {n_items} synthetic pages in '
+                        f'{time.perf_counter() - start_time:.0f} seconds')
+
+        if 'token_cleaning' in stages:
+            mismatches = check_token_cleaning()
+            if mismatches:
+                raise AssertionError('Token cleaning differs for '
+                                     f'{mismatches[:10]}')
+            metrics['token_cleaning_tokens_per_s'] = metric(
+                benchmark_token_cleaning()['current'], 'tokens/s')
+        if 'tokenize' in stages:
+            metrics.update(benchmark_tokenization(
+                os.path.join(feed_dir, 'synthetic0.jl')))
+        if 'preprocess' in stages:
+            metrics.update(benchmark_preprocess(feed_dir, sentlines_path,
+                                                n_jobs=n_jobs))
+        elif {'vocab', 'train'} & set(stages):
+            os.makedirs(os.path.dirname(sentlines_path))
+            write_sentlines(sentlines_path,
+                            generate_sentences(n_items * 20, seed=seed))
+        if 'vocab' in stages:
+            metrics.update(benchmark_vocab(sentlines_path))
+        if 'train' in stages:
+            out_dir = os.path.join(tmp_dir, 'embeddings')
+            os.makedirs(out_dir)
+            metrics.update(benchmark_train_and_export(
+                sentlines_path, out_dir, workers=workers))
+        if 'scaling' in stages:
+            scaling = benchmark_training_scaling(n_sentences=n_items * 20,
+                                                 max_workers=workers)
+            for n_workers,words_per_s in scaling.items():
+                metrics[f'scaling_workers{n_workers}_words_per_s'] = metric(
+                    words_per_s, 'words/s')
+        if 'queries' in stages:
+            for batch_size,qps in benchmark_similarity_queries(
+                    n_words=50000, batch_sizes=(1, 100, 10000)).items():
+                metrics[f'queries_batch{batch_size}_per_s'] = metric(
+                    qps['batched'], 'queries/s')
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpus': get_n_workers(),
+            'stages': list(stages),
+            'n_items': n_items,
+            'n_jobs': n_jobs,
+            'workers': workers,
+            'seed': seed
+        },
+        'metrics': metrics
+    }
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """Compare metrics of two benchmark runs.
+
+    Args:
+        baseline (dict): Results of the baseline run.
+        current (dict): Results of the current run.
+        threshold (float, optional): Relative change considered a regression.
+            Defaults to 0.1.
+
+    Returns:
+        list: Regressions as dictionaries with 'metric', 'baseline',
+            'current' and relative 'change', where negative is worse.
+    """
+    regressions = []
+    for name,base in sorted(baseline['metrics'].items()):
+        if name not in current['metrics'] or not base['value']:
+            continue
+        value = current['metrics'][name]['value']
+        change = (value - base['value']) / base['value']
+        if not base['higher_is_better']:
+            change = -change
+        flag = 'REGRESSION' if change < -threshold else ''
+        logger.info(f'{name}: {base["value"]:.4g} -> {value:.4g} '
+                    f'{base["unit"]} ({change:+.1%}) {flag}')
+        if flag:
+            regressions.append({'metric': name, 'baseline': base['value'],
+                                'current': value, 'change': change})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run benchmarks')
+    run_parser.add_argument('--out', default='benchmark.json',
+                            help='Filepath of the results JSON')
+    run_parser.add_argument('--stages', nargs='+', default=BENCHMARK_STAGES,
+                            choices=BENCHMARK_STAGES)
+    run_parser.add_argument('--items', type=int, default=10000,
+                            help='Number of synthetic crawled pages')
+    run_parser.add_argument('--files', type=int, default=2,
+                            help='Number of synthetic feed files')
+    run_parser.add_argument('--jobs', type=int, default=3,
+                            help='Number of preprocessing processes')
+    run_parser.add_argument('--workers', type=int, default=None,
+                            help='Number of training threads')
+    run_parser.add_argument('--seed', type=int, default=0)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two runs and flag regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative change flagged as regression')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        results = run_benchmarks(stages=args.stages, n_items=args.items,
+                                 n_files=args.files, n_jobs=args.jobs,
+                                 workers=args.workers, seed=args.seed)
+        with open(args.out, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f'Saved results into "{args.out}"')
+    elif args.command == 'compare':
+        with open(args.baseline, 'r', encoding='utf8') as f:
+            baseline = json.load(f)
+        with open(args.current, 'r', encoding='utf8') as f:
+            current = json.load(f)
+        regressions = compare_results(baseline, current, args.threshold)
+        if regressions:
+            logger.warning(f'{len(regressions)} regressions found!')
+            sys.exit(1)
+    else:
+        parser.print_help()
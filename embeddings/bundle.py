@@ -0,0 +1,314 @@
+"""Module for memory-mapped word embedding bundles.
+
+A bundle is a directory with the following files:
+
+* *vectors.npy*: float32 matrix of word vectors, one row per word
+* *vocab.npy*: UTF-8 encoded words concatenated one after another
+* *vocab_offsets.npy*: Start offset of each word in *vocab.npy*, plus the end
+* *vocab_sorted.npy*: Word indices in byte order of the words, for lookups
+* *meta.json*: Model name, dimension, number of words and tokens trained on
+
+All arrays are memory-mapped read-only when loading, so loading takes only
+milliseconds and processes loading the same bundle share the same pages.
+"""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import gzip
+import os
+import re
+import time
+import ujson as json
+
+import numpy as np
+
+
+BUNDLE_FILES = {
+    'vectors': 'vectors.npy',
+    'vocab': 'vocab.npy',
+    'vocab_offsets': 'vocab_offsets.npy',
+    'vocab_sorted': 'vocab_sorted.npy',
+    'meta': 'meta.json'
+}
+
+# Files derived from the vectors and cached into the bundle by other modules,
+# removed when the bundle is written again
+BUNDLE_CACHE_FILES = ['vectors_norm.npy']
+
+
+class BundleWriter(object):
+    """Writer of an embedding bundle row by row.
+
+    Args:
+        bundle_dir (str): Directory of the bundle.
+        n_words (int): Number of words in the bundle.
+        dim (int): Word vector dimension.
+        meta (dict, optional): Extra metadata, such as 'model' and 'n_tokens'.
+            Defaults to None.
+    """
+
+    def __init__(self, bundle_dir, n_words, dim, meta=None):
+        if not os.path.exists(bundle_dir):
+            os.makedirs(bundle_dir)
+        self.bundle_dir = bundle_dir
+        
+        # Files of an earlier bundle in the same directory are no longer valid
+        for name in ['meta.json'] + BUNDLE_CACHE_FILES:
+            filepath = os.path.join(bundle_dir, name)
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        self.meta = dict(meta or {}, dim=dim, n_words=n_words)
+        self.vectors = np.lib.format.open_memmap(
+            self.filepath('vectors'), mode='w+', dtype=np.float32,
+            shape=(n_words, dim))
+        self.words = []
+        self.n_written = 0
+
+    def filepath(self, name):
+        return os.path.join(self.bundle_dir, BUNDLE_FILES[name])
+
+    def write(self, words, vectors):
+        """Write rows of words and their vectors.
+
+        Args:
+            words (list): Words as strings or UTF-8 encoded bytes.
+            vectors (numpy.ndarray): Vectors of the words.
+        """
+        self.words.extend(word.encode('utf8') if isinstance(word, str)
+                          else word for word in words)
+        self.vectors[self.n_written:self.n_written + len(words)] = vectors
+        self.n_written += len(words)
+
+    def close(self):
+        """Write the vocabulary and metadata, and close the bundle."""
+        if self.n_written != self.meta['n_words']:
+            raise ValueError(f'Expected {self.meta["n_words"]} words, but '
+                             f'{self.n_written} were written!')
+        self.vectors.flush()
+        del self.vectors
+
+        lengths = np.fromiter(map(len, self.words), dtype=np.int64,
+                              count=len(self.words))
+        offsets = np.zeros(len(self.words) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(self.filepath('vocab'),
+                np.frombuffer(b''.join(self.words), dtype=np.uint8))
+        np.save(self.filepath('vocab_offsets'), offsets)
+        sorted_idx = sorted(range(len(self.words)),
+                            key=self.words.__getitem__)
+        np.save(self.filepath('vocab_sorted'),
+                np.array(sorted_idx, dtype=np.int64))
+
+        # Written last, so that an interrupted bundle is not considered valid
+        with open(self.filepath('meta'), 'w', encoding='utf8') as f:
+            json.dump(self.meta, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+
+
+class EmbeddingBundle(object):
+    """Memory-mapped word embeddings loaded from a bundle directory.
+
+    Args:
+        bundle_dir (str): Directory of the bundle.
+    """
+
+    def __init__(self, bundle_dir):
+        self.bundle_dir = bundle_dir
+        with open(self.filepath('meta'), 'r', encoding='utf8') as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(self.filepath('vectors'), mmap_mode='r')
+        self._vocab = np.load(self.filepath('vocab'), mmap_mode='r')
+        self._offsets = np.load(self.filepath('vocab_offsets'), mmap_mode='r')
+        self._sorted = np.load(self.filepath('vocab_sorted'), mmap_mode='r')
+
+    def filepath(self, name):
+        return os.path.join(self.bundle_dir, BUNDLE_FILES[name])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __contains__(self, word):
+        try:
+            self.index(word)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, word):
+        return self.vectors[self.index(word)]
+
+    def _word_bytes(self, i):
+        return self._vocab[self._offsets[i]:self._offsets[i + 1]].tobytes()
+
+    def word(self, i):
+        """Get word by its index.
+
+        Args:
+            i (int): Index of the word.
+
+        Returns:
+            str: The word.
+        """
+        return self._word_bytes(i).decode('utf8')
+
+    def index(self, word):
+        """Get index of a word with binary search.
+
+        Args:
+            word (str): The word.
+
+        Returns:
+            int: Index of the word.
+
+        Raises:
+            KeyError: If word is not in the vocabulary.
+        """
+        target = word.encode('utf8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word_bytes(self._sorted[mid]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._word_bytes(self._sorted[lo]) == target:
+            return int(self._sorted[lo])
+        raise KeyError(f'Word "{word}" not in vocabulary')
+
+    @property
+    def words(self):
+        """list: All words in index order."""
+        vocab = self._vocab.tobytes()
+        offsets = self._offsets.tolist()
+        return [vocab[offsets[i]:offsets[i + 1]].decode('utf8')
+                for i in range(len(self))]
+
+
+def load_bundle(bundle_dir):
+    """Load memory-mapped word embeddings from a bundle directory.
+
+    Args:
+        bundle_dir (str): Directory of the bundle.
+
+    Returns:
+        EmbeddingBundle: Loaded bundle.
+    """
+    return EmbeddingBundle(bundle_dir)
+
+
+def get_bundle_dir(filepath):
+    """Get bundle directory that corresponds to a word2vec format file.
+
+    Args:
+        filepath (str): Path to a word2vec format file, such as
+            'fasttext.fi.all.1045M.100d.bin.gz'.
+
+    Returns:
+        str: Path like 'fasttext.fi.all.1045M.100d.bundle'.
+    """
+    return re.sub(r'\.(bin|vec)(\.gz|\.zst)?$', '', filepath) + '.bundle'
+
+
+def read_word2vec_format(f, binary=True, rows_per_block=10000):
+    """Read word vectors in word2vec format block by block.
+
+    Args:
+        f (file): Binary file-like object.
+        binary (bool, optional): Whether the file is in binary or text format.
+            Defaults to True.
+        rows_per_block (int, optional): Number of rows in a block. Defaults to
+            10000.
+
+    Yields:
+        tuple: First the header as (number of words, dimension), and then
+            blocks as tuples of list of UTF-8 encoded words and numpy array of
+            their vectors.
+    """
+    n_words, dim = map(int, f.readline().split())
+    yield n_words,dim
+    row_bytes = 4 * dim
+    buf = b''
+    pos = 0
+    n_read = 0
+    while n_read < n_words:
+        n_block = min(rows_per_block, n_words - n_read)
+        if not binary:
+            lines = [f.readline().rstrip(b'\n').split(b' ')
+                     for _ in range(n_block)]
+            yield ([line[0] for line in lines],
+                   np.array([line[1:dim + 1] for line in lines],
+                            dtype=np.float32))
+            n_read += n_block
+            continue
+        words = []
+        vectors = np.empty((n_block, dim), dtype=np.float32)
+        for i in range(n_block):
+            # Make sure buffer has the word and its vector
+            while True:
+                space = buf.find(b' ', pos)
+                if space >= 0 and len(buf) >= space + 1 + row_bytes:
+                    break
+                data = f.read(1 << 20)
+                if not data:
+                    raise EOFError('Unexpected end of word2vec file!')
+                buf = buf[pos:] + data
+                pos = 0
+            words.append(buf[pos:space].lstrip(b'\n'))
+            vectors[i] = np.frombuffer(buf, dtype=np.float32, count=dim,
+                                       offset=space + 1)
+            pos = space + 1 + row_bytes
+        yield words,vectors
+        n_read += n_block
+
+
+def convert_word2vec_to_bundle(filepath, bundle_dir=None, binary=None):
+    """Convert existing word2vec format file into a bundle.
+
+    Args:
+        filepath (str): Path to a word2vec format file, optionally gzipped.
+        bundle_dir (str, optional): Directory of the bundle. Defaults to None,
+            which means 'get_bundle_dir(filepath)'.
+        binary (bool, optional): Whether the file is in binary format. Defaults
+            to None, which means binary unless filename contains '.vec'.
+
+    Returns:
+        str: Directory of the bundle.
+    """
+    start_time = time.perf_counter()
+    if bundle_dir is None:
+        bundle_dir = get_bundle_dir(filepath)
+    if binary is None:
+        binary = '.vec' not in os.path.basename(filepath)
+
+    # Metadata from filenames like 'fasttext.fi.all.1045M.100d.bin.gz'
+    meta = {}
+    match = re.match(r'(\w+)\.fi\..*\.(\d+)M\.\d+d\.',
+                     os.path.basename(filepath))
+    if match:
+        meta['model'] = match.group(1)
+        meta['n_tokens'] = int(match.group(2)) * int(1e6)
+
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rb') as f:
+        blocks = read_word2vec_format(f, binary=binary)
+        n_words, dim = next(blocks)
+        with BundleWriter(bundle_dir, n_words, dim, meta=meta) as writer:
+            for words,vectors in blocks:
+                writer.write(words, vectors)
+    logger.info(f'Converted "{filepath}" into "{bundle_dir}" in '
+                f'{time.perf_counter() - start_time:.0f} seconds!')
+    return bundle_dir
+
+
+if __name__ == '__main__':
+    import sys
+    for path in sys.argv[1:]:
+        convert_word2vec_to_bundle(path)
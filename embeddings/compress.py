@@ -0,0 +1,229 @@
+"""Module for parallel compression of output files."""
+
+
+import collections
+import os
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODEC_EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    'none': ''
+}
+
+
+def gzip_compress_block(data, compresslevel=6):
+    """Compress data into a single gzip member.
+
+    Args:
+        data (bytes): Data to compress.
+        compresslevel (int, optional): Compression level from 1 to 9. Defaults
+            to 6.
+
+    Returns:
+        bytes: Complete gzip member with header and trailer.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class AtomicWriter(object):
+    """Binary file writer that replaces 'filepath' only when it completes.
+
+    Data is written into a temporary file, which replaces 'filepath' only
+    when the writer is closed without an exception, so that an interrupted
+    write never leaves a truncated file that looks valid. Subclasses
+    compress the data with 'write', 'finish' and 'cancel'.
+
+    Args:
+        filepath (str): Path to the output file.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.tmp_filepath = filepath + '.tmp'
+        self.file = open(self.tmp_filepath, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, data):
+        """Write data.
+
+        Args:
+            data (bytes): Data to write.
+        """
+        self.file.write(data)
+
+    def finish(self):
+        """Write remaining data into the temporary file before closing it."""
+
+    def cancel(self):
+        """Drop remaining data before the temporary file is removed."""
+
+    def close(self):
+        """Write remaining data, close the file and move it in place."""
+        if self.file.closed:
+            return
+        try:
+            self.finish()
+            self.file.close()
+        except BaseException:
+            self.discard()
+            raise
+        os.replace(self.tmp_filepath, self.filepath)
+
+    def discard(self):
+        """Drop remaining data and remove the temporary file."""
+        if self.file.closed and not os.path.exists(self.tmp_filepath):
+            return
+        self.cancel()
+        self.file.close()
+        if os.path.exists(self.tmp_filepath):
+            os.remove(self.tmp_filepath)
+
+
+class ParallelGzipWriter(AtomicWriter):
+    """Binary file writer that compresses blocks in parallel threads.
+
+    Each block is compressed into its own gzip member and the members are
+    written in order. A concatenation of gzip members is a standard gzip file,
+    which can be read with 'gzip.open' and gensim as a whole. zlib releases
+    the GIL while compressing, so the blocks are compressed in parallel.
+
+    Args:
+        filepath (str): Path to the output file.
+        n_threads (int, optional): Number of compression threads. Defaults to
+            None, which means the number of CPUs.
+        block_size (int, optional): Size of an uncompressed block in bytes.
+            Defaults to 16 MiB.
+        compresslevel (int, optional): Compression level from 1 to 9. Defaults
+            to 6.
+    """
+
+    def __init__(self, filepath, n_threads=None, block_size=1 << 24,
+                 compresslevel=6):
+        super().__init__(filepath)
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    def _submit(self, data):
+        self.pending.append(self.executor.submit(
+            gzip_compress_block, data, self.compresslevel))
+        while len(self.pending) > 2 * self.n_threads:
+            self.file.write(self.pending.popleft().result())
+
+    def write(self, data):
+        """Write uncompressed data.
+
+        Args:
+            data (bytes): Data to write.
+        """
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+    def finish(self):
+        """Compress remaining data and write it in order."""
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+    def cancel(self):
+        """Cancel compression of remaining blocks."""
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.buffer = bytearray()
+        self.executor.shutdown()
+
+
+class ZstdWriter(AtomicWriter):
+    """Binary file writer that compresses with multi-threaded zstd.
+
+    Args:
+        filepath (str): Path to the output file.
+        n_threads (int, optional): Number of compression threads. Defaults to
+            None, which means the number of CPUs.
+
+    Raises:
+        ImportError: If 'zstandard' is not installed.
+    """
+
+    def __init__(self, filepath, n_threads=None):
+        if zstandard is None:
+            raise ImportError('Package "zstandard" is required for "zstd" '
+                              'codec!')
+        super().__init__(filepath)
+        compressor = zstandard.ZstdCompressor(
+            threads=n_threads or os.cpu_count() or 1)
+        self.stream = compressor.stream_writer(self.file)
+
+    def write(self, data):
+        """Write uncompressed data.
+
+        Args:
+            data (bytes): Data to write.
+        """
+        self.stream.write(data)
+
+    def finish(self):
+        """Compress remaining data and end the zstd frame."""
+        self.stream.flush(zstandard.FLUSH_FRAME)
+
+
+def open_compressed(filepath, codec='gzip', n_threads=None, compresslevel=6):
+    """Open binary file writer that compresses with a given codec.
+
+    Args:
+        filepath (str): Path to the output file, without codec extension.
+        codec (str, optional): One of 'gzip', 'zstd' or 'none'. 'zstd' needs
+            the optional 'zstandard' package. Defaults to 'gzip'.
+        n_threads (int, optional): Number of compression threads. Defaults to
+            None, which means the number of CPUs.
+        compresslevel (int, optional): Compression level of gzip. Defaults to
+            6.
+
+    Returns:
+        tuple: Two-element tuple with an AtomicWriter, which writes into a
+            temporary file until it is closed without an exception, and path
+            to the file with codec extension.
+
+    Raises:
+        ValueError: If codec is not supported.
+        ImportError: If 'zstandard' is not installed for 'zstd' codec.
+    """
+    if codec not in CODEC_EXTENSIONS:
+        raise ValueError(f'Unknown codec "{codec}", should be in '
+                         f'{list(CODEC_EXTENSIONS)}!')
+    out_filepath = filepath + CODEC_EXTENSIONS[codec]
+    if codec == 'gzip':
+        writer = ParallelGzipWriter(out_filepath, n_threads=n_threads,
+                                    compresslevel=compresslevel)
+    elif codec == 'zstd':
+        writer = ZstdWriter(out_filepath, n_threads=n_threads)
+    else:
+        writer = AtomicWriter(out_filepath)
+    return writer,out_filepath
@@ -0,0 +1,334 @@
+"""Module for pre-tokenized sentence line corpora."""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import collections
+import itertools
+import os
+import time
+import ujson as json
+
+import numpy as np
+
+
+def get_corpus_filepaths(sentlines_path):
+    """Get filepaths of the token corpus of a sentence lines file.
+
+    The corpus is stored in a directory next to the sentence lines file, so
+    that for './data/processed/all.sl' it is './data/processed/all.corpus/'.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+
+    Returns:
+        dict: Filepaths of the corpus 'dir', 'vocab', 'vocab_meta', 'ids',
+            'offsets' and 'meta'.
+    """
+    corpus_dir = os.path.splitext(sentlines_path)[0] + '.corpus'
+    return {
+        'dir': corpus_dir,
+        'vocab': os.path.join(corpus_dir, 'vocab.tsv'),
+        'vocab_meta': os.path.join(corpus_dir, 'vocab.json'),
+        'ids': os.path.join(corpus_dir, 'ids.npy'),
+        'offsets': os.path.join(corpus_dir, 'offsets.npy'),
+        'meta': os.path.join(corpus_dir, 'meta.json')
+    }
+
+
+def read_line_chunks(sentlines_path, lines_per_chunk=100000):
+    """Read sentence lines file in chunks of lines.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        lines_per_chunk (int, optional): Number of lines in a chunk. Defaults
+            to 100000.
+
+    Yields:
+        list: Lines of the chunk.
+    """
+    with open(sentlines_path, 'r', encoding='utf8') as f:
+        while True:
+            lines = list(itertools.islice(f, lines_per_chunk))
+            if not lines:
+                return
+            yield lines
+
+
+def count_tokens(sentlines_path, lines_per_chunk=100000):
+    """Count tokens and sentences of a sentence lines file.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        lines_per_chunk (int, optional): Number of lines read at once. Defaults
+            to 100000.
+
+    Returns:
+        tuple: Two-element tuple with token counts as collections.Counter and
+            number of sentences.
+    """
+    counts = collections.Counter()
+    n_sents = 0
+    for lines in read_line_chunks(sentlines_path, lines_per_chunk):
+        counts.update(' '.join(lines).split())
+        n_sents += len(lines)
+    return counts,n_sents
+
+
+def save_vocab(filepath, counts):
+    """Save vocabulary as tab separated 'token count' -lines.
+
+    Args:
+        filepath (str): Filepath of the vocabulary.
+        counts (collections.Counter): Token counts.
+    """
+    with open(filepath, 'w', encoding='utf8') as f:
+        for token,count in counts.most_common():
+            f.write(f'{token}\t{count}\n')
+
+
+def load_vocab(filepath):
+    """Load vocabulary saved with 'save_vocab'.
+
+    Args:
+        filepath (str): Filepath of the vocabulary.
+
+    Returns:
+        tuple: Two-element tuple with list of tokens and numpy array of their
+            counts, in descending order of counts.
+    """
+    words = []
+    counts = []
+    with open(filepath, 'r', encoding='utf8') as f:
+        for line in f:
+            word, count = line.rstrip('\n').split('\t')
+            words.append(word)
+            counts.append(int(count))
+    return words,np.array(counts, dtype=np.int64)
+
+
+class TokenCorpus(object):
+    """Iterable over sentences of a memory-mapped token ID corpus.
+
+    Sentences are given as lists of tokens, which can be used directly as
+    'sentences' for gensim models without re-reading and splitting text.
+
+    Args:
+        words (list): Tokens of the vocabulary by token ID.
+        ids (numpy.ndarray): Token IDs of all sentences one after another.
+        offsets (numpy.ndarray): Start index of each sentence in 'ids', plus
+            the total number of tokens as last element.
+        sents_per_block (int, optional): Number of sentences converted into
+            tokens at once. Defaults to 10000.
+    """
+
+    def __init__(self, words, ids, offsets, sents_per_block=10000):
+        self.words = np.array(words, dtype=object)
+        self.ids = ids
+        self.offsets = offsets
+        self.sents_per_block = sents_per_block
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for start in range(0, len(self), self.sents_per_block):
+            end = min(start + self.sents_per_block, len(self))
+            offsets = self.offsets[start:end + 1]
+            tokens = self.words[self.ids[offsets[0]:offsets[-1]]].tolist()
+            offsets = (offsets - offsets[0]).tolist()
+            for i in range(len(offsets) - 1):
+                yield tokens[offsets[i]:offsets[i + 1]]
+
+    @classmethod
+    def load(cls, sentlines_path):
+        """Load memory-mapped corpus of a sentence lines file.
+
+        Args:
+            sentlines_path (str): Filepath of sentence lines file.
+
+        Returns:
+            TokenCorpus: Loaded corpus.
+        """
+        filepaths = get_corpus_filepaths(sentlines_path)
+        words, _ = load_vocab(filepaths['vocab'])
+        ids = np.load(filepaths['ids'], mmap_mode='r')
+        offsets = np.load(filepaths['offsets'], mmap_mode='r')
+        return cls(words, ids, offsets)
+
+
+def get_source_stats(sentlines_path):
+    """Get size and modification time of a sentence lines file.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+
+    Returns:
+        dict: Dictionary with 'size' and 'mtime_ns' of the file.
+    """
+    stat = os.stat(sentlines_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def load_meta(sentlines_path, name='meta'):
+    """Load metadata of the vocabulary or corpus of a sentence lines file.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        name (str, optional): 'vocab_meta' for vocabulary or 'meta' for token
+            corpus. Defaults to 'meta'.
+
+    Returns:
+        dict: Metadata with keys 'n_sentences', 'n_tokens' and 'source', or
+            None if it doesn't exist or is outdated compared to the sentence
+            lines file.
+    """
+    filepath = get_corpus_filepaths(sentlines_path)[name]
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, 'r', encoding='utf8') as f:
+        meta = json.load(f)
+    if meta['source'] != get_source_stats(sentlines_path):
+        return None
+    return meta
+
+
+def save_meta(sentlines_path, meta, name='meta'):
+    """Save metadata of the vocabulary or corpus of a sentence lines file.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        meta (dict): Metadata to save.
+        name (str, optional): 'vocab_meta' for vocabulary or 'meta' for token
+            corpus. Defaults to 'meta'.
+    """
+    with open(get_corpus_filepaths(sentlines_path)[name], 'w',
+              encoding='utf8') as f:
+        json.dump(meta, f, indent=2)
+
+
+def build_vocab(sentlines_path, lines_per_chunk=100000):
+    """Count and save vocabulary of a sentence lines file.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        lines_per_chunk (int, optional): Number of lines read at once. Defaults
+            to 100000.
+    """
+    start_time = time.perf_counter()
+    filepaths = get_corpus_filepaths(sentlines_path)
+    if not os.path.exists(filepaths['dir']):
+        os.makedirs(filepaths['dir'])
+    source_stats = get_source_stats(sentlines_path)
+
+    logger.info(f'Counting tokens of "{sentlines_path}"...')
+    counts, n_sents = count_tokens(sentlines_path, lines_per_chunk)
+    save_vocab(filepaths['vocab'], counts)
+
+    # Written last, so that an interrupted build is not considered complete
+    save_meta(sentlines_path, {
+        'n_sentences': n_sents,
+        'n_tokens': sum(counts.values()),
+        'source': source_stats
+    }, name='vocab_meta')
+    logger.info(f'Vocabulary of {len(counts)} tokens counted in '
+                f'{time.perf_counter() - start_time:.0f} seconds!')
+
+
+def get_vocab(sentlines_path, lines_per_chunk=100000):
+    """Load vocabulary of a sentence lines file, counting it if needed.
+
+    The vocabulary is counted only once per sentence lines file and shared by
+    the token corpus and all models trained on the file.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        lines_per_chunk (int, optional): Number of lines read at once when
+            counting the vocabulary. Defaults to 100000.
+
+    Returns:
+        tuple: Three-element tuple with list of tokens, numpy array of their
+            counts in descending order, and metadata with 'n_sentences' and
+            'n_tokens'.
+    """
+    meta = load_meta(sentlines_path, name='vocab_meta')
+    if meta is None:
+        build_vocab(sentlines_path, lines_per_chunk)
+        meta = load_meta(sentlines_path, name='vocab_meta')
+    words, counts = load_vocab(get_corpus_filepaths(sentlines_path)['vocab'])
+    return words,counts,meta
+
+
+def build_token_corpus(sentlines_path, lines_per_chunk=100000):
+    """Build memory-mapped token ID corpus of a sentence lines file.
+
+    Creates a vocabulary with token counts, uint32 token ID array of all
+    sentences and int64 array of sentence start offsets. Token IDs are in
+    descending order of token counts.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        lines_per_chunk (int, optional): Number of lines read at once. Defaults
+            to 100000.
+    """
+    start_time = time.perf_counter()
+    filepaths = get_corpus_filepaths(sentlines_path)
+    source_stats = get_source_stats(sentlines_path)
+
+    # Vocabulary
+    words, _, vocab_meta = get_vocab(sentlines_path, lines_per_chunk)
+    n_sents = vocab_meta['n_sentences']
+    n_tokens = vocab_meta['n_tokens']
+    word2id = {word: i for i,word in enumerate(words)}
+    del words
+
+    # Token IDs and sentence offsets
+    logger.info(f'Writing {n_tokens} token IDs of {n_sents} sentences...')
+    ids = np.lib.format.open_memmap(filepaths['ids'], mode='w+',
+                                    dtype=np.uint32, shape=(n_tokens,))
+    offsets = np.lib.format.open_memmap(filepaths['offsets'], mode='w+',
+                                        dtype=np.int64, shape=(n_sents + 1,))
+    offsets[0] = 0
+    n_done_tokens = 0
+    n_done_sents = 0
+    for lines in read_line_chunks(sentlines_path, lines_per_chunk):
+        sents = [line.split() for line in lines]
+        lengths = np.fromiter(map(len, sents), dtype=np.int64,
+                              count=len(sents))
+        n_chunk_tokens = int(lengths.sum())
+        ids[n_done_tokens:n_done_tokens + n_chunk_tokens] = np.fromiter(
+            map(word2id.__getitem__, itertools.chain.from_iterable(sents)),
+            dtype=np.uint32, count=n_chunk_tokens)
+        offsets[n_done_sents + 1:n_done_sents + 1 + len(sents)] = (
+            n_done_tokens + np.cumsum(lengths))
+        n_done_tokens += n_chunk_tokens
+        n_done_sents += len(sents)
+    ids.flush()
+    offsets.flush()
+    del ids, offsets
+
+    # Written last, so that an interrupted build is not considered complete
+    save_meta(sentlines_path, {
+        'n_sentences': n_sents,
+        'n_tokens': n_tokens,
+        'source': source_stats
+    })
+    logger.info(f'Token corpus "{filepaths["dir"]}" built in '
+                f'{time.perf_counter() - start_time:.0f} seconds!')
+
+
+def get_token_corpus(sentlines_path, lines_per_chunk=100000):
+    """Load token corpus of a sentence lines file, building it if needed.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file.
+        lines_per_chunk (int, optional): Number of lines read at once when
+            building the corpus. Defaults to 100000.
+
+    Returns:
+        TokenCorpus: Corpus of the sentence lines file.
+    """
+    if load_meta(sentlines_path) is None:
+        build_token_corpus(sentlines_path, lines_per_chunk)
+    return TokenCorpus.load(sentlines_path)
@@ -0,0 +1,136 @@
+"""Load test of the local word vector service in 'serve.py'.
+
+Sends concurrent requests over keep-alive connections, and reports
+throughput, latency percentiles and the statistics of the service.
+
+Example:
+    python loadtest.py --words koira kissa koiranpentu --requests 10000
+"""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import argparse
+import asyncio
+import random
+import time
+import ujson as json
+
+from urllib.parse import urlencode
+
+import numpy as np
+
+
+async def request(reader, writer, path, params=None):
+    """Send GET request over a keep-alive connection and read the response.
+
+    Args:
+        reader (asyncio.StreamReader): Reader of the connection.
+        writer (asyncio.StreamWriter): Writer of the connection.
+        path (str): Path of the request.
+        params (dict, optional): Query parameters. Defaults to None.
+
+    Returns:
+        tuple: Two-element tuple with HTTP status code and parsed JSON body.
+    """
+    target = path + ('?' + urlencode(params) if params else '')
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                 .encode('utf8'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    return status,json.loads(await reader.readexactly(length))
+
+
+async def run_client(host, port, path, words, n_requests, latencies,
+                     statuses, rng):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(n_requests):
+            start_time = time.perf_counter()
+            status, _ = await request(reader, writer, path,
+                                      {'word': rng.choice(words)})
+            latencies.append(time.perf_counter() - start_time)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def load_test(words, host='127.0.0.1', port=8000, path='/vector',
+                    n_requests=10000, concurrency=64, seed=0):
+    """Drive the service with concurrent clients.
+
+    Args:
+        words (list): Words to request, chosen randomly.
+        host (str, optional): Host of the service. Defaults to '127.0.0.1'.
+        port (int, optional): Port of the service. Defaults to 8000.
+        path (str, optional): Either '/vector' or '/most_similar'. Defaults
+            to '/vector'.
+        n_requests (int, optional): Total number of requests. Defaults to
+            10000.
+        concurrency (int, optional): Number of concurrent connections.
+            Defaults to 64.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict: Report with 'requests_per_s', latency percentiles, counts of
+            HTTP status codes and the statistics of the service.
+    """
+    rng = random.Random(seed)
+    latencies = []
+    statuses = {}
+    per_client = [n_requests // concurrency
+                  + (i < n_requests % concurrency)
+                  for i in range(concurrency)]
+    start_time = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(host, port, path, words, n, latencies, statuses, rng)
+        for n in per_client if n])
+    time_passed = time.perf_counter() - start_time
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, service_stats = await request(reader, writer, '/stats')
+    writer.close()
+
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+    report = {
+        'path': path,
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'requests_per_s': len(latencies) / time_passed,
+        'p50_ms': p50,
+        'p90_ms': p90,
+        'p99_ms': p99,
+        'statuses': statuses,
+        'service': service_stats
+    }
+    logger.info(f'{path}: {report["requests_per_s"]:.0f} requests/s, '
+                f'p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms, '
+                f'cache hit rate {service_stats["cache"]["hit_rate"]:.2f}')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--path', default='/vector',
+                        choices=['/vector', '/most_similar'])
+    parser.add_argument('--words', nargs='+', required=True,
+                        help='Words to request, chosen randomly')
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    report = asyncio.run(load_test(
+        args.words, host=args.host, port=args.port, path=args.path,
+        n_requests=args.requests, concurrency=args.concurrency))
+    print(json.dumps(report, indent=2))
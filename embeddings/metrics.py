@@ -0,0 +1,194 @@
+"""Module for structured metrics and profiling of pipeline stages.
+
+Each stage is recorded as one JSON line event in the metrics file, with wall
+time, CPU time, peak resident memory, items in and out, and throughput:
+
+    with Stage('vocab', items_in=n_sents) as stage:
+        ...
+        stage.items_out = n_words
+
+Metrics are written into 'metrics.jl' by default. Stages can be profiled
+with cProfile and tracemalloc by name, which writes the profiles into the
+profile directory. Defaults are read from the environment, so that profiles
+can be taken from production runs without code changes:
+
+* *METRICS_FILE*: Filepath of the metrics, or empty to disable
+* *PROFILE_STAGE*: Name of the stage to profile, or a pattern like
+  'preprocess_*'
+* *PROFILE_DIR*: Directory of the profiles, defaults to './profiles'
+* *PROFILE_MEMORY*: Set to '1' to profile memory with tracemalloc as well
+"""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import cProfile
+import collections
+import fnmatch
+import os
+import threading
+import time
+import tracemalloc
+import ujson as json
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_config = {
+    'filepath': os.environ.get('METRICS_FILE', 'metrics.jl') or None,
+    'profile_stage': os.environ.get('PROFILE_STAGE') or None,
+    'profile_dir': os.environ.get('PROFILE_DIR', './profiles'),
+    'profile_memory': os.environ.get('PROFILE_MEMORY') == '1'
+}
+_lock = threading.Lock()
+_profile_counts = collections.Counter()
+_active_profiler = []
+
+
+def configure(filepath='metrics.jl', profile_stage=None,
+              profile_dir='./profiles', profile_memory=False):
+    """Configure metrics and profiling.
+
+    Args:
+        filepath (str, optional): Filepath of the JSON line metrics, or None
+            to disable them. Defaults to 'metrics.jl'.
+        profile_stage (str, optional): Name or pattern of stages to profile
+            with cProfile. Defaults to None, which means no profiling.
+        profile_dir (str, optional): Directory of the profiles. Defaults to
+            './profiles'.
+        profile_memory (bool, optional): Whether to profile memory
+            allocations of the profiled stages with tracemalloc. Defaults to
+            False.
+    """
+    _config.update(filepath=filepath, profile_stage=profile_stage,
+                   profile_dir=profile_dir, profile_memory=profile_memory)
+
+
+def get_peak_rss_mb():
+    """Get peak resident memory of this process in MB.
+
+    Returns:
+        float: Peak resident memory, or None if 'resource' module is not
+            available, such as on Windows.
+    """
+    if resource is None:
+        return None
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def emit(stage, **fields):
+    """Write a stage event into the metrics file.
+
+    Args:
+        stage (str): Name of the stage.
+        **fields: Fields of the event, such as 'wall_s', 'items_in' and
+            'items_out'. Throughput 'items_per_s' is calculated from items
+            out, or items in if there are no items out.
+
+    Returns:
+        dict: The event.
+    """
+    event = {'time': time.time(), 'stage': stage, 'pid': os.getpid()}
+    event.update(fields)
+    items = event.get('items_out')
+    if items is None:
+        items = event.get('items_in')
+    if items is not None and event.get('wall_s'):
+        event['items_per_s'] = items / event['wall_s']
+    if _config['filepath'] is not None:
+        line = json.dumps(event) + '\n'
+        with _lock:
+            with open(_config['filepath'], 'a', encoding='utf8') as f:
+                f.write(line)
+    return event
+
+
+class Stage(object):
+    """Context manager that records a stage as a metrics event.
+
+    Args:
+        name (str): Name of the stage, such as 'train'.
+        items_in (int, optional): Number of items in. Defaults to None.
+        items_out (int, optional): Number of items out, can also be set
+            within the stage. Defaults to None.
+        write (bool, optional): Whether to write the event into the metrics
+            file. Set to False to only measure, for example in worker
+            processes that return their measurements. Defaults to True.
+        **fields: Extra fields of the event, such as 'file' or 'model'.
+    """
+
+    def __init__(self, name, items_in=None, items_out=None, write=True,
+                 **fields):
+        self.name = name
+        self.items_in = items_in
+        self.items_out = items_out
+        self.write = write
+        self.fields = fields
+        self.event = None
+        self.profiler = None
+
+    @property
+    def profiled(self):
+        pattern = _config['profile_stage']
+        return pattern is not None and fnmatch.fnmatch(self.name, pattern)
+
+    def __enter__(self):
+        # Only the outermost matching stage is profiled, as profilers can't
+        # be nested
+        if self.profiled and not _active_profiler:
+            self.profiler = cProfile.Profile()
+            _active_profiler.append(self.profiler)
+            if _config['profile_memory'] and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.profiler.enable()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        fields = dict(self.fields, wall_s=wall, cpu_s=cpu,
+                      peak_rss_mb=get_peak_rss_mb(), items_in=self.items_in,
+                      items_out=self.items_out)
+        if exc_type is not None:
+            fields['error'] = exc_type.__name__
+        if self.profiler is not None:
+            self.profiler.disable()
+            _active_profiler.remove(self.profiler)
+            fields['profile'] = self.dump_profile()
+        if self.write:
+            self.event = emit(self.name, **fields)
+        else:
+            self.event = dict(fields, stage=self.name)
+
+    def dump_profile(self):
+        """Write profiles of the stage into the profile directory.
+
+        Returns:
+            str: Filepath of the cProfile stats, which can be read with
+                'pstats' or 'snakeviz'.
+        """
+        profile_dir = _config['profile_dir']
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        with _lock:
+            _profile_counts[self.name] += 1
+            n = _profile_counts[self.name]
+        base = os.path.join(profile_dir, f'{self.name}.{os.getpid()}.{n}')
+        self.profiler.dump_stats(base + '.prof')
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(base + '.tracemalloc.txt', 'w', encoding='utf8') as f:
+                f.write(f'Peak traced memory: {peak / 1e6:.1f} MB\n')
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write(f'{stat}\n')
+        logger.info(f'Saved profile of stage "{self.name}" into "{base}.*"')
+        return base + '.prof'
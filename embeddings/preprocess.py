@@ -4,41 +4,352 @@
 from utils import get_logger
 logger = get_logger()
 
-import gc
 import glob
+import gzip
+import hashlib
+import collections
+import multiprocessing
 import os
+import random
 import re
+import threading
 import time
 import string
 import ujson as json
 
-from itertools import zip_longest
-
 import nltk
 import numpy as np
-import pandas as pd
 
-from joblib import Parallel, delayed
 from nltk.tokenize import TweetTokenizer
 
+from metrics import Stage, emit
+
 
 PUNCT_CHARS = string.punctuation + '´”…'
+PUNCT_SET = frozenset(PUNCT_CHARS)
+FILTER_RE = re.compile(r'[^\w\s]')
+URL_RE = re.compile(r'\w+:\/\/\S*')
+TOKENIZERS = ['tweet']
+
+# Normalized variants of the sentences, produced by the workers in the same
+# pass and written next to the output, like 'all.uncased.sl' for 'all.sl'
+SENTENCE_VARIANTS = {
+    'uncased': str.lower
+}
+
+# Tokens with known edge cases for token cleaning
+TOKEN_CORPUS = [
+    'koira', 'Koira', 'KOIRA', 'päivää', 'Åland', 'öljy', '2019', '12,5',
+    '12:30', '1.5.2019', 'e.g.', "don't", 'linja-auto', 'linja--auto',
+    'snake_case', '__init__', '_', '#hashtag', '@käyttäjä', '<URL>', 'a', 'ab',
+    'abc.', 'abcd.', 'abcde.', 'abc..', '!', '!!!', '...', '…', '´', '”',
+    '"', '(', ')', ':)', ':-)', ';)', '<3', '😀', '😀😀', '😀!', 'a😀',
+    'ab😀', '👍🏻', '👨\u200d👩\u200d👧', '€', '5€', '100€', '°C', '20°C',
+    '²', 'm²', '½', '٣', 'é', 'e\u0301', 'cafe\u0301', '\u00ad',
+    'soft\u00adhyphen', '漢字', 'テスト', 'Ωmega', '→', 'a→b', '•', '§',
+    '§12', '★★★', '★', '©', '©2019', '™', 'x™', '\u200b', 'abc\u200b',
+    '\t', 'a b', '–', '—', '-', '--', '+358', '+', '%', '50%', '5%',
+]
+
+# Worker process state set by 'init_worker'
+_worker_state = {}
+
+
+def hash_sentences(sents):
+    """Calculate stable 64-bit hashes for sentences.
+
+    Args:
+        sents (iterable): Sentences as strings.
+
+    Returns:
+        numpy.ndarray: Array of sentence hashes with dtype uint64.
+    """
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(sent.encode('utf8'),
+                                        digest_size=8).digest(), 'little')
+         for sent in sents),
+        dtype=np.uint64
+    )
+
+
+class SentenceHashIndex(object):
+    """Corpus-wide index of seen sentences for deduplication.
+
+    Sentences are stored as 64-bit hashes in sorted runs, which takes 8 bytes
+    per unique sentence regardless of sentence length. New hashes of each
+    batch form a new run, and the newest two runs are merged whenever the
+    older one is at most twice the size of the newer one. There are thus at
+    most about log2(N) runs, and each hash is merged only about log2(N)
+    times, instead of copying the whole index for each batch.
+
+    Runs are saved as separate '.npy' files into a folder, so that only the
+    runs created or merged since the previous save are written. Files of
+    merged runs are kept until 'remove_unused' is called, so that a list of
+    runs recorded elsewhere, such as in the manifest of preprocessing, stays
+    loadable until it is replaced.
+
+    Args:
+        runs (list, optional): Sorted arrays of unique uint64 hashes, in the
+            order they were created, to initialize the index with. Defaults
+            to None.
+    """
+
+    def __init__(self, runs=None):
+        # Sorted hashes of each run, and the file it is saved in or None
+        self.runs = list(runs or [])
+        self.run_names = [None] * len(self.runs)
+        self.next_run_id = 0
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    @classmethod
+    def load(cls, dirpath, run_names=None):
+        """Load index from a folder, or create an empty one if not found.
+
+        Args:
+            dirpath (str): Path to folder saved with 'save'.
+            run_names (list, optional): Names of the runs to load, as
+                returned by 'save'. Defaults to None, which means the runs of
+                the latest 'save'.
+
+        Returns:
+            SentenceHashIndex: Loaded index.
+        """
+        runs_filepath = os.path.join(dirpath, 'runs.json')
+        if run_names is None and os.path.exists(runs_filepath):
+            with open(runs_filepath, 'r', encoding='utf8') as f:
+                run_names = json.load(f)['runs']
+        if run_names is None:
+            return cls()
+        index = cls([np.load(os.path.join(dirpath, name))
+                     for name in run_names])
+        index.run_names = list(run_names)
+        
+        # Files of runs saved after 'run_names' are never reused
+        run_ids = [int(os.path.basename(path).split('.')[0])
+                   for path in glob.glob(os.path.join(dirpath, '*.npy'))]
+        index.next_run_id = max(run_ids, default=-1) + 1
+        return index
+
+    def save(self, dirpath):
+        """Save runs that are not saved yet into a folder.
+
+        The list of runs is replaced atomically after the new runs have been
+        written.
+
+        Args:
+            dirpath (str): Path to folder.
+        
+        Returns:
+            list: Names of the runs of the index.
+        """
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        for i,run in enumerate(self.runs):
+            if self.run_names[i] is not None:
+                continue
+            name = f'{self.next_run_id:08d}.npy'
+            self.next_run_id += 1
+            tmp_filepath = os.path.join(dirpath, name + '.tmp.npy')
+            np.save(tmp_filepath, run)
+            os.replace(tmp_filepath, os.path.join(dirpath, name))
+            self.run_names[i] = name
+
+        runs_filepath = os.path.join(dirpath, 'runs.json')
+        tmp_filepath = runs_filepath + '.tmp'
+        with open(tmp_filepath, 'w', encoding='utf8') as f:
+            json.dump({'runs': self.run_names}, f)
+        os.replace(tmp_filepath, runs_filepath)
+        return list(self.run_names)
+
+    def remove_unused(self, dirpath):
+        """Remove files of runs that are no longer in the index.
+
+        Args:
+            dirpath (str): Path to folder given to 'save'.
+        """
+        names = set(self.run_names)
+        for path in glob.glob(os.path.join(dirpath, '*.npy')):
+            if os.path.basename(path) not in names:
+                os.remove(path)
+
+    def contains(self, hashes):
+        """Check which of sorted unique hashes are in the index.
+
+        Args:
+            hashes (numpy.ndarray): Sorted array of unique uint64 hashes.
+
+        Returns:
+            numpy.ndarray: Boolean mask of hashes found from the index.
+        """
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            pos = np.searchsorted(run, hashes)
+            in_range = pos < len(run)
+            found[in_range] |= run[pos[in_range]] == hashes[in_range]
+        return found
+
+    def add_run(self, hashes):
+        """Add new hashes as a run, and merge runs of similar size.
+
+        Args:
+            hashes (numpy.ndarray): Sorted array of unique uint64 hashes not
+                in the index yet.
+        """
+        if len(hashes) == 0:
+            return
+        self.runs.append(hashes)
+        self.run_names.append(None)
+        while (len(self.runs) > 1
+               and len(self.runs[-2]) <= 2 * len(self.runs[-1])):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            self.run_names[-2:] = []
+            # Stable sort merges the two sorted runs in linear time
+            merged = np.sort(np.concatenate([older, newer]), kind='stable')
+            self.runs.append(merged)
+            self.run_names.append(None)
+
+    def add(self, sents):
+        """Add sentences into the index.
+
+        Args:
+            sents (list): Sentences as strings.
 
+        Returns:
+            numpy.ndarray: Boolean mask of sentences that were not seen before,
+                either in the index or earlier in 'sents'.
+        """
+        is_new = np.zeros(len(sents), dtype=bool)
+        if len(sents) == 0:
+            return is_new
+        hashes = hash_sentences(sents)
+        
+        # First occurrence of each hash within the batch
+        uniq, first_idx = np.unique(hashes, return_index=True)
+        
+        # Hashes not yet in the index
+        found = self.contains(uniq)
+        
+        is_new[first_idx[~found]] = True
+        self.add_run(uniq[~found])
+        return is_new
+
+    def filter(self, sents):
+        """Add sentences into the index and return only the unseen ones.
+
+        Args:
+            sents (list): Sentences as strings.
+
+        Returns:
+            list: Sentences that were not seen before, in original order.
+        """
+        is_new = self.add(sents)
+        return [sent for sent, new in zip(sents, is_new) if new]
+
+
+class OtherCharTable(dict):
+    """Translation table that removes all but 'FILTER_RE' characters.
+    
+    Each character is classified with 'FILTER_RE' only once, when it is first
+    seen, after which 'str.translate' looks it up from the table.
+    """
 
-def grouper(iterable, n, fillvalue=None):
-    """Return iterable in chunks of certain length.
+    def __missing__(self, key):
+        value = key if FILTER_RE.match(chr(key)) else None
+        self[key] = value
+        return value
+
+
+OTHER_CHAR_TABLE = OtherCharTable()
+
+
+def is_valid_token(token):
+    """Check whether a token should be kept in a sentence.
+    
+    Token is kept if more than 75% of its characters are normal word or
+    whitespace characters, or if it has exactly one other character, which is
+    not punctuation, such as an emoji.
     
     Args:
-        iterable (iterable): Iterable to return chunks from.
-        n (int): Length of a chunk.
-        fillvalue (any, optional): Value to fill when iterable has been consumed
-            entirely. Defaults to None.
+        token (str): Token to check.
     
     Returns:
-        iterable: Iterable of length n.
+        bool: True if token should be kept, False otherwise.
+    """
+    if token.isalnum():
+        return True
+    other_chars = token.translate(OTHER_CHAR_TABLE)
+    n_normal_chars = len(token) - len(other_chars)
+    if n_normal_chars > 0 and n_normal_chars / len(token) > 0.75:
+        return True
+    return len(other_chars) == 1 and other_chars not in PUNCT_SET
+
+
+def reference_is_valid_token(token):
+    """Reference regex implementation of 'is_valid_token'.
+
+    Args:
+        token (str): Token to check.
+
+    Returns:
+        bool: True if token should be kept, False otherwise.
+    """
+    # Normal tokens
+    normal_chars = FILTER_RE.sub('', token)
+    n_token = len(token)
+    n_normal_chars = len(normal_chars)
+    pct_normal_chars = n_normal_chars / n_token
+    if n_normal_chars > 0 and pct_normal_chars > 0.75:
+        return True
+
+    # Emojis
+    other_chars = FILTER_RE.findall(token)
+    only_one_other = len(other_chars) == 1
+    others_in_punct = any([c in PUNCT_CHARS for c in other_chars])
+    return only_one_other and not others_in_punct
+
+
+def generate_tokens(n_tokens=100000, seed=0):
+    """Generate random tokens that mix words, punctuation and symbols.
+
+    Args:
+        n_tokens (int, optional): Number of tokens. Defaults to 100000.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: List of tokens.
     """
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
+    rng = random.Random(seed)
+    chars = ('abcdefghijklmnopqrstuvwxyzäöåABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÅ'
+             '0123456789_' + PUNCT_CHARS + '😀👍€°²½→•§★©\u0301\u200b')
+    words = [t for t in TOKEN_CORPUS if t.isalnum()]
+    tokens = []
+    for _ in range(n_tokens):
+        if rng.random() < 0.8:
+            tokens.append(rng.choice(words))
+        else:
+            tokens.append(''.join(rng.choice(chars)
+                                  for _ in range(rng.randint(1, 8))))
+    return tokens
+
+
+def check_token_cleaning(tokens=None):
+    """Check that 'is_valid_token' agrees with the reference implementation.
+
+    Args:
+        tokens (list, optional): Tokens to check. Defaults to None, which means
+            TOKEN_CORPUS and a set of generated tokens.
+
+    Returns:
+        list: Tokens for which the implementations disagree.
+    """
+    if tokens is None:
+        tokens = TOKEN_CORPUS + generate_tokens(n_tokens=100000, seed=1)
+    return [token for token in tokens
+            if (token.isalnum() or is_valid_token(token))
+            != reference_is_valid_token(token)]
 
 
 def preprocess_lines(lines, tokenizer, sent_tokenizer, min_sent_len=5):
@@ -57,39 +368,19 @@ def preprocess_lines(lines, tokenizer, sent_tokenizer, min_sent_len=5):
     contents = [c for js in json.loads('[' + ','.join(lines) + ']')
                 for c in js['content']]
     
-    filter_re = re.compile(r'[^\w\s]')
-    url_re = re.compile(r'\w+:\/\/\S*')
+    url_re = URL_RE
     
     sents = []
     for doc in contents:
         
         for sent in sent_tokenizer.tokenize(doc):
-            sent_tokens = []
             
             # Remove URLs
             sent = url_re.sub('<URL>', sent)
             
-            # Tokenization
-            tokens = tokenizer.tokenize(sent)
-
-            # Cleaning up
-            for token in tokens:
-                
-                # Normal tokens
-                normal_chars = filter_re.sub('', token)
-                n_token = len(token)
-                n_normal_chars = len(normal_chars)
-                pct_normal_chars = n_normal_chars / n_token
-                if n_normal_chars > 0 and pct_normal_chars > 0.75:
-                    sent_tokens.append(token)
-                    continue
-                    
-                # Emojis
-                other_chars = filter_re.findall(token)
-                only_one_other = len(other_chars) == 1
-                others_in_punct = any([c in PUNCT_CHARS for c in other_chars])
-                if only_one_other and not others_in_punct:
-                    sent_tokens.append(token)
+            # Tokenization and cleaning up
+            sent_tokens = [token for token in tokenizer.tokenize(sent)
+                           if token.isalnum() or is_valid_token(token)]
             
             # Add to sentences
             if len(sent_tokens) >= min_sent_len:
@@ -98,120 +389,856 @@ def preprocess_lines(lines, tokenizer, sent_tokenizer, min_sent_len=5):
     return sents
 
 
-def parallel_preprocess_lines(lines, tokenizer, sent_tokenizer,
-                              n_jobs=3, min_sent_len=5):
-    """Parallel preprocessing of lines.
+def get_tokenizers(tokenizer='tweet'):
+    """Load word and sentence tokenizers.
     
     Args:
-        lines (list): List of strings that are crawled lines and not in
-            JSON format yet.
-        tokenizer (object): Word tokenizer with 'tokenize' -method.
-        sent_tokenizer (object): Sentence tokenizer with 'tokenize' -method.
-        n_jobs (int, optional): Number of parallel workers to use. Defaults to
-            3.
+        tokenizer (str, optional): Word tokenizer to use. Should be in 
+            ['tweet']. Defaults to 'tweet'.
+    
+    Returns:
+        tuple: Two-element tuple with word and sentence tokenizer.
+    
+    Raises:
+        ValueError: If tokenizer name not in the list of allowed tokenizers.
+    """
+    if tokenizer.lower().strip() == 'tweet':
+        word_tokenizer = TweetTokenizer(strip_handles=True, reduce_len=True, 
+                                        preserve_case=True)
+    else:
+        raise ValueError('Currently only "tweet" tokenizer is supported!')
+    sent_tokenizer = nltk.data.load('tokenizers/punkt/finnish.pickle')
+    return word_tokenizer,sent_tokenizer
+
+
+def init_worker(tokenizer='tweet', min_sent_len=5, variants=(),
+                count_tokens=False):
+    """Initialize preprocessing worker process.
+    
+    Tokenizers are loaded only once per worker and kept in module state, so
+    that they don't need to be pickled along with each chunk of lines.
+    
+    Args:
+        tokenizer (str, optional): Word tokenizer to use. Defaults to 'tweet'.
         min_sent_len (int, optional): Minimum number of tokens to be considered
             as a sentence. Defaults to 5.
-            
+        variants (tuple, optional): Names of the sentence variants to produce
+            from SENTENCE_VARIANTS. Defaults to ().
+        count_tokens (bool, optional): Whether to count tokens of the cased
+            sentences. Defaults to False.
+    """
+    word_tokenizer, sent_tokenizer = get_tokenizers(tokenizer)
+    _worker_state['tokenizer'] = word_tokenizer
+    _worker_state['sent_tokenizer'] = sent_tokenizer
+    _worker_state['min_sent_len'] = min_sent_len
+    _worker_state['variants'] = variants
+    _worker_state['count_tokens'] = count_tokens
+
+
+def worker_preprocess_chunk(chunk):
+    """Preprocess a chunk of JSON lines with tokenizers of the worker process.
+    
+    Args:
+        chunk (tuple): Two-element tuple with bytes of complete JSON lines and
+            the byte offset in the input file where the chunk ends.
+    
+    Returns:
+        tuple: Five-element tuple with a dictionary of unique preprocessed
+            sentences for 'cased' and each configured variant, token counts
+            of the cased sentences as a Counter or None if tokens are not
+            counted, number of JSON lines in the chunk, the end offset of the
+            chunk and metrics of the worker as a dictionary.
+    """
+    data, end_offset = chunk
+    with Stage('preprocess_chunk', write=False) as stage:
+        sents, n_lines = _preprocess_data(data)
+        variant_sents = _get_variant_sents(sents)
+        token_counts = _count_tokens(variant_sents['cased'])
+    worker_metrics = _get_worker_metrics(stage)
+    worker_metrics['bytes'] = len(data)
+    return variant_sents,token_counts,n_lines,end_offset,worker_metrics
+
+
+def worker_preprocess_shard(filepath):
+    """Preprocess a closed, gzip compressed feed shard in a worker process.
+    
+    Args:
+        filepath (str): Path to the shard, like 'iltalehti.00001.jl.gz'.
+    
     Returns:
-        List of unique sentences in an array.
-    """
-    n = int(np.ceil(len(lines) / n_jobs))
-    job_lines = [lines[i:i + n] for i in range(0, len(lines), n)]
-    sent_lists = Parallel(n_jobs=n_jobs)(
-        delayed(preprocess_lines)(
-            lines=lines,
-            tokenizer=tokenizer,
-            sent_tokenizer=sent_tokenizer,
-            min_sent_len=min_sent_len
-        )
-        for lines in job_lines
+        tuple: Five-element tuple like in 'worker_preprocess_chunk', with the
+            size of the shard file as the end offset.
+    """
+    sents = []
+    n_lines = 0
+    n_bytes = 0
+    with Stage('preprocess_shard', write=False) as stage:
+        with gzip.open(filepath, 'rb') as f:
+            for data,_ in read_chunks(f):
+                chunk_sents, n_chunk_lines = _preprocess_data(data)
+                sents.extend(chunk_sents)
+                n_lines += n_chunk_lines
+                n_bytes += len(data)
+        variant_sents = _get_variant_sents(sents)
+        token_counts = _count_tokens(variant_sents['cased'])
+    worker_metrics = _get_worker_metrics(stage)
+    worker_metrics['bytes'] = n_bytes
+    return (variant_sents, token_counts, n_lines, os.path.getsize(filepath),
+            worker_metrics)
+
+
+def _preprocess_data(data):
+    lines = [l for l in data.decode('utf8').split('\n') if l.strip()]
+    sents = preprocess_lines(
+        lines,
+        tokenizer=_worker_state['tokenizer'],
+        sent_tokenizer=_worker_state['sent_tokenizer'],
+        min_sent_len=_worker_state['min_sent_len']
     )
-    sents = [sent for sent_list in sent_lists for sent in sent_list]
-    return pd.unique(sents)
-      
+    return sents,len(lines)
+
+
+def _get_variant_sents(sents):
+    sents = list(dict.fromkeys(sents))
+    variant_sents = {'cased': sents}
+    for name in _worker_state['variants']:
+        normalize = SENTENCE_VARIANTS[name]
+        variant_sents[name] = [normalize(sent) for sent in sents]
+    return variant_sents
+
 
-def preprocess_file(filepath, tokenizer, sent_tokenizer,
-                 out_filepath='./data/processed/test.sl',
-                 mode='a', lines_per_chunk=30000, min_sent_len=5, n_jobs=3):
-    """Preprocess single crawled JSON line file in chunks.
+def _count_tokens(sents):
+    if not _worker_state['count_tokens']:
+        return None
+    return collections.Counter(' '.join(sents).split())
+
+
+def _get_worker_metrics(stage):
+    return {key: stage.event[key] for key in
+            ['wall_s', 'cpu_s', 'peak_rss_mb', 'profile']
+            if key in stage.event}
+
+
+def create_pool(tokenizer='tweet', min_sent_len=5, variants=(),
+                count_tokens=False, n_jobs=3):
+    """Create a pool of preprocessing worker processes.
     
     Args:
-        filepath (str): Path to JSON line file to be preprocessed.
-        tokenizer (object): Word tokenizer with 'tokenize' -method.
-        sent_tokenizer (object): Sentence tokenizer with 'tokenize' -method.
-        out_filepath (str, optional): Filepath of the output sentence lines.
-            Defaults to './data/processed/test.sl'.
-        mode (str, optional): Mode to open output file with. Defaults to 'a'.
-        lines_per_chunk (int, optional): Number of JSON lines to be processed
-            in one chunk. Defaults to 30000.
+        tokenizer (str, optional): Word tokenizer to use. Should be in 
+            ['tweet']. Defaults to 'tweet'.
         min_sent_len (int, optional): Minimum number of tokens to be considered
             as a sentence. Defaults to 5.
-        n_jobs (int, optional): Number of parallel workers to use. Defaults to 
-            3.
+        variants (tuple, optional): Names of the sentence variants to produce
+            from SENTENCE_VARIANTS. Defaults to ().
+        count_tokens (bool, optional): Whether the workers count tokens of
+            the cased sentences. Defaults to False.
+        n_jobs (int, optional): Number of worker processes. Defaults to 3.
+    
+    Returns:
+        multiprocessing.Pool: Pool with initialized workers.
+    
+    Raises:
+        ValueError: If tokenizer or variant name is not supported.
     """
-    with open(filepath, 'r', encoding='utf8') as f:
-        logger.info('Reading number of lines in the file...')
-        n_total_lines = sum(1 for _ in f)
-        f.seek(0)
+    if tokenizer.lower().strip() not in TOKENIZERS:
+        raise ValueError('Currently only "tweet" tokenizer is supported!')
+    for name in variants:
+        if name not in SENTENCE_VARIANTS:
+            raise ValueError(f'Unknown sentence variant "{name}", should be '
+                             f'in {list(SENTENCE_VARIANTS)}!')
+    return multiprocessing.Pool(
+        processes=n_jobs,
+        initializer=init_worker,
+        initargs=(tokenizer, min_sent_len, tuple(variants), count_tokens)
+    )
+
+
+def read_chunks(f, bytes_per_chunk=1 << 22, start_offset=0, slots=None,
+                stop=None):
+    """Read chunks of complete lines from a binary file.
+    
+    A possibly incomplete last line, such as one being written by a running
+    crawler, is left out.
+    
+    Args:
+        f (file): File opened in binary mode.
+        bytes_per_chunk (int, optional): Approximate size of a chunk in bytes.
+            Defaults to 4 MiB.
+        start_offset (int, optional): Byte offset to start reading from.
+            Defaults to 0.
+        slots (threading.Semaphore, optional): Semaphore acquired before
+            reading each chunk, used to bound the number of chunks in memory.
+            Defaults to None.
+        stop (threading.Event, optional): Event that ends reading when set.
+            Defaults to None.
+    
+    Yields:
+        tuple: Two-element tuple with bytes of the chunk and the byte offset
+            in the file where the chunk ends.
+    """
+    offset = start_offset
+    f.seek(offset)
+    while True:
+        if slots is not None:
+            slots.acquire()
+        if stop is not None and stop.is_set():
+            return
+        data = f.read(bytes_per_chunk)
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+        if not data.endswith(b'\n'):
+            data = data[:data.rfind(b'\n') + 1]
+        if not data:
+            return
+        offset += len(data)
+        yield data,offset
+
+
+class SentenceWriter(object):
+    """Writer of sentence lines of one variant.
+    
+    Args:
+        filepath (str): Filepath of the output sentence lines.
+        variant (str, optional): Name of the variant to write. Defaults to
+            'cased'.
+        mode (str, optional): Mode to open output file with. Defaults to 'w'.
+    """
+
+    def __init__(self, filepath, variant='cased', mode='w'):
+        self.filepath = filepath
+        self.variant = variant
+        self.file = open(filepath, mode=mode, encoding='utf8')
+
+    def write(self, variant_sents, source, token_counts=None):
+        """Write sentences of a chunk.
         
-        with open(out_filepath, mode=mode, encoding='utf8') as fout:
-            it = grouper(f, lines_per_chunk)
-            for i,lines in enumerate(it):
-                start_time = time.perf_counter()
-                end_line = min((i + 1) * lines_per_chunk, n_total_lines) / 1e3
-                logger.info(f'Lines {i * lines_per_chunk / 1e3:.0f}'
-                            f' - {end_line:.0f}k '
-                            f'/ {n_total_lines / 1e3:.0f}k')
-                
-                sents = parallel_preprocess_lines(
-                    [l for l in lines if l],
-                    tokenizer=tokenizer,
-                    sent_tokenizer=sent_tokenizer,
-                    n_jobs=n_jobs,
-                    min_sent_len=min_sent_len
-                )
-                
-                logger.info(f'Writing {len(sents)} sentences...')
-                fout.write('\n'.join(sents))
+        Args:
+            variant_sents (dict): Sentences of the chunk by variant name.
+            source (str): Name of the source the sentences came from.
+            token_counts (collections.Counter, optional): Token counts of the
+                cased sentences. Defaults to None.
+        """
+        self.file.write(''.join(sent + '\n'
+                                for sent in variant_sents[self.variant]))
+
+    def flush(self):
+        """Flush written sentences to the output file."""
+        self.file.flush()
+
+    def close(self):
+        """Close the output file."""
+        self.file.close()
+
+
+class CountWriter(object):
+    """Base class of writers of counts that are kept in memory.
+    
+    Counts are written in two steps, so that they stay consistent with the
+    manifest of preprocessing: 'flush' writes them into filepath + '.tmp'
+    and returns their checksum, which is recorded in the manifest, after
+    which 'commit' replaces the output with them.
+    
+    Args:
+        filepath (str): Filepath of the output counts.
+        mode (str, optional): 'w' to start from zero counts or 'a' to add to
+            the counts found from 'filepath'. Defaults to 'w'.
+    """
+
+    def __init__(self, filepath, mode='w'):
+        self.filepath = filepath
+        self.counts = collections.Counter()
+        if mode == 'a' and os.path.exists(filepath):
+            self.read()
+
+    def read(self):
+        """Read counts from the output file."""
+        raise NotImplementedError
+
+    def dump(self, f):
+        """Write counts into a file.
+        
+        Args:
+            f (file): File opened for writing text.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """Write the counts so far into a temporary file.
+        
+        Returns:
+            str: Checksum of the written counts.
+        """
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, 'w', encoding='utf8') as f:
+            self.dump(f)
+        return file_checksum(tmp_filepath, os.path.getsize(tmp_filepath))
+
+    def commit(self):
+        """Replace the output file with the counts of the last flush."""
+        tmp_filepath = self.filepath + '.tmp'
+        if os.path.exists(tmp_filepath):
+            os.replace(tmp_filepath, self.filepath)
+
+    def close(self):
+        """Close the writer without writing counts after the last flush."""
+
+
+class TokenCountWriter(CountWriter):
+    """Writer of token frequencies as tab separated 'token count' -lines.
+    
+    Tokens are counted by the worker processes, and only the counts of each
+    chunk are added up here.
+    
+    Args:
+        filepath (str): Filepath of the output token counts.
+        mode (str, optional): 'w' to start from zero counts or 'a' to add to
+            the counts found from 'filepath'. Defaults to 'w'.
+    """
+
+    def read(self):
+        """Read token counts from the output file."""
+        with open(self.filepath, 'r', encoding='utf8') as f:
+            for line in f:
+                token, count = line.rstrip('\n').split('\t')
+                self.counts[token] = int(count)
+
+    def write(self, variant_sents, source, token_counts=None):
+        """Add token counts of a chunk.
+        
+        Args:
+            variant_sents (dict): Sentences of the chunk by variant name.
+            source (str): Name of the source the sentences came from.
+            token_counts (collections.Counter, optional): Token counts of the
+                cased sentences. Defaults to None.
+        """
+        self.counts.update(token_counts)
+
+    def dump(self, f):
+        """Write token counts in descending order into a file.
+        
+        Args:
+            f (file): File opened for writing text.
+        """
+        for token,count in self.counts.most_common():
+            f.write(f'{token}\t{count}\n')
+
+
+class SourceCountWriter(CountWriter):
+    """Writer of number of sentences per source as JSON.
+    
+    Args:
+        filepath (str): Filepath of the output JSON.
+        mode (str, optional): 'w' to start from zero counts or 'a' to add to
+            the counts found from 'filepath'. Defaults to 'w'.
+    """
+
+    def read(self):
+        """Read sentence counts from the output file."""
+        with open(self.filepath, 'r', encoding='utf8') as f:
+            self.counts.update(json.load(f))
+
+    def write(self, variant_sents, source, token_counts=None):
+        """Count sentences of a chunk.
+        
+        Args:
+            variant_sents (dict): Sentences of the chunk by variant name.
+            source (str): Name of the source the sentences came from.
+            token_counts (collections.Counter, optional): Token counts of the
+                cased sentences. Defaults to None.
+        """
+        self.counts[source] += len(variant_sents['cased'])
+
+    def dump(self, f):
+        """Write sentence counts into a file.
+        
+        Args:
+            f (file): File opened for writing text.
+        """
+        json.dump(dict(self.counts), f, indent=2)
+
+
+def get_output_filepaths(out_filepath, variants=()):
+    """Get filepaths of all outputs created by preprocessing.
+    
+    Args:
+        out_filepath (str): Filepath of the output sentence lines.
+        variants (tuple, optional): Names of the sentence variants. Defaults to
+            ().
+    
+    Returns:
+        dict: Filepaths by output name, with one 'cased' and one per variant
+            for sentence lines, and 'token_counts', 'source_counts',
+            'hashes' and 'manifest' for the rest.
+    """
+    base = os.path.splitext(out_filepath)[0]
+    filepaths = {'cased': out_filepath}
+    for name in variants:
+        filepaths[name] = f'{base}.{name}.sl'
+    filepaths['token_counts'] = f'{base}.tokens.tsv'
+    filepaths['source_counts'] = f'{base}.sources.json'
+    filepaths['hashes'] = f'{base}.hashes'
+    filepaths['manifest'] = f'{base}.manifest.json'
+    return filepaths
+
+
+def preprocess_file(filepath, pool, writers, start_offset=0,
+                    bytes_per_chunk=1 << 22,
+                    max_pending_chunks=8, hash_index=None,
+                    log_interval=10):
+    """Preprocess single crawled JSON line file as a stream of chunks.
+    
+    Reading, tokenization and writing are overlapped: chunks are read in a
+    background thread and handed out to the workers one at a time, while
+    finished chunks are passed in order to each of the writers. At most
+    'max_pending_chunks' chunks are in memory at once, so peak memory is
+    roughly 'max_pending_chunks' * 'bytes_per_chunk' plus the resulting
+    sentences.
+    
+    Args:
+        filepath (str): Path to JSON line file to be preprocessed.
+        pool (multiprocessing.Pool): Pool created with 'create_pool'.
+        writers (list): Writers with 'write', 'flush' and 'close' -methods,
+            such as SentenceWriter, that receive the sentences of each chunk.
+        start_offset (int, optional): Byte offset in the input file to start
+            preprocessing from. Defaults to 0.
+        bytes_per_chunk (int, optional): Approximate size of a chunk of JSON
+            lines given to a worker, in bytes. Defaults to 4 MiB.
+        max_pending_chunks (int, optional): Maximum number of chunks read but
+            not yet written. Should be larger than the number of workers to
+            keep all of them busy. Defaults to 8.
+        hash_index (SentenceHashIndex, optional): Index of already seen
+            sentences. If given, sentences found from the index are dropped
+            and new ones are added into it. Defaults to None.
+        log_interval (float, optional): Minimum number of seconds between
+            progress messages. Defaults to 10.
+
+    Each chunk is recorded as a 'preprocess_chunk' metrics event with the
+    measurements of its worker, and the whole file as 'preprocess_file'.
+    
+    Returns:
+        tuple: Two-element tuple with number of duplicate sentences dropped
+            with 'hash_index' and the byte offset up to which the input file
+            was preprocessed.
+    """
+    with Stage('preprocess_file', file=os.path.basename(filepath),
+               start_offset=start_offset) as stage:
+        n_duplicates, offset, n_lines, n_sents = _preprocess_file(
+            filepath, pool, writers, start_offset, bytes_per_chunk,
+            max_pending_chunks, hash_index, log_interval)
+        stage.items_in = n_lines
+        stage.items_out = n_sents
+        stage.fields.update(bytes=offset - start_offset,
+                            duplicates=int(n_duplicates))
+    return n_duplicates,offset
+
+
+def get_source(filepath):
+    """Get name of the source of a feed file, such as the spider name.
+    
+    Args:
+        filepath (str): Path to a JSON line file like 'iltalehti.jl', or a
+            feed shard like 'iltalehti.00001.jl.gz'.
+    
+    Returns:
+        str: Name of the source, like 'iltalehti'.
+    """
+    name = os.path.basename(filepath)
+    if name.endswith('.jl.gz'):
+        return name.rsplit('.', 3)[0]
+    return os.path.splitext(name)[0]
+
+
+def write_sentences(variant_sents, writers, source, hash_index=None,
+                    token_counts=None):
+    """Write preprocessed sentences of a chunk or shard.
+    
+    Args:
+        variant_sents (dict): Sentences of 'cased' and each variant.
+        writers (list): Writers that receive the sentences.
+        source (str): Name of the source of the sentences.
+        hash_index (SentenceHashIndex, optional): Index of already seen
+            sentences, used to drop duplicates. Defaults to None.
+        token_counts (collections.Counter, optional): Token counts of the
+            cased sentences, counted by a worker. Tokens of dropped
+            duplicates are subtracted from them. Defaults to None.
+    
+    Returns:
+        tuple: Two-element tuple with number of sentences written and number
+            of duplicate sentences dropped.
+    """
+    n_duplicates = 0
+    if hash_index is not None:
+        is_new = hash_index.add(variant_sents['cased'])
+        n_duplicates = int(len(is_new) - is_new.sum())
+        if token_counts is not None and n_duplicates > 0:
+            token_counts.subtract(' '.join(
+                sent for sent,new in zip(variant_sents['cased'], is_new)
+                if not new).split())
+            token_counts = +token_counts
+        variant_sents = {
+            name: [sent for sent,new in zip(sents, is_new) if new]
+            for name,sents in variant_sents.items()
+        }
+    for writer in writers:
+        writer.write(variant_sents, source, token_counts)
+    return len(variant_sents['cased']),n_duplicates
+
+
+def _preprocess_file(filepath, pool, writers, start_offset, bytes_per_chunk,
+                     max_pending_chunks, hash_index, log_interval):
+    start_time = time.perf_counter()
+    n_total_bytes = os.path.getsize(filepath)
+    offset = start_offset
+    n_lines = 0
+    n_sents = 0
+    n_duplicates = 0
+    
+    source = get_source(filepath)
+    slots = threading.Semaphore(max_pending_chunks)
+    stop = threading.Event()
+    with open(filepath, 'rb') as f:
+        try:
+            chunks = read_chunks(f, bytes_per_chunk=bytes_per_chunk,
+                                 start_offset=start_offset, slots=slots,
+                                 stop=stop)
+            results = pool.imap(worker_preprocess_chunk, chunks, chunksize=1)
+            last_log_time = start_time
+            for result in results:
+                slots.release()
+                (variant_sents, token_counts, n_chunk_lines, offset,
+                 worker_metrics) = result
+                n_lines += n_chunk_lines
+                n_chunk_sents, n_chunk_duplicates = write_sentences(
+                    variant_sents, writers, source, hash_index, token_counts)
+                n_sents += n_chunk_sents
+                n_duplicates += n_chunk_duplicates
+                emit('preprocess_chunk', file=source, offset=offset,
+                     items_in=n_chunk_lines, items_out=n_chunk_sents,
+                     sentences_before_dedup=len(variant_sents['cased']),
+                     **worker_metrics)
                 
-                time_passed = time.perf_counter() - start_time
-                logger.info(f'Chunk done in {time_passed:.0f} seconds!')
-                gc.collect()
+                if time.perf_counter() - last_log_time >= log_interval:
+                    last_log_time = time.perf_counter()
+                    time_passed = last_log_time - start_time
+                    logger.info(f'{offset / 1e6:.0f} / '
+                                f'{n_total_bytes / 1e6:.0f} MB '
+                                f'({offset / max(n_total_bytes, 1):.0%}), '
+                                f'{n_lines / time_passed:.0f} lines/s, '
+                                f'{n_sents} sentences written')
+        finally:
+            # Wake up the reader if it is waiting for a free slot
+            stop.set()
+            slots.release()
+    
+    time_passed = time.perf_counter() - start_time
+    logger.info(f'File done in {time_passed:.0f} seconds, {n_lines} lines '
+                f'and {n_sents} sentences!')
+    return n_duplicates,offset,n_lines,n_sents
+
+
+def preprocess_shards(filepaths, pool, writers, max_pending_shards=4,
+                      hash_index=None):
+    """Preprocess closed feed shards in parallel, one shard per worker.
+    
+    Shards are decompressed and preprocessed by the workers, while finished
+    shards are passed in order to each of the writers. At most
+    'max_pending_shards' preprocessed shards are in memory at once.
+    
+    Args:
+        filepaths (list): Paths to gzip compressed shards written by
+            'crawling.pipelines.CrawlingPipeline'.
+        pool (multiprocessing.Pool): Pool created with 'create_pool'.
+        writers (list): Writers with 'write', 'flush' and 'close' -methods.
+        max_pending_shards (int, optional): Maximum number of shards handed
+            out but not yet written. Defaults to 4.
+        hash_index (SentenceHashIndex, optional): Index of already seen
+            sentences. Defaults to None.
+    
+    Each shard is recorded as a 'preprocess_shard' metrics event.
+    
+    Yields:
+        tuple: Three-element tuple with path of the shard, number of
+            duplicate sentences dropped and the size of the shard, once the
+            sentences of the shard have been written.
+    """
+    start_time = time.perf_counter()
+    n_lines = 0
+    slots = threading.Semaphore(max_pending_shards)
+    stop = threading.Event()
+    
+    def iter_shards():
+        for path in filepaths:
+            slots.acquire()
+            if stop.is_set():
+                return
+            yield path
+    
+    try:
+        results = pool.imap(worker_preprocess_shard, iter_shards(),
+                            chunksize=1)
+        for i,(path,result) in enumerate(zip(filepaths, results)):
+            slots.release()
+            (variant_sents, token_counts, n_shard_lines, size,
+             worker_metrics) = result
+            n_lines += n_shard_lines
+            source = get_source(path)
+            n_sents, n_duplicates = write_sentences(
+                variant_sents, writers, source, hash_index, token_counts)
+            emit('preprocess_shard', file=os.path.basename(path),
+                 items_in=n_shard_lines, items_out=n_sents,
+                 sentences_before_dedup=len(variant_sents['cased']),
+                 duplicates=n_duplicates, **worker_metrics)
+            time_passed = time.perf_counter() - start_time
+            logger.info(f'Shard "{path}" done ({i + 1} / {len(filepaths)}), '
+                        f'{n_shard_lines} lines and {n_sents} sentences, '
+                        f'{n_lines / time_passed:.0f} lines/s')
+            yield path,n_duplicates,size
+    finally:
+        stop.set()
+        slots.release()
+
+
+def get_shard_filepaths(in_filedir):
+    """Get closed feed shards from the shard indexes of a folder.
+    
+    Args:
+        in_filedir (str): Path to directory of the feeds.
+    
+    Returns:
+        list: Absolute paths to the shards listed in each '*.shards.json'
+            index, in the order they were written.
+    """
+    filepaths = []
+    for index_path in sorted(glob.glob(in_filedir + '*.shards.json')):
+        with open(index_path, 'r', encoding='utf8') as f:
+            shards = json.load(f)['shards']
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        filepaths.extend(os.path.join(index_dir, shard['file'])
+                         for shard in shards)
+    return filepaths
+
+
+def file_checksum(filepath, n_bytes):
+    """Calculate checksum of the beginning of a file.
+    
+    Args:
+        filepath (str): Path to the file.
+        n_bytes (int): Number of bytes from the beginning to calculate the
+            checksum from.
+    
+    Returns:
+        str: Hexadecimal checksum.
+    """
+    with open(filepath, 'rb') as f:
+        return hashlib.blake2b(f.read(n_bytes), digest_size=16).hexdigest()
+
+
+def new_manifest():
+    """Create manifest of a preprocessing run from scratch.
+    
+    Returns:
+        dict: Manifest without preprocessed files.
+    """
+    return {'files': {}, 'outputs': {}, 'counts': {}, 'hash_runs': None}
+
+
+def load_manifest(filepath):
+    """Load manifest of already preprocessed input files.
+    
+    Args:
+        filepath (str): Path to the manifest JSON file.
+    
+    Returns:
+        dict: Manifest with keys 'files', which maps input file names to
+            dictionaries with keys 'offset', 'checksum' and
+            'checksum_bytes', 'outputs', which maps output file names to
+            their sizes in bytes, 'counts', which maps files of counts to
+            their checksums, and 'hash_runs', which lists the runs of the
+            sentence hash index or is None. Empty files if the manifest
+            doesn't exist.
+    """
+    manifest = new_manifest()
+    if os.path.exists(filepath):
+        with open(filepath, 'r', encoding='utf8') as f:
+            manifest.update(json.load(f))
+    return manifest
+
+
+def save_manifest(filepath, manifest):
+    """Save manifest of already preprocessed input files.
+    
+    Args:
+        filepath (str): Path to the manifest JSON file.
+        manifest (dict): Manifest as returned by 'load_manifest'.
+    """
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+def truncate_outputs(filepaths, output_sizes):
+    """Truncate outputs to the sizes they had when the manifest was saved.
+    
+    Sentences written after that, by a run that was interrupted in the
+    middle of a file, are removed, since the file is preprocessed again.
+    
+    Args:
+        filepaths (list): Paths to the output files.
+        output_sizes (dict): Output file names mapped to their sizes.
+    
+    Returns:
+        bool: True if all outputs were truncated, False if an output is
+            missing from 'output_sizes' or smaller than its recorded size.
+    """
+    for path in filepaths:
+        size = output_sizes.get(os.path.basename(path))
+        if size is None or os.path.getsize(path) < size:
+            return False
+    for path in filepaths:
+        size = output_sizes[os.path.basename(path)]
+        if os.path.getsize(path) > size:
+            logger.warning(f'Truncating "{path}" from '
+                           f'{os.path.getsize(path)} to {size} bytes, '
+                           'written after the previous manifest')
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+    return True
+
+
+def restore_counts(filepaths, checksums):
+    """Restore counts to the state they had when the manifest was saved.
+    
+    Counts written by 'CountWriter.flush' but not yet committed when a run
+    was interrupted are committed, if they are the ones in the manifest.
+    
+    Args:
+        filepaths (list): Paths to the files of counts.
+        checksums (dict): File names of counts mapped to their checksums.
+    
+    Returns:
+        bool: True if all counts match the manifest, False otherwise.
+    """
+    for path in filepaths:
+        checksum = checksums.get(os.path.basename(path))
+        for candidate in [path, path + '.tmp']:
+            if (checksum is not None and os.path.exists(candidate)
+                    and file_checksum(candidate, os.path.getsize(candidate))
+                    == checksum):
+                if candidate != path:
+                    os.replace(candidate, path)
+                break
+        else:
+            return False
+    return True
+
+
+def get_manifest_entry(filepath, offset, checksum_bytes=1 << 20):
+    """Create manifest entry for an input file preprocessed up to an offset.
+    
+    Args:
+        filepath (str): Path to the input file.
+        offset (int): Byte offset up to which the file has been preprocessed.
+        checksum_bytes (int, optional): Maximum number of bytes from the
+            beginning of the file to calculate the checksum from. Defaults to
+            1 MiB.
+    
+    Returns:
+        dict: Manifest entry.
+    """
+    n_bytes = min(offset, checksum_bytes)
+    return {
+        'offset': offset,
+        'checksum': file_checksum(filepath, n_bytes),
+        'checksum_bytes': n_bytes
+    }
+
+
+def is_unchanged(filepath, entry):
+    """Check whether already preprocessed part of an input file is unchanged.
+    
+    Args:
+        filepath (str): Path to the input file.
+        entry (dict): Manifest entry of the file.
+    
+    Returns:
+        bool: False if the file has been truncated or rewritten since it was
+            preprocessed, True otherwise.
+    """
+    if os.path.getsize(filepath) < entry['offset']:
+        return False
+    checksum = file_checksum(filepath, entry['checksum_bytes'])
+    return checksum == entry['checksum']
 
 
 def preprocess_all_files(in_filedir='./data/feed/',
                          out_filepath='./data/processed/all2.sl',
-                         lines_per_chunk=30000,
-                         create_uncased=True,
+                         bytes_per_chunk=1 << 22,
+                         max_pending_chunks=None,
+                         variants=('uncased',),
+                         token_counts=False,
+                         source_counts=False,
                          min_sent_len=5,
                          tokenizer='tweet',
-                         n_jobs=3):
-    """Preprocess all crawled JSON line files in a folder.
+                         n_jobs=3,
+                         dedup=True,
+                         incremental=False):
+    """Preprocess all crawled JSON line files and feed shards in a folder.
+    
+    JSON line files are streamed chunk by chunk one at a time, and closed
+    gzip compressed shards listed in the shard indexes are preprocessed in
+    parallel, one shard per worker.
     
     Args:
-        in_filedir (str, optional): Path to directory of JSON line files to be
-            preprocessed. Defaults to './data/feed/'.
+        in_filedir (str, optional): Path to directory of JSON line files and
+            shards to be preprocessed. Defaults to './data/feed/'.
         out_filepath (str, optional): Filepath of the output sentence lines.
             Defaults to './data/processed/all.sl'.
-        lines_per_chunk (int, optional): Number of JSON lines to be processed
-            in one chunk. Defaults to 30000.
-        create_uncased (bool, optional): Whether to create uncased version of
-            the sentences or not. The name will be same as out_filepath + 
-            '_uncased.sl'. Defaults to True.
+        bytes_per_chunk (int, optional): Approximate size of a chunk of JSON
+            lines given to a worker, in bytes. Defaults to 4 MiB.
+        max_pending_chunks (int, optional): Maximum number of chunks in memory
+            at once. Defaults to None, which means two times 'n_jobs'.
+        variants (tuple, optional): Names of the normalized sentence variants
+            from SENTENCE_VARIANTS to write in the same pass. Each is written
+            next to the output with the extension replaced by '.<name>.sl',
+            like 'all.uncased.sl'. Defaults to ('uncased',).
+        token_counts (bool, optional): Whether to write token frequencies of
+            the cased sentences, counted by the workers, next to the output
+            as '.tokens.tsv'. Defaults to False.
+        source_counts (bool, optional): Whether to write number of sentences
+            per input file next to the output as '.sources.json'. Defaults to
+            False.
         min_sent_len (int, optional): Minimum number of tokens to be considered
             as a sentence. Defaults to 5.
         tokenizer (str, optional): Word tokenizer to use. Should be in 
             ['tweet']. Defaults to 'tweet'.
-        n_jobs (int, optional): Number of parallel workers to use. Defaults to 
-            3.
+        n_jobs (int, optional): Number of worker processes kept alive for the
+            whole run. Defaults to 3.
+        dedup (bool, optional): Whether to drop sentences that already occur
+            anywhere in the output. Hashes of written sentences are persisted
+            into the folder next to the output with the extension replaced
+            by '.hashes'. Defaults to True.
+        incremental (bool, optional): Whether to preprocess only lines that
+            have been appended to the input files since the previous run, and
+            append their sentences into the existing output. The processed
+            byte offset of each input file is kept in '.manifest.json' next to
+            the output, together with the sizes of the outputs, checksums of
+            the counts and the runs of the sentence hashes, and outputs are
+            truncated back to those sizes when a run was interrupted in the
+            middle of a file.
+            If any input file has been rewritten since, all files are
+            preprocessed again from scratch. Defaults to False.
     
     Raises:
-        ValueError: If tokenizer name not in the list of allowed tokenizers.
+        ValueError: If tokenizer or variant name is not supported.
     """
     start_time = time.perf_counter()
     
     # Solve paths
-    filepaths = [os.path.abspath(p) for p in glob.glob(in_filedir + '*.jl')]
+    jl_filepaths = [os.path.abspath(p)
+                    for p in glob.glob(in_filedir + '*.jl')]
+    shard_filepaths = get_shard_filepaths(in_filedir)
+    filepaths = jl_filepaths + shard_filepaths
     
     out_filepath = os.path.abspath(out_filepath)
     out_dir = os.path.dirname(out_filepath)
@@ -219,39 +1246,148 @@ def preprocess_all_files(in_filedir='./data/feed/',
         os.makedirs(out_dir)
         logger.warn(f'Created directory in {out_dir}')
     
-    # Tokenizers
-    if tokenizer.lower().strip() == 'tweet':
-        tokenizer = TweetTokenizer(strip_handles=True, reduce_len=True, 
-                                   preserve_case=True)
-    else:
-        raise ValueError('Currently only "tweet" tokenizer is supported!')
-    sent_tokenizer = nltk.data.load('tokenizers/punkt/finnish.pickle')
+    if max_pending_chunks is None:
+        max_pending_chunks = 2 * n_jobs
     
-    # Preprocessing
-    for i,path in enumerate(filepaths):
-        logger.info(f'Processing file "{path}" '
-                    f'({i + 1} / {len(filepaths)})')
-        preprocess_file(
-            filepath=path,
-            mode='w' if i == 0 else 'a',
-            lines_per_chunk=lines_per_chunk,
-            out_filepath=out_filepath, min_sent_len=min_sent_len,
-            tokenizer=tokenizer,
-            sent_tokenizer=sent_tokenizer,
-            n_jobs=n_jobs
-        )
+    out_filepaths = get_output_filepaths(out_filepath, variants)
+    
+    # Worker processes with tokenizers
+    pool = create_pool(tokenizer=tokenizer, min_sent_len=min_sent_len,
+                       variants=variants, count_tokens=token_counts,
+                       n_jobs=n_jobs)
+    
+    # Already preprocessed parts of the input files
+    manifest_filepath = out_filepaths['manifest']
+    manifest = new_manifest()
+    sent_filepaths = [out_filepaths[name]
+                      for name in ['cased'] + list(variants)]
+    count_filepaths = [out_filepaths[name] for name,enabled
+                       in [('token_counts', token_counts),
+                           ('source_counts', source_counts)] if enabled]
+    missing_outputs = [path for path in sent_filepaths
+                       if not os.path.exists(path)]
+    if incremental and missing_outputs:
+        logger.warning(f'Outputs {missing_outputs} not found, '
+                       'preprocessing all files again')
+    elif incremental:
+        manifest = load_manifest(manifest_filepath)
+        for path in filepaths:
+            name = os.path.basename(path)
+            files = manifest['files']
+            if name in files and not is_unchanged(path, files[name]):
+                logger.warning(f'File "{path}" has been rewritten since '
+                               'previous run, preprocessing all files again')
+                manifest = new_manifest()
+                break
         
-    # Uncased version of the sentence lines
-    if create_uncased:
-        uncased_filepath = os.path.join(
-            os.path.dirname(out_filepath),
-            os.path.splitext(out_filepath)[0] + '.uncased.sl')
-        logger.info(f'Creating uncased into "{uncased_filepath}"...')
-        with open(out_filepath, 'r', encoding='utf8') as f:
-            with open(uncased_filepath, 'w', encoding='utf8') as fout:
-                for line in f:
-                    fout.write(line.lower())
-                    
+        # Manifests of earlier versions have no output sizes
+        if (manifest['files'] and manifest['outputs']
+                and not truncate_outputs(sent_filepaths,
+                                         manifest['outputs'])):
+            logger.warning('Outputs are smaller than in the manifest, '
+                           'preprocessing all files again')
+            manifest = new_manifest()
+        if (manifest['files']
+                and not restore_counts(count_filepaths, manifest['counts'])):
+            logger.warning('Counts do not match the manifest, '
+                           'preprocessing all files again')
+            manifest = new_manifest()
+    files = manifest['files']
+    append = len(files) > 0
+    
+    # Sentence deduplication
+    hash_index = None
+    hash_dirpath = out_filepaths['hashes']
+    if dedup:
+        if append:
+            hash_index = SentenceHashIndex.load(hash_dirpath,
+                                                manifest['hash_runs'])
+            logger.info(f'Loaded {len(hash_index)} sentence hashes '
+                        f'from "{hash_dirpath}"')
+        else:
+            hash_index = SentenceHashIndex()
+    
+    def save_progress():
+        # Outputs, hashes and input offsets are recorded together, so that
+        # an interrupted run is resumed from a consistent state
+        for writer in sent_writers:
+            writer.flush()
+        manifest['counts'] = {os.path.basename(writer.filepath): writer.flush()
+                              for writer in count_writers}
+        if hash_index is not None:
+            manifest['hash_runs'] = hash_index.save(hash_dirpath)
+        manifest['outputs'] = {os.path.basename(path): os.path.getsize(path)
+                               for path in sent_filepaths}
+        save_manifest(manifest_filepath, manifest)
+        for writer in count_writers:
+            writer.commit()
+        if hash_index is not None:
+            hash_index.remove_unused(hash_dirpath)
+    
+    # Output writers
+    mode = 'a' if append else 'w'
+    sent_writers = [SentenceWriter(out_filepaths[name], variant=name,
+                                   mode=mode)
+                    for name in ['cased'] + list(variants)]
+    count_writers = []
+    if token_counts:
+        count_writers.append(TokenCountWriter(out_filepaths['token_counts'],
+                                              mode=mode))
+    if source_counts:
+        count_writers.append(SourceCountWriter(
+            out_filepaths['source_counts'], mode=mode))
+    writers = sent_writers + count_writers
+    
+    # Preprocessing
+    try:
+        with pool:
+            for i,path in enumerate(jl_filepaths):
+                name = os.path.basename(path)
+                start_offset = files.get(name, {}).get('offset', 0)
+                if start_offset == os.path.getsize(path):
+                    logger.info(f'No new lines in file "{path}" '
+                                f'({i + 1} / {len(jl_filepaths)})')
+                    continue
+            
+                logger.info(f'Processing file "{path}" from byte '
+                            f'{start_offset} ({i + 1} / {len(jl_filepaths)})')
+                n_duplicates,offset = preprocess_file(
+                    filepath=path,
+                    pool=pool,
+                    writers=writers,
+                    start_offset=start_offset,
+                    bytes_per_chunk=bytes_per_chunk,
+                    max_pending_chunks=max_pending_chunks,
+                    hash_index=hash_index
+                )
+                if hash_index is not None:
+                    logger.info(f'Dropped {n_duplicates} duplicate sentences '
+                                f'from "{path}"')
+                files[name] = get_manifest_entry(path, offset)
+                save_progress()
+            
+            # Closed shards never change, so they are either done or not
+            new_shard_filepaths = [
+                path for path in shard_filepaths
+                if os.path.basename(path) not in files
+            ]
+            logger.info(f'Processing {len(new_shard_filepaths)} new shards, '
+                        f'{len(shard_filepaths) - len(new_shard_filepaths)} '
+                        'already done')
+            shard_results = preprocess_shards(
+                new_shard_filepaths,
+                pool=pool,
+                writers=writers,
+                max_pending_shards=n_jobs + 1,
+                hash_index=hash_index
+            )
+            for path,n_duplicates,size in shard_results:
+                files[os.path.basename(path)] = get_manifest_entry(path, size)
+                save_progress()
+    finally:
+        for writer in writers:
+            writer.close()
+    
     logger.info(f'All done in {time.perf_counter() - start_time:.0f} seconds!')
     
 
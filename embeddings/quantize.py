@@ -0,0 +1,462 @@
+"""Module for quantized exports of word embeddings.
+
+Normalized word vectors are quantized into one of the following kinds:
+
+* *float16*: half precision floats, 2x smaller
+* *int8*: int8 codes with a float32 scale per dimension, 4x smaller
+* *pq*: product quantization, where each vector is split into subvectors that
+  are replaced by uint8 codes of their nearest k-means centroids, for example
+  16x smaller for 300d vectors with 75 subvectors
+
+Original vector norms are kept as float16, so that 'dequantize' restores the
+scale of the vectors. Each export is saved as '<name>.<kind>.npz' next to the
+word2vec format file, and uses the vocabulary of the bundle next to it.
+"""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import abc
+import re
+import time
+import ujson as json
+
+import numpy as np
+
+from ann import assign_clusters, kmeans
+from bundle import get_bundle_dir, load_bundle
+from query import SimilarityIndex, normalize_rows
+
+
+QUANTIZATION_KINDS = ['float16', 'int8', 'pq']
+
+
+class QuantizedVectors(abc.ABC):
+    """Base class of quantized normalized word vectors.
+
+    Indexing with an integer, slice or list of integers dequantizes the rows
+    on the fly into normalized float32 vectors, so that quantized vectors can
+    be used as vectors of query.SimilarityIndex.
+
+    Args:
+        norms (numpy.ndarray): Norms of the original vectors.
+    """
+
+    kind = None
+
+    def __init__(self, norms):
+        self.norms = norms
+
+    def __len__(self):
+        return len(self.norms)
+
+    def __getitem__(self, key):
+        return normalize_rows(self.decode(key))
+
+    @property
+    def nbytes(self):
+        """int: Size of the quantized vectors in bytes."""
+        return sum(arr.nbytes for arr in self.arrays().values())
+
+    @classmethod
+    @abc.abstractmethod
+    def encode(cls, vectors, norms, rows_per_block=100000):
+        """Quantize word vectors, normalizing them block by block.
+
+        Args:
+            vectors (numpy.ndarray): Word vectors, may be memory-mapped.
+            norms (numpy.ndarray): Norms of the vectors.
+            rows_per_block (int, optional): Number of rows normalized and
+                quantized at once. Defaults to 100000.
+
+        Returns:
+            QuantizedVectors: Quantized normalized vectors.
+        """
+
+    @abc.abstractmethod
+    def arrays(self):
+        """Get arrays that are saved into the export.
+
+        Returns:
+            dict: Arrays by name.
+        """
+
+    @abc.abstractmethod
+    def decode(self, key):
+        """Decode rows into float32 vectors without normalizing them.
+
+        Args:
+            key (int, slice or list): Rows to decode.
+
+        Returns:
+            numpy.ndarray: Decoded vectors.
+        """
+
+    def dequantize(self, key):
+        """Dequantize rows into float32 vectors with their original norms.
+
+        Args:
+            key (int, slice or list): Rows to dequantize.
+
+        Returns:
+            numpy.ndarray: Dequantized vectors.
+        """
+        return self[key] * self.norms[key, None].astype(np.float32)
+
+    def scores(self, queries, start, end):
+        """Calculate cosine similarities of queries with a range of rows.
+
+        Args:
+            queries (numpy.ndarray): Normalized query vectors.
+            start (int): First row.
+            end (int): End of rows, exclusive.
+
+        Returns:
+            numpy.ndarray: Similarities of shape (number of queries, rows).
+        """
+        return queries @ self[start:end].T
+
+    def save(self, filepath):
+        """Save the quantized vectors.
+
+        Args:
+            filepath (str): Filepath ending with '.npz'.
+        """
+        np.savez(filepath, kind=self.kind, **self.arrays())
+
+
+class Float16Vectors(QuantizedVectors):
+    """Normalized word vectors as half precision floats.
+
+    Args:
+        vectors (numpy.ndarray): float16 vectors.
+        norms (numpy.ndarray): Norms of the original vectors.
+    """
+
+    kind = 'float16'
+
+    def __init__(self, vectors, norms):
+        super().__init__(norms)
+        self.vectors = vectors
+
+    @classmethod
+    def encode(cls, vectors, norms, rows_per_block=100000):
+        out = np.empty(vectors.shape, dtype=np.float16)
+        for start in range(0, len(vectors), rows_per_block):
+            out[start:start + rows_per_block] = normalize_rows(
+                vectors[start:start + rows_per_block])
+        return cls(out, norms)
+
+    def arrays(self):
+        return {'vectors': self.vectors, 'norms': self.norms}
+
+    def decode(self, key):
+        return self.vectors[key].astype(np.float32)
+
+
+class Int8Vectors(QuantizedVectors):
+    """Normalized word vectors as int8 codes with a scale per dimension.
+
+    Args:
+        codes (numpy.ndarray): int8 codes.
+        scale (numpy.ndarray): float32 scale of each dimension.
+        norms (numpy.ndarray): Norms of the original vectors.
+    """
+
+    kind = 'int8'
+
+    def __init__(self, codes, scale, norms):
+        super().__init__(norms)
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def encode(cls, vectors, norms, rows_per_block=100000):
+        max_abs = np.zeros(vectors.shape[1], dtype=np.float32)
+        for start in range(0, len(vectors), rows_per_block):
+            block = normalize_rows(vectors[start:start + rows_per_block])
+            np.maximum(max_abs, np.abs(block).max(axis=0), out=max_abs)
+        scale = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), rows_per_block):
+            block = normalize_rows(vectors[start:start + rows_per_block])
+            codes[start:start + len(block)] = np.clip(
+                np.rint(block / scale), -127, 127)
+        return cls(codes, scale, norms)
+
+    def arrays(self):
+        return {'codes': self.codes, 'scale': self.scale,
+                'norms': self.norms}
+
+    def decode(self, key):
+        return self.codes[key].astype(np.float32) * self.scale
+
+
+class PQVectors(QuantizedVectors):
+    """Normalized word vectors as product quantization codes.
+
+    Similarities are computed directly on the codes with a lookup table of
+    query-centroid inner products per subvector.
+
+    Args:
+        codes (numpy.ndarray): uint8 codes, one column per subvector.
+        codebooks (numpy.ndarray): float32 centroids of shape (number of
+            subvectors, number of centroids, subvector dimension).
+        code_norms (numpy.ndarray): Norms of the decoded vectors.
+        norms (numpy.ndarray): Norms of the original vectors.
+    """
+
+    kind = 'pq'
+
+    def __init__(self, codes, codebooks, code_norms, norms):
+        super().__init__(norms)
+        self.codes = codes
+        self.codebooks = codebooks
+        self.code_norms = code_norms
+
+    @classmethod
+    def encode(cls, vectors, norms, n_subvectors=None, n_iter=20,
+               rows_per_block=100000, seed=0):
+        dim = vectors.shape[1]
+        if n_subvectors is None:
+            n_subvectors = max((m for m in range(1, dim + 1)
+                                if dim % m == 0 and dim // m >= 4),
+                               default=1)
+        if dim % n_subvectors:
+            raise ValueError(f'Dimension {dim} is not divisible by '
+                             f'{n_subvectors} subvectors!')
+        dsub = dim // n_subvectors
+
+        # Codebooks are trained on a normalized random sample of 256 rows
+        # per centroid
+        rng = np.random.RandomState(seed)
+        sample_size = min(256 * 256, len(vectors))
+        sample_idx = np.sort(rng.choice(len(vectors), sample_size,
+                                        replace=False))
+        sample = normalize_rows(vectors[sample_idx])
+        codebooks = []
+        for m in range(n_subvectors):
+            codebook = kmeans(sample[:, m * dsub:(m + 1) * dsub], 256,
+                              n_iter=n_iter, sample_size=sample_size,
+                              spherical=False, seed=seed + m)
+            codebooks.append(np.pad(codebook,
+                                    ((0, 256 - len(codebook)), (0, 0)),
+                                    mode='constant'))
+
+        codes = np.empty((len(vectors), n_subvectors), dtype=np.uint8)
+        for start in range(0, len(vectors), rows_per_block):
+            block = normalize_rows(vectors[start:start + rows_per_block])
+            for m,codebook in enumerate(codebooks):
+                codes[start:start + len(block), m] = assign_clusters(
+                    block[:, m * dsub:(m + 1) * dsub], codebook,
+                    spherical=False)
+        pq = cls(codes, np.stack(codebooks), None, norms)
+
+        pq.code_norms = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), rows_per_block):
+            block = pq.decode(slice(start, start + rows_per_block))
+            pq.code_norms[start:start + len(block)] = np.linalg.norm(block,
+                                                                     axis=1)
+        return pq
+
+    def arrays(self):
+        return {'codes': self.codes, 'codebooks': self.codebooks,
+                'code_norms': self.code_norms, 'norms': self.norms}
+
+    def decode(self, key):
+        codes = self.codes[key]
+        n_subvectors = self.codebooks.shape[0]
+        decoded = self.codebooks[np.arange(n_subvectors), codes]
+        return decoded.reshape(codes.shape[:-1] + (-1,))
+
+    def scores(self, queries, start, end):
+        n_subvectors, _, dsub = self.codebooks.shape
+        tables = np.einsum('qmd,mkd->mqk',
+                           queries.reshape(len(queries), n_subvectors, dsub),
+                           self.codebooks)
+        codes = self.codes[start:end]
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for m in range(n_subvectors):
+            scores += tables[m][:, codes[:, m]]
+        code_norms = self.code_norms[start:end]
+        return scores / np.where(code_norms > 0, code_norms, 1)
+
+
+QUANTIZED_CLASSES = {
+    'float16': Float16Vectors,
+    'int8': Int8Vectors,
+    'pq': PQVectors
+}
+
+
+class QuantizedIndex(SimilarityIndex):
+    """Similarity queries over quantized word vectors.
+
+    Same as query.SimilarityIndex, but scores are computed with 'scores' of
+    the quantized vectors, which works directly on the codes for 'pq'.
+    """
+
+    def block_scores(self, queries, start, end):
+        return self.vectors.scores(queries, start, end)
+
+
+def quantize_vectors(vectors, kind, **kwargs):
+    """Quantize word vectors.
+
+    Args:
+        vectors (numpy.ndarray): Word vectors, may be memory-mapped.
+        kind (str): One of 'float16', 'int8' or 'pq'.
+        **kwargs: Keyword arguments passed to 'encode' of the kind, such as
+            'n_subvectors' for 'pq'.
+
+    Returns:
+        QuantizedVectors: Quantized normalized vectors.
+
+    Raises:
+        ValueError: If kind is not supported.
+    """
+    if kind not in QUANTIZED_CLASSES:
+        raise ValueError(f'Unknown quantization "{kind}", should be in '
+                         f'{QUANTIZATION_KINDS}!')
+    norms = np.empty(len(vectors), dtype=np.float16)
+    for start in range(0, len(vectors), 100000):
+        block = np.asarray(vectors[start:start + 100000], dtype=np.float32)
+        norms[start:start + len(block)] = np.linalg.norm(block, axis=1)
+    return QUANTIZED_CLASSES[kind].encode(vectors, norms, **kwargs)
+
+
+def get_quantized_filepath(filepath, kind):
+    """Get filepath of a quantized export of a word2vec format file.
+
+    Args:
+        filepath (str): Path to a word2vec format file, such as
+            'fasttext.fi.all.1045M.100d.bin.gz'.
+        kind (str): One of 'float16', 'int8' or 'pq'.
+
+    Returns:
+        str: Path like 'fasttext.fi.all.1045M.100d.int8.npz'.
+    """
+    return re.sub(r'\.(bin|vec)(\.gz|\.zst)?$', '', filepath) + f'.{kind}.npz'
+
+
+def load_quantized_vectors(filepath):
+    """Load quantized vectors saved with 'QuantizedVectors.save'.
+
+    Args:
+        filepath (str): Filepath of the export.
+
+    Returns:
+        QuantizedVectors: Loaded vectors.
+    """
+    with np.load(filepath) as data:
+        arrays = {name: data[name] for name in data.files}
+    kind = str(arrays.pop('kind'))
+    return QUANTIZED_CLASSES[kind](**arrays)
+
+
+def load_quantized_index(filepath, kind):
+    """Load quantized export of a word2vec format file for queries.
+
+    Args:
+        filepath (str): Path to the word2vec format file, with a bundle next
+            to it.
+        kind (str): One of 'float16', 'int8' or 'pq'.
+
+    Returns:
+        QuantizedIndex: Index over the quantized vectors.
+    """
+    bundle = load_bundle(get_bundle_dir(filepath))
+    vectors = load_quantized_vectors(get_quantized_filepath(filepath, kind))
+    return QuantizedIndex(vectors, bundle.index, bundle.word)
+
+
+def evaluate_quantization(exact, quantized, n_queries=1000, k=10, seed=0):
+    """Compare quantized vectors against float32 vectors.
+
+    Args:
+        exact (query.SimilarityIndex): Index over float32 vectors.
+        quantized (QuantizedIndex): Index over quantized vectors of the same
+            words.
+        n_queries (int, optional): Number of random query words. Defaults to
+            1000.
+        k (int, optional): Number of neighbors. Defaults to 10.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict: Report with 'float32_bytes', 'quantized_bytes',
+            'compression_ratio', mean neighbor overlap@k 'overlap' and mean
+            and max absolute error of cosine similarities 'mean_abs_error'
+            and 'max_abs_error' against the same random neighbors.
+    """
+    rng = np.random.RandomState(seed)
+    query_idx = np.sort(rng.choice(len(exact), min(n_queries, len(exact)),
+                                   replace=False))
+    exclude = [[i] for i in query_idx.tolist()]
+    queries = np.asarray(exact.vectors[query_idx])
+
+    exact_idx, exact_scores = exact.top_k(queries, k=k, exclude=exclude)
+    quant_idx, _ = quantized.top_k(queries, k=k, exclude=exclude)
+    overlap = np.mean([len(np.intersect1d(a, e)) / k
+                       for a,e in zip(quant_idx, exact_idx)])
+
+    # Similarity errors on exact neighbors and random pairs
+    pair_idx = np.concatenate([exact_idx.ravel(),
+                               rng.randint(len(exact), size=exact_idx.size)])
+    query_rows = np.concatenate([np.repeat(query_idx, k)] * 2)
+    errors = np.abs(
+        np.einsum('ij,ij->i', np.asarray(exact.vectors[query_rows]),
+                  np.asarray(exact.vectors[pair_idx]))
+        - np.einsum('ij,ij->i', quantized.vectors[query_rows.tolist()],
+                    quantized.vectors[pair_idx.tolist()]))
+
+    float32_bytes = len(exact) * exact.vectors.shape[1] * 4
+    report = {
+        'kind': quantized.vectors.kind,
+        'float32_bytes': float32_bytes,
+        'quantized_bytes': quantized.vectors.nbytes,
+        'compression_ratio': float32_bytes / quantized.vectors.nbytes,
+        'k': k,
+        'overlap': float(overlap),
+        'mean_abs_error': float(errors.mean()),
+        'max_abs_error': float(errors.max())
+    }
+    logger.info(f'{report["kind"]}: {report["compression_ratio"]:.1f}x '
+                f'smaller, overlap@{k} {overlap:.3f}, mean similarity error '
+                f'{report["mean_abs_error"]:.4f}')
+    return report
+
+
+def export_quantized(filepath, kind, evaluate=True, **kwargs):
+    """Save quantized export of word vectors exported with a bundle.
+
+    The export is saved next to the word2vec format file, and the report of
+    memory saved and accuracy lost next to it with '.json' extension.
+
+    Args:
+        filepath (str): Path to a word2vec format file, such as
+            'fasttext.fi.all.1045M.100d.bin.gz', with a bundle next to it.
+        kind (str): One of 'float16', 'int8' or 'pq'.
+        evaluate (bool, optional): Whether to write the report. Defaults to
+            True.
+        **kwargs: Keyword arguments passed to 'quantize_vectors'.
+
+    Returns:
+        str: Filepath of the export.
+    """
+    start_time = time.perf_counter()
+    bundle = load_bundle(get_bundle_dir(filepath))
+    quantized = quantize_vectors(bundle.vectors, kind, **kwargs)
+    quant_filepath = get_quantized_filepath(filepath, kind)
+    quantized.save(quant_filepath)
+    logger.info(f'Saved {kind} vectors into "{quant_filepath}" in '
+                f'{time.perf_counter() - start_time:.0f} seconds')
+    if evaluate:
+        exact = SimilarityIndex.from_bundle(get_bundle_dir(filepath))
+        report = evaluate_quantization(
+            exact, QuantizedIndex(quantized, exact.index, exact.word))
+        report_filepath = re.sub(r'\.npz$', '.json', quant_filepath)
+        with open(report_filepath, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+    return quant_filepath
@@ -0,0 +1,472 @@
+"""Module for batched similarity queries over exported word embeddings."""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import copy
+import hashlib
+import os
+import threading
+import time
+import ujson as json
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from bundle import load_bundle
+
+
+def normalize_rows(x):
+    """Scale rows of a matrix into unit length.
+
+    Args:
+        x (numpy.ndarray): Matrix to normalize.
+
+    Returns:
+        numpy.ndarray: Normalized float32 matrix. Rows of zeros are kept as is.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
+
+
+def normalize_in_blocks(vectors, out, rows_per_block=100000):
+    """Normalize rows of a possibly memory-mapped matrix block by block.
+
+    Args:
+        vectors (numpy.ndarray): Matrix to normalize.
+        out (numpy.ndarray): Output matrix of the same shape.
+        rows_per_block (int, optional): Number of rows normalized at once.
+            Defaults to 100000.
+    """
+    for start in range(0, len(vectors), rows_per_block):
+        end = start + rows_per_block
+        out[start:end] = normalize_rows(vectors[start:end])
+
+
+def is_valid_cache(filepath, vectors_filepath, shape):
+    """Check whether an array cached from vectors is up to date.
+
+    Args:
+        filepath (str): Path to the cached '.npy' array.
+        vectors_filepath (str): Path to the '.npy' vectors it was built from.
+        shape (tuple): Expected shape of the cached array.
+
+    Returns:
+        bool: True if the cache exists, has the expected shape and is not
+            older than the vectors, False otherwise.
+    """
+    if not os.path.exists(filepath):
+        return False
+    if os.path.getmtime(filepath) < os.path.getmtime(vectors_filepath):
+        return False
+    try:
+        cached = np.load(filepath, mmap_mode='r')
+    except ValueError:
+        return False
+    return cached.shape == tuple(shape)
+
+
+def load_normalized(vectors, norm_filepath, vectors_filepath):
+    """Memory-map normalized vectors, normalizing them into a cache first.
+
+    The cache is normalized again if it is missing, if its shape differs from
+    the vectors, or if it is older than the vectors.
+
+    Args:
+        vectors (numpy.ndarray): Vectors, may be memory-mapped.
+        norm_filepath (str): Path to the cached normalized '.npy' vectors.
+        vectors_filepath (str): Path to the file the vectors were loaded from.
+
+    Returns:
+        numpy.ndarray: Memory-mapped normalized float32 vectors.
+    """
+    if not is_valid_cache(norm_filepath, vectors_filepath, vectors.shape):
+        logger.info(f'Normalizing vectors into "{norm_filepath}"...')
+        tmp_filepath = norm_filepath + '.tmp.npy'
+        out = np.lib.format.open_memmap(
+            tmp_filepath, mode='w+', dtype=np.float32, shape=vectors.shape)
+        normalize_in_blocks(vectors, out)
+        out.flush()
+        del out
+        os.replace(tmp_filepath, norm_filepath)
+    return np.load(norm_filepath, mmap_mode='r')
+
+
+def merge_top_k(indices, scores, k):
+    """Select top k of candidate indices and scores on each row.
+
+    Args:
+        indices (numpy.ndarray): Candidate indices, one row per query.
+        scores (numpy.ndarray): Scores of the candidates.
+        k (int): Number of results per query.
+
+    Returns:
+        tuple: Two-element tuple with top k indices and scores per row, in
+            descending order of scores.
+    """
+    k = min(k, scores.shape[1])
+    rows = np.arange(len(scores))[:, None]
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        indices, scores = indices[rows, part], scores[rows, part]
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return indices[rows, order],scores[rows, order]
+
+
+class SimilarityIndex(object):
+    """Batched exact similarity queries over pre-normalized word vectors.
+
+    Queries are answered with blocked matrix-matrix products between a batch
+    of query vectors and blocks of the vocabulary, keeping only the running
+    top k per query with 'argpartition'. Memory used for scores is bounded by
+    'max_block_bytes'.
+
+    Args:
+        vectors (numpy.ndarray): Normalized float32 vectors, may be memory-
+            mapped.
+        index (callable): Function that returns index of a word, raising
+            KeyError for unknown words.
+        word (callable): Function that returns word of an index.
+        max_block_bytes (int, optional): Maximum size of a block of scores in
+            bytes. Defaults to 256 MiB.
+    """
+
+    def __init__(self, vectors, index, word, max_block_bytes=1 << 28):
+        self.vectors = vectors
+        self.index = index
+        self.word = word
+        self.max_block_bytes = max_block_bytes
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @classmethod
+    def from_bundle(cls, bundle_dir, **kwargs):
+        """Create index from a bundle, caching normalized vectors into it.
+
+        Normalized vectors are saved as 'vectors_norm.npy' in the bundle the
+        first time, and memory-mapped after that. The cache is normalized
+        again if its shape differs from the vectors, or if it is older than
+        the vectors.
+
+        Args:
+            bundle_dir (str): Directory of the bundle.
+            **kwargs: Keyword arguments passed to SimilarityIndex.
+
+        Returns:
+            SimilarityIndex: Index over the bundle.
+        """
+        bundle = load_bundle(bundle_dir)
+        vectors = load_normalized(
+            bundle.vectors, os.path.join(bundle_dir, 'vectors_norm.npy'),
+            bundle.filepath('vectors'))
+        return cls(vectors, bundle.index, bundle.word, **kwargs)
+
+    @classmethod
+    def from_keyedvectors(cls, kv, filepath=None, **kwargs):
+        """Create index from gensim KeyedVectors.
+
+        If the word vectors were loaded from 'filepath', normalized vectors are
+        cached into 'filepath' + '.norm.npy' and memory-mapped like in
+        'from_bundle', so that vectors loaded with 'mmap' are not copied into
+        memory. Otherwise, normalized vectors are kept in memory.
+
+        Args:
+            kv (gensim.models.keyedvectors.KeyedVectors): Word vectors.
+            filepath (str, optional): Path the word vectors were loaded from.
+                Defaults to None.
+            **kwargs: Keyword arguments passed to SimilarityIndex.
+
+        Returns:
+            SimilarityIndex: Index over the word vectors.
+        """
+        if filepath is None:
+            vectors = normalize_rows(kv.vectors)
+        else:
+            vectors = load_normalized(kv.vectors, filepath + '.norm.npy',
+                                      filepath)
+        return cls(vectors, lambda word: kv.vocab[word].index,
+                   kv.index2word.__getitem__, **kwargs)
+
+    def get_vectors(self, words):
+        """Get normalized vectors of words.
+
+        Args:
+            words (list): Words.
+
+        Returns:
+            numpy.ndarray: Normalized vectors, one row per word.
+
+        Raises:
+            KeyError: If a word is not in the vocabulary.
+        """
+        return self.vectors[[self.index(word) for word in words]]
+
+    def block_scores(self, queries, start, end):
+        """Calculate similarities of queries with a range of rows.
+
+        Args:
+            queries (numpy.ndarray): Query vectors.
+            start (int): First row.
+            end (int): End of rows, exclusive.
+
+        Returns:
+            numpy.ndarray: Similarities of shape (number of queries, rows).
+        """
+        return queries @ np.asarray(self.vectors[start:end]).T
+
+    def top_k(self, queries, k=10, exclude=None):
+        """Find the most similar vocabulary entries of query vectors.
+
+        Args:
+            queries (numpy.ndarray): Query vectors, one row per query. Should
+                be normalized for the scores to be cosine similarities.
+            k (int, optional): Number of results per query. Defaults to 10.
+            exclude (list, optional): Lists of indices to leave out of the
+                results, one per query. Defaults to None.
+
+        Returns:
+            tuple: Two-element tuple with arrays of indices and scores, both
+                of shape (number of queries, k), best first.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        n_queries = len(queries)
+        n_extra = max((len(e) for e in exclude), default=0) if exclude else 0
+        k_search = min(k + n_extra, len(self))
+        rows_per_block = max(self.max_block_bytes // (4 * max(n_queries, 1)),
+                             k_search)
+
+        best_idx = np.empty((n_queries, 0), dtype=np.int64)
+        best_scores = np.empty((n_queries, 0), dtype=np.float32)
+        for start in range(0, len(self), rows_per_block):
+            end = min(start + rows_per_block, len(self))
+            scores = self.block_scores(queries, start, end)
+            block_idx = np.broadcast_to(np.arange(start, end), scores.shape)
+            best_idx, best_scores = merge_top_k(
+                np.hstack([best_idx, block_idx]),
+                np.hstack([best_scores, scores]), k_search)
+
+        if exclude:
+            for i,excluded in enumerate(exclude):
+                mask = np.isin(best_idx[i], excluded)
+                best_scores[i, mask] = -np.inf
+            best_idx, best_scores = merge_top_k(best_idx, best_scores,
+                                                k_search)
+        return best_idx[:, :k],best_scores[:, :k]
+
+    def _results(self, indices, scores):
+        return [[(self.word(i), float(score))
+                 for i,score in zip(row_idx, row_scores)
+                 if score != -np.inf]
+                for row_idx,row_scores in zip(indices.tolist(),
+                                              scores.tolist())]
+
+    def most_similar(self, words, topn=10):
+        """Find the most similar words for a batch of words.
+
+        Args:
+            words (list): Query words.
+            topn (int, optional): Number of results per word. Defaults to 10.
+
+        Returns:
+            list: List of (word, similarity) -lists, one per query word, which
+                does not appear in its own results.
+        """
+        indices = [self.index(word) for word in words]
+        indices, scores = self.top_k(self.vectors[indices], k=topn,
+                                     exclude=[[i] for i in indices])
+        return self._results(indices, scores)
+
+    def most_similar_vectors(self, vectors, topn=10):
+        """Find the most similar words for a batch of vectors.
+
+        Args:
+            vectors (numpy.ndarray): Query vectors, one row per query.
+            topn (int, optional): Number of results per vector. Defaults to 10.
+
+        Returns:
+            list: List of (word, similarity) -lists, one per query vector.
+        """
+        indices, scores = self.top_k(normalize_rows(vectors), k=topn)
+        return self._results(indices, scores)
+
+    def similarity(self, pairs):
+        """Calculate cosine similarities of word pairs.
+
+        Args:
+            pairs (list): List of (word, word) -tuples.
+
+        Returns:
+            numpy.ndarray: Similarity of each pair.
+        """
+        a = self.get_vectors([pair[0] for pair in pairs])
+        b = self.get_vectors([pair[1] for pair in pairs])
+        return np.einsum('ij,ij->i', a, b)
+
+    def analogy(self, triples, topn=10):
+        """Solve analogies 'a is to b as c is to ?' for a batch of triples.
+
+        Like gensim 'most_similar(positive=[b, c], negative=[a])', the query
+        is the mean of normalized vectors, and a, b and c are left out of the
+        results.
+
+        Args:
+            triples (list): List of (a, b, c) -tuples of words.
+            topn (int, optional): Number of results per triple. Defaults to 10.
+
+        Returns:
+            list: List of (word, similarity) -lists, one per triple.
+        """
+        indices = np.array([[self.index(word) for word in triple]
+                            for triple in triples]).reshape(-1, 3)
+        vectors = self.vectors[indices.ravel()].reshape(len(indices), 3, -1)
+        queries = normalize_rows(
+            (vectors[:, 1] + vectors[:, 2] - vectors[:, 0]) / 3)
+        indices, scores = self.top_k(queries, k=topn,
+                                     exclude=indices.tolist())
+        return self._results(indices, scores)
+
+
+NEIGHBOR_FILES = {
+    'indices': 'indices.npy',
+    'scores': 'scores.npy',
+    'done': 'done.npy',
+    'meta': 'meta.json'
+}
+
+
+def get_vectors_fingerprint(vectors, rows_per_block=100000):
+    """Calculate fingerprint of word vectors from their shape and contents.
+
+    Args:
+        vectors (numpy.ndarray): Word vectors, may be memory-mapped.
+        rows_per_block (int, optional): Number of rows hashed at once.
+            Defaults to 100000.
+
+    Returns:
+        dict: Fingerprint with 'shape' and hexadecimal 'checksum'.
+    """
+    checksum = hashlib.blake2b(digest_size=16)
+    for start in range(0, len(vectors), rows_per_block):
+        block = np.asarray(vectors[start:start + rows_per_block],
+                           dtype=np.float32)
+        checksum.update(np.ascontiguousarray(block).tobytes())
+    return {'shape': list(vectors.shape), 'checksum': checksum.hexdigest()}
+
+
+def compute_neighbor_table(index, out_dir, k=10, n_words=None,
+                           rows_per_block=1024, n_threads=None,
+                           max_memory_bytes=1 << 30):
+    """Compute top k neighbors of each word into memory-mapped arrays.
+
+    Blocks of query words are processed in parallel threads, as numpy
+    releases the GIL in matrix products. Each finished block is marked in
+    'done.npy' after its results are flushed, so that an interrupted run
+    continues from the remaining blocks when called again with the same
+    parameters and vectors. Otherwise the table is computed from scratch.
+
+    Args:
+        index (SimilarityIndex): Index over the word vectors. Neighbors are
+            searched from the whole vocabulary.
+        out_dir (str): Directory of the table.
+        k (int, optional): Number of neighbors per word. Defaults to 10.
+        n_words (int, optional): Number of words to compute neighbors for,
+            from the start of the vocabulary, which are the most frequent
+            words for exported bundles. Defaults to None, which means all
+            words.
+        rows_per_block (int, optional): Number of query words in a block.
+            Defaults to 1024.
+        n_threads (int, optional): Number of threads. Defaults to None, which
+            means the number of CPUs.
+        max_memory_bytes (int, optional): Maximum size of score blocks of all
+            threads together in bytes. Defaults to 1 GiB.
+    """
+    start_time = time.perf_counter()
+    n_words = min(n_words or len(index), len(index))
+    n_threads = n_threads or os.cpu_count() or 1
+    n_blocks = -(-n_words // rows_per_block)
+    meta = {'k': k, 'n_words': n_words, 'rows_per_block': rows_per_block,
+            'vectors': get_vectors_fingerprint(index.vectors)}
+    filepaths = {name: os.path.join(out_dir, filename)
+                 for name,filename in NEIGHBOR_FILES.items()}
+
+    # Continue previous run only if it has the same parameters and vectors
+    mode = 'w+'
+    if all(os.path.exists(path) for path in filepaths.values()):
+        with open(filepaths['meta'], 'r', encoding='utf8') as f:
+            if json.load(f) == meta:
+                mode = 'r+'
+    if mode == 'w+':
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        
+        # Meta is written after the arrays, so that the blocks of an earlier
+        # table are never taken as done
+        if os.path.exists(filepaths['meta']):
+            os.remove(filepaths['meta'])
+    indices = np.lib.format.open_memmap(filepaths['indices'], mode=mode,
+                                        dtype=np.int32, shape=(n_words, k))
+    scores = np.lib.format.open_memmap(filepaths['scores'], mode=mode,
+                                       dtype=np.float16, shape=(n_words, k))
+    done = np.lib.format.open_memmap(filepaths['done'], mode=mode,
+                                     dtype=np.bool_, shape=(n_blocks,))
+    if mode == 'w+':
+        done.flush()
+        with open(filepaths['meta'], 'w', encoding='utf8') as f:
+            json.dump(meta, f, indent=2)
+    todo = np.flatnonzero(~done).tolist()
+    logger.info(f'Computing {k} neighbors of {n_words} words in '
+                f'{len(todo)}/{n_blocks} blocks...')
+
+    thread_index = copy.copy(index)
+    thread_index.max_block_bytes = max(max_memory_bytes // n_threads, 1 << 20)
+    lock = threading.Lock()
+
+    def process_block(block):
+        start = block * rows_per_block
+        end = min(start + rows_per_block, n_words)
+        rows = list(range(start, end))
+        block_idx, block_scores = thread_index.top_k(
+            np.asarray(index.vectors[start:end]), k=k,
+            exclude=[[i] for i in rows])
+        indices[start:end] = block_idx
+        scores[start:end] = block_scores
+        with lock:
+            indices.flush()
+            scores.flush()
+            done[block] = True
+            done.flush()
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for i,_ in enumerate(executor.map(process_block, todo)):
+            if (i + 1) % 100 == 0:
+                logger.info(f'{i + 1}/{len(todo)} blocks done')
+    logger.info(f'Neighbors computed in '
+                f'{time.perf_counter() - start_time:.0f} seconds!')
+
+
+def load_neighbor_table(out_dir):
+    """Load memory-mapped table computed with 'compute_neighbor_table'.
+
+    Args:
+        out_dir (str): Directory of the table.
+
+    Returns:
+        tuple: Two-element tuple with int32 neighbor indices and float16
+            similarities, both of shape (number of words, k).
+
+    Raises:
+        ValueError: If the table is not complete.
+    """
+    done = np.load(os.path.join(out_dir, NEIGHBOR_FILES['done']))
+    if not done.all():
+        raise ValueError(f'Neighbor table "{out_dir}" is not complete, '
+                         f'{(~done).sum()} blocks missing!')
+    return (np.load(os.path.join(out_dir, NEIGHBOR_FILES['indices']),
+                    mmap_mode='r'),
+            np.load(os.path.join(out_dir, NEIGHBOR_FILES['scores']),
+                    mmap_mode='r'))
@@ -0,0 +1,293 @@
+"""Module for vectorized sentence embeddings from word vectors.
+
+Sentences are converted into ragged token ID arrays, which are token IDs of
+all sentences one after another with start offsets of the sentences, and
+pooled with numpy 'reduceat' operations chunk by chunk:
+
+* *mean*: Mean of word vectors
+* *sif*: Smooth inverse frequency weighted mean of word vectors, with weight
+  a / (a + p(word)) for word probability p(word), without removing the
+  common component
+* *max*: Elementwise maximum of word vectors
+
+Tokens outside of the vocabulary are left out, and sentences without known
+tokens get zero vectors.
+"""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import itertools
+import time
+
+import numpy as np
+
+from bundle import load_bundle
+from corpus import get_vocab, read_line_chunks
+
+
+POOLING_METHODS = ['mean', 'sif', 'max']
+
+
+def to_ragged_ids(sentences, word2id):
+    """Convert tokenized sentences into a ragged token ID array.
+
+    Args:
+        sentences (list): Sentences as lists of tokens.
+        word2id (dict): Token IDs by token.
+
+    Returns:
+        tuple: Two-element tuple with int64 token IDs of all sentences, and
+            start offset of each sentence plus the end. Unknown tokens are
+            left out.
+    """
+    lengths = np.fromiter(map(len, sentences), dtype=np.int64,
+                          count=len(sentences))
+    ids = np.fromiter(map(word2id.get, itertools.chain.from_iterable(sentences),
+                          itertools.repeat(-1)),
+                      dtype=np.int64, count=int(lengths.sum()))
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # Leave unknown tokens out
+    known = ids >= 0
+    if not known.all():
+        offsets = np.concatenate([[0], np.cumsum(known)])[offsets]
+        ids = ids[known]
+    return ids,offsets
+
+
+def to_padded_ids(sentences, word2id, max_len=None, pad_id=-1):
+    """Convert tokenized sentences into a padded token ID matrix.
+
+    Args:
+        sentences (list): Sentences as lists of tokens.
+        word2id (dict): Token IDs by token.
+        max_len (int, optional): Maximum number of tokens per sentence, longer
+            sentences are truncated. Defaults to None, which means the length
+            of the longest sentence.
+        pad_id (int, optional): Token ID of padding. Defaults to -1.
+
+    Returns:
+        tuple: Two-element tuple with int64 token ID matrix of shape (number
+            of sentences, max_len) and number of known tokens per sentence.
+    """
+    ids, offsets = to_ragged_ids(sentences, word2id)
+    lengths = np.diff(offsets)
+    if max_len is None:
+        max_len = int(lengths.max()) if len(lengths) else 0
+    lengths = np.minimum(lengths, max_len)
+    padded = np.full((len(sentences), max_len), pad_id, dtype=np.int64)
+    mask = np.arange(max_len) < lengths[:, None]
+    positions = offsets[:-1, None] + np.arange(max_len)
+    padded[mask] = ids[positions[mask]]
+    return padded,lengths
+
+
+def get_sif_weights(counts, a=1e-3):
+    """Get smooth inverse frequency weights of words.
+
+    Args:
+        counts (numpy.ndarray): Counts of words by token ID.
+        a (float, optional): Smoothing parameter. Defaults to 1e-3.
+
+    Returns:
+        numpy.ndarray: float32 weight a / (a + p(word)) of each word.
+    """
+    probs = counts / max(counts.sum(), 1)
+    return (a / (a + probs)).astype(np.float32)
+
+
+def pool_ragged(vectors, ids, offsets, method='mean', weights=None):
+    """Pool word vectors of sentences in a ragged token ID array.
+
+    Args:
+        vectors (numpy.ndarray): Word vectors by token ID, may be
+            memory-mapped.
+        ids (numpy.ndarray): Token IDs of all sentences one after another.
+        offsets (numpy.ndarray): Start offset of each sentence plus the end.
+        method (str, optional): One of 'mean', 'sif' or 'max'. Defaults to
+            'mean'.
+        weights (numpy.ndarray, optional): Weights by token ID, required for
+            'sif'. Defaults to None.
+
+    Returns:
+        numpy.ndarray: float32 sentence vectors, one row per sentence.
+
+    Raises:
+        ValueError: If method is not supported or weights are missing.
+    """
+    if method not in POOLING_METHODS:
+        raise ValueError(f'Unknown pooling "{method}", should be in '
+                         f'{POOLING_METHODS}!')
+    if method == 'sif' and weights is None:
+        raise ValueError('Pooling "sif" requires weights!')
+
+    lengths = np.diff(offsets)
+    out = np.zeros((len(lengths), vectors.shape[1]), dtype=np.float32)
+    nonempty = lengths > 0
+    if not nonempty.any():
+        return out
+
+    # Empty sentences are skipped, since 'reduceat' would not leave them empty
+    starts = offsets[:-1][nonempty] - offsets[0]
+    token_vectors = np.asarray(vectors[ids], dtype=np.float32)
+    if method == 'max':
+        out[nonempty] = np.maximum.reduceat(token_vectors, starts)
+        return out
+    if method == 'sif':
+        token_vectors *= weights[ids][:, None]
+    out[nonempty] = (np.add.reduceat(token_vectors, starts)
+                     / lengths[nonempty][:, None])
+    return out
+
+
+class SentenceEncoder(object):
+    """Batched sentence embeddings from word vectors.
+
+    Args:
+        vectors (numpy.ndarray): Word vectors by token ID, may be
+            memory-mapped.
+        words (list): Words by token ID.
+        counts (numpy.ndarray, optional): Word counts by token ID, used for
+            'sif' pooling. Defaults to None.
+        sif_a (float, optional): Smoothing parameter of 'sif' pooling.
+            Defaults to 1e-3.
+    """
+
+    def __init__(self, vectors, words, counts=None, sif_a=1e-3):
+        self.vectors = vectors
+        self.word2id = {word: i for i,word in enumerate(words)}
+        self.weights = None
+        if counts is not None:
+            self.weights = get_sif_weights(counts, a=sif_a)
+
+    @classmethod
+    def from_bundle(cls, bundle_dir, sentlines_path=None, **kwargs):
+        """Create encoder over word vectors of a bundle.
+
+        Args:
+            bundle_dir (str): Directory of the bundle.
+            sentlines_path (str, optional): Sentence lines file that the
+                vectors were trained on, whose shared vocabulary gives the
+                word counts for 'sif' pooling. Defaults to None.
+            **kwargs: Keyword arguments passed to SentenceEncoder.
+
+        Returns:
+            SentenceEncoder: Encoder of the bundle.
+        """
+        bundle = load_bundle(bundle_dir)
+        words = bundle.words
+        counts = None
+        if sentlines_path is not None:
+            vocab_words, vocab_counts, _ = get_vocab(sentlines_path)
+            word_counts = dict(zip(vocab_words, vocab_counts.tolist()))
+            counts = np.array([word_counts.get(word, 0) for word in words],
+                              dtype=np.int64)
+        return cls(bundle.vectors, words, counts=counts, **kwargs)
+
+    def encode(self, sentences, method='mean', sents_per_chunk=10000,
+               out=None):
+        """Compute sentence vectors chunk by chunk.
+
+        Args:
+            sentences (list): Sentences as lists of tokens.
+            method (str, optional): One of 'mean', 'sif' or 'max'. Defaults
+                to 'mean'.
+            sents_per_chunk (int, optional): Number of sentences pooled at
+                once. Defaults to 10000.
+            out (numpy.ndarray, optional): Output matrix, such as a memory-
+                mapped one. Defaults to None, which means a new array.
+
+        Returns:
+            numpy.ndarray: float32 sentence vectors, one row per sentence.
+        """
+        if out is None:
+            out = np.empty((len(sentences), self.vectors.shape[1]),
+                           dtype=np.float32)
+        for start in range(0, len(sentences), sents_per_chunk):
+            chunk = sentences[start:start + sents_per_chunk]
+            ids, offsets = to_ragged_ids(chunk, self.word2id)
+            out[start:start + len(chunk)] = pool_ragged(
+                self.vectors, ids, offsets, method=method,
+                weights=self.weights)
+        return out
+
+
+def count_lines(filepath):
+    """Count lines of a file.
+
+    Args:
+        filepath (str): Filepath.
+
+    Returns:
+        int: Number of lines, including a last line without a newline.
+    """
+    n_lines = 0
+    data = b''
+    with open(filepath, 'rb') as f:
+        for data in iter(lambda: f.read(1 << 24), b''):
+            n_lines += data.count(b'\n')
+    if data and not data.endswith(b'\n'):
+        n_lines += 1
+    return n_lines
+
+
+def encode_sentlines(sentlines_path, bundle_dir, out_filepath, method='mean',
+                     lines_per_chunk=10000, log_interval=10):
+    """Compute vectors of all sentences of a sentence lines file.
+
+    Sentences are streamed from the file into a memory-mapped float32 matrix
+    with one row per line.
+
+    Args:
+        sentlines_path (str): Filepath of sentence lines file, as produced by
+            'preprocess.preprocess_all_files'.
+        bundle_dir (str): Directory of the bundle of word vectors.
+        out_filepath (str): Filepath of the output matrix ('.npy').
+        method (str, optional): One of 'mean', 'sif' or 'max'. Defaults to
+            'mean'.
+        lines_per_chunk (int, optional): Number of lines pooled at once.
+            Defaults to 10000.
+        log_interval (int, optional): Seconds between progress logs. Defaults
+            to 10.
+
+    Returns:
+        float: Sentences per second.
+    """
+    start_time = time.perf_counter()
+    encoder = SentenceEncoder.from_bundle(
+        bundle_dir, sentlines_path=sentlines_path if method == 'sif' else None)
+    n_sents = count_lines(sentlines_path)
+    out = np.lib.format.open_memmap(
+        out_filepath, mode='w+', dtype=np.float32,
+        shape=(n_sents, encoder.vectors.shape[1]))
+
+    n_done = 0
+    last_log_time = time.perf_counter()
+    encode_start_time = time.perf_counter()
+    for lines in read_line_chunks(sentlines_path, lines_per_chunk):
+        sentences = [line.split() for line in lines]
+        encoder.encode(sentences, method=method, sents_per_chunk=len(lines),
+                       out=out[n_done:n_done + len(lines)])
+        n_done += len(lines)
+        if time.perf_counter() - last_log_time > log_interval:
+            last_log_time = time.perf_counter()
+            logger.info(f'{n_done}/{n_sents} sentences encoded, '
+                        f'{n_done / (last_log_time - encode_start_time):.0f} '
+                        'sentences/s')
+    out.flush()
+    del out
+
+    sents_per_s = n_done / (time.perf_counter() - encode_start_time)
+    logger.info(f'Encoded {n_done} sentences of "{sentlines_path}" into '
+                f'"{out_filepath}" with {method} pooling at '
+                f'{sents_per_s:.0f} sentences/s, '
+                f'{time.perf_counter() - start_time:.0f} seconds in total')
+    return sents_per_s
+
+
+if __name__ == '__main__':
+    import sys
+    encode_sentlines(*sys.argv[1:])
@@ -0,0 +1,457 @@
+"""Module for serving word vectors over local HTTP.
+
+The service loads FastText word vectors saved by
+'train.create_fasttext_embeddings' and answers the following GET requests
+with JSON:
+
+* */vector?word=koira*: Vector of a word, computed from subword n-grams for
+  words outside of the vocabulary
+* */most_similar?word=koira&topn=10*: Most similar vocabulary words
+* */stats*: OOV cache hit rate, batch sizes and latency percentiles
+
+Concurrent requests are grouped into micro-batches, which are answered with
+one vectorized query in a worker thread. Computed OOV vectors are kept in a
+bounded LRU cache.
+
+Example:
+    python serve.py ./data/embeddings/fasttext.fi.all.1045M.300d.kv
+"""
+
+
+from utils import get_logger
+logger = get_logger()
+
+import argparse
+import asyncio
+import collections
+import time
+import ujson as json
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from gensim.models.keyedvectors import FastTextKeyedVectors
+
+from query import SimilarityIndex, normalize_rows
+
+
+class LRUCache(object):
+    """Bounded cache that drops the least recently used items.
+
+    Args:
+        maxsize (int, optional): Maximum number of items. Defaults to 100000.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        """Get item and mark it as most recently used.
+
+        Args:
+            key (hashable): Key of the item.
+
+        Returns:
+            object: The item, or None if it is not cached.
+        """
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Add item, dropping the least recently used item if full.
+
+        Args:
+            key (hashable): Key of the item.
+            value (object): The item.
+        """
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        """float: Share of lookups found from the cache."""
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class LatencyStats(object):
+    """Latencies of the most recent requests by endpoint.
+
+    Args:
+        maxlen (int, optional): Number of latencies kept per endpoint.
+            Defaults to 10000.
+    """
+
+    def __init__(self, maxlen=10000):
+        self.latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=maxlen))
+        self.counts = collections.Counter()
+
+    def add(self, endpoint, seconds):
+        self.latencies[endpoint].append(seconds)
+        self.counts[endpoint] += 1
+
+    def summary(self):
+        """Get request counts and latency percentiles in milliseconds.
+
+        Returns:
+            dict: Statistics by endpoint.
+        """
+        summary = {}
+        for endpoint,latencies in self.latencies.items():
+            p50, p90, p99 = np.percentile(np.array(latencies) * 1000,
+                                          [50, 90, 99])
+            summary[endpoint] = {'count': self.counts[endpoint],
+                                 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+        return summary
+
+
+class MicroBatcher(object):
+    """Group concurrent requests into batches processed in a thread.
+
+    Requests that arrive while a batch is being processed, or within
+    'max_wait' seconds of the first request of a batch, are processed
+    together.
+
+    Args:
+        func (callable): Function that takes a list of requests and returns a
+            list of results in the same order.
+        max_batch_size (int, optional): Maximum number of requests in a
+            batch. Defaults to 256.
+        max_wait (float, optional): Maximum time to wait for more requests in
+            seconds. Defaults to 0.002.
+        executor (concurrent.futures.Executor, optional): Executor of the
+            batches. Defaults to None, which means the default executor of
+            the event loop.
+    """
+
+    def __init__(self, func, max_batch_size=256, max_wait=0.002,
+                 executor=None):
+        self.func = func
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.n_batches = 0
+        self.n_requests = 0
+
+    async def submit(self, request):
+        """Submit request and wait for its result.
+
+        Args:
+            request (object): Request passed to 'func'.
+
+        Returns:
+            object: Result of the request.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def run(self):
+        """Process batches until cancelled."""
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0 and self.queue.empty():
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(
+                        self.queue.get(), max(timeout, 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            self.n_batches += 1
+            self.n_requests += len(batch)
+            requests = [request for request,_ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.func,
+                                                     requests)
+            except Exception as e:
+                for _,future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_,future),result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    @property
+    def mean_batch_size(self):
+        """float: Mean number of requests per batch."""
+        return self.n_requests / max(self.n_batches, 1)
+
+
+class EmbeddingService(object):
+    """Batched word vector and similarity queries of FastText word vectors.
+
+    Args:
+        kv (gensim.models.keyedvectors.FastTextKeyedVectors): Word vectors.
+        filepath (str, optional): Path the word vectors were loaded from,
+            next to which normalized vectors are cached and memory-mapped.
+            If None, normalized vectors are kept in memory. Defaults to None.
+        cache_size (int, optional): Maximum number of cached OOV vectors.
+            Defaults to 100000.
+        max_batch_size (int, optional): Maximum number of requests in a
+            batch. Defaults to 256.
+        max_wait (float, optional): Maximum time to wait for more requests in
+            seconds. Defaults to 0.002.
+    """
+
+    def __init__(self, kv, filepath=None, cache_size=100000,
+                 max_batch_size=256, max_wait=0.002):
+        self.kv = kv
+        self.index = SimilarityIndex.from_keyedvectors(kv, filepath)
+        self.cache = LRUCache(cache_size)
+        self.latency = LatencyStats()
+
+        # Batches are processed one at a time, as the cache is not thread-safe
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.batchers = {
+            'vector': MicroBatcher(self.get_vectors, max_batch_size,
+                                   max_wait, executor),
+            'most_similar': MicroBatcher(self.most_similar, max_batch_size,
+                                         max_wait, executor)
+        }
+
+    def get_vectors(self, words):
+        """Get vectors of words, computing OOV vectors from n-grams.
+
+        Args:
+            words (list): Words.
+
+        Returns:
+            list: Vectors as numpy arrays, or None for words without known
+                n-grams.
+        """
+        vectors = [None] * len(words)
+        for i,word in enumerate(words):
+            vocab = self.kv.vocab.get(word)
+            if vocab is not None:
+                vectors[i] = self.kv.vectors[vocab.index]
+                continue
+            vector = self.cache.get(word)
+            if vector is None:
+                try:
+                    vector = self.kv.word_vec(word)
+                except KeyError:
+                    continue
+                self.cache.put(word, vector)
+            vectors[i] = vector
+        return vectors
+
+    def most_similar(self, requests):
+        """Find most similar vocabulary words for a batch of requests.
+
+        Requests are grouped by 'topn' rounded up to a power of two, and each
+        group is queried separately, so that a request with a large 'topn'
+        does not slow down the other requests of the batch.
+
+        Args:
+            requests (list): List of (word, topn) -tuples.
+
+        Returns:
+            list: List of (word, similarity) -lists, or None for words
+                without known n-grams.
+        """
+        words = [word for word,_ in requests]
+        vectors = self.get_vectors(words)
+        results = [None] * len(requests)
+        groups = collections.defaultdict(list)
+        for i,(word, topn) in enumerate(requests):
+            if vectors[i] is not None:
+                groups[1 << (topn - 1).bit_length()].append(i)
+
+        for group in groups.values():
+            topn = max(requests[i][1] for i in group)
+            exclude = [[self.kv.vocab[words[i]].index]
+                       if words[i] in self.kv.vocab else [] for i in group]
+            indices, scores = self.index.top_k(
+                normalize_rows(np.stack([vectors[i] for i in group])),
+                k=topn, exclude=exclude)
+            for i,row_idx,row_scores in zip(group, indices.tolist(),
+                                            scores.tolist()):
+                results[i] = [(self.kv.index2word[j], score) for j,score
+                              in zip(row_idx, row_scores)
+                              if score != -np.inf][:requests[i][1]]
+        return results
+
+    def stats(self):
+        """Get service statistics.
+
+        Returns:
+            dict: Cache hit rate and size, mean batch sizes and latency
+                percentiles by endpoint.
+        """
+        return {
+            'cache': {'hit_rate': self.cache.hit_rate,
+                      'hits': self.cache.hits,
+                      'misses': self.cache.misses,
+                      'size': len(self.cache)},
+            'batches': {name: {'count': batcher.n_batches,
+                               'mean_size': batcher.mean_batch_size}
+                        for name,batcher in self.batchers.items()},
+            'latency': self.latency.summary()
+        }
+
+    async def handle(self, path, params):
+        """Answer a request.
+
+        Args:
+            path (str): Path of the request.
+            params (dict): Query parameters.
+
+        Returns:
+            tuple: Two-element tuple with HTTP status code and JSON
+                serializable response.
+        """
+        if path == '/stats':
+            return 200,self.stats()
+        if path not in ('/vector', '/most_similar'):
+            return 404,{'error': f'Unknown path "{path}"'}
+        if 'word' not in params:
+            return 400,{'error': 'Parameter "word" is required'}
+
+        word = params['word'][0]
+        if path == '/vector':
+            vector = await self.batchers['vector'].submit(word)
+            if vector is None:
+                return 404,{'error': f'No vector for "{word}"'}
+            return 200,{'word': word, 'oov': word not in self.kv.vocab,
+                        'vector': vector.tolist()}
+
+        try:
+            topn = int(params.get('topn', ['10'])[0])
+        except ValueError:
+            return 400,{'error': 'Parameter "topn" should be an integer'}
+        if not 1 <= topn <= len(self.index):
+            return 400,{'error': 'Parameter "topn" should be between 1 and '
+                                 f'{len(self.index)}'}
+        if word in self.kv.vocab:
+            # A vocabulary word is not its own neighbor
+            topn = min(topn, len(self.index) - 1)
+        result = await self.batchers['most_similar'].submit((word, topn))
+        if result is None:
+            return 404,{'error': f'No vector for "{word}"'}
+        return 200,{'word': word, 'most_similar': result}
+
+    async def handle_connection(self, reader, writer):
+        """Serve HTTP/1.1 requests of a keep-alive connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get('content-length', 0)):
+                    await reader.readexactly(int(headers['content-length']))
+
+                start_time = time.perf_counter()
+                try:
+                    method, target, _ = request_line.decode('latin1').split()
+                except ValueError:
+                    break
+                url = urlsplit(target)
+                if method != 'GET':
+                    status, response = 405,{'error': 'Only GET is supported'}
+                else:
+                    try:
+                        status, response = await self.handle(
+                            url.path, parse_qs(url.query))
+                    except Exception:
+                        logger.exception(f'Failed to answer "{target}"')
+                        status, response = 500,{'error': 'Internal error'}
+                self.latency.add(url.path, time.perf_counter() - start_time)
+
+                body = json.dumps(response,
+                                  escape_forward_slashes=False).encode('utf8')
+                writer.write(
+                    f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}'
+                    f'\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(body)}\r\n\r\n'.encode('latin1')
+                    + body)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """Serve requests until cancelled.
+
+        Args:
+            host (str, optional): Host to listen on. Defaults to '127.0.0.1'.
+            port (int, optional): Port to listen on. Defaults to 8000.
+        """
+        tasks = [asyncio.ensure_future(batcher.run())
+                 for batcher in self.batchers.values()]
+        server = await asyncio.start_server(self.handle_connection, host,
+                                            port)
+        logger.info(f'Serving {len(self.kv.vocab)} words on '
+                    f'http://{host}:{port}')
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+            for task in tasks:
+                task.cancel()
+
+
+def load_service(filepath, **kwargs):
+    """Load word vectors saved by 'train.create_fasttext_embeddings'.
+
+    Args:
+        filepath (str): Path to the saved FastText word vectors ('.kv').
+        **kwargs: Keyword arguments passed to EmbeddingService.
+
+    Returns:
+        EmbeddingService: Service of the word vectors.
+    """
+    start_time = time.perf_counter()
+    kv = FastTextKeyedVectors.load(filepath, mmap='r')
+    logger.info(f'Loaded "{filepath}" in '
+                f'{time.perf_counter() - start_time:.1f} seconds')
+    return EmbeddingService(kv, filepath, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('filepath', help='Path to FastText word vectors')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-size', type=int, default=100000)
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2)
+    args = parser.parse_args()
+
+    service = load_service(args.filepath, cache_size=args.cache_size,
+                           max_batch_size=args.max_batch_size,
+                           max_wait=args.max_wait_ms / 1000)
+    asyncio.run(service.serve(args.host, args.port))
@@ -5,14 +5,22 @@ from utils import get_logger
 logger = get_logger()
 
 import glob
-import gzip
 import os
-import shutil
 import time
 
+import numpy as np
+
 from gensim.models import Word2Vec,FastText
 from gensim.models.word2vec import LineSentence
 
+from ann import build_ann_index
+from bundle import BundleWriter, get_bundle_dir
+from compress import open_compressed
+from corpus import get_token_corpus, get_vocab
+from metrics import Stage
+from quantize import export_quantized
+from query import SimilarityIndex, compute_neighbor_table
+
 
 def get_out_filepaths(in_filepath, out_dir, model_name, size, n_tokens):
     """Get output filepaths for word embeddings based on model parameters.
@@ -35,104 +43,406 @@ def get_out_filepaths(in_filepath, out_dir, model_name, size, n_tokens):
     return f'{out_filepath}.bin',f'{out_filepath}.vec'
 
 
-def gzip_file(filepath, remove_original=True):
-    """Gzip compress given file.
+def get_sorted_words(wv):
+    """Get words of word vectors with the most frequent words first.
+    
+    Args:
+        wv (gensim.models.keyedvectors.KeyedVectors): Word vectors.
+    
+    Returns:
+        list: Words in descending order of counts.
+    """
+    return sorted(wv.vocab, key=lambda word: -wv.vocab[word].count)
+
+
+def write_word2vec_format(fout, wv, binary=True, rows_per_block=10000):
+    """Write word vectors in word2vec format into a binary file-like object.
+    
+    Output is identical to 'KeyedVectors.save_word2vec_format', but it is
+    written in blocks of rows into any writer, such as a compressing one.
+    
+    Args:
+        fout (file): Binary file-like object with 'write' -method.
+        wv (gensim.models.keyedvectors.KeyedVectors): Word vectors to write.
+        binary (bool, optional): Whether to write in binary or text format.
+            Defaults to True.
+        rows_per_block (int, optional): Number of rows converted at once.
+            Defaults to 10000.
+    """
+    words = get_sorted_words(wv)
+    fout.write(f'{len(words)} {wv.vectors.shape[1]}\n'.encode('utf8'))
+    for start in range(0, len(words), rows_per_block):
+        block_words = words[start:start + rows_per_block]
+        indices = [wv.vocab[word].index for word in block_words]
+        rows = wv.vectors[indices].astype(np.float32)
+        if binary:
+            fout.write(b''.join(word.encode('utf8') + b' ' + row.tobytes()
+                                for word,row in zip(block_words, rows)))
+        else:
+            fout.write(''.join(
+                f'{word} {" ".join(values)}\n'
+                for word,values in zip(block_words,
+                                       np.char.mod('%.9g', rows).tolist())
+            ).encode('utf8'))
+
+
+def write_bundle(bundle_dir, wv, meta=None, rows_per_block=10000):
+    """Write word vectors into a memory-mapped bundle.
+    
+    Args:
+        bundle_dir (str): Directory of the bundle.
+        wv (gensim.models.keyedvectors.KeyedVectors): Word vectors to write.
+        meta (dict, optional): Extra metadata, such as 'model' and 'n_tokens'.
+            Defaults to None.
+        rows_per_block (int, optional): Number of rows written at once.
+            Defaults to 10000.
+    """
+    words = get_sorted_words(wv)
+    with BundleWriter(bundle_dir, len(words), wv.vectors.shape[1],
+                      meta=meta) as writer:
+        for start in range(0, len(words), rows_per_block):
+            block_words = words[start:start + rows_per_block]
+            indices = [wv.vocab[word].index for word in block_words]
+            writer.write(block_words, wv.vectors[indices])
+
+
+def get_neighbors_dir(filepath):
+    """Get directory of the neighbor table of a word2vec format file.
     
     Args:
-        filepath (str): Path to file to be compressed.
-        remove_original (bool, optional): Whether to remove the original file
-            or not. Defaults to True.
+        filepath (str): Path to a word2vec format file, such as
+            'fasttext.fi.all.1045M.100d.bin.gz'.
+    
+    Returns:
+        str: Path like 'fasttext.fi.all.1045M.100d.neighbors'.
+    """
+    return get_bundle_dir(filepath)[:-len('.bundle')] + '.neighbors'
+
+
+def save_neighbor_table(filepath, n_neighbors=10, n_words=None,
+                        n_threads=None):
+    """Compute top k neighbors of words of a model exported with a bundle.
+    
+    The table is saved next to the word2vec format file as memory-mappable
+    int32 neighbor indices and float16 similarities, see
+    'query.load_neighbor_table'. Interrupted computation continues from the
+    remaining blocks.
+    
+    Args:
+        filepath (str): Path to a word2vec format file, with a bundle next to
+            it.
+        n_neighbors (int, optional): Number of neighbors per word. Defaults to
+            10.
+        n_words (int, optional): Number of most frequent words to compute
+            neighbors for. Defaults to None, which means all words.
+        n_threads (int, optional): Number of threads. Defaults to None, which
+            means the number of CPUs.
+    """
+    index = SimilarityIndex.from_bundle(get_bundle_dir(filepath))
+    neighbors_dir = get_neighbors_dir(filepath)
+    compute_neighbor_table(index, neighbors_dir, k=n_neighbors,
+                           n_words=n_words, n_threads=n_threads)
+    logger.info(f'Saved neighbor table into "{neighbors_dir}"')
+
+
+def get_model_filepath(filepath):
+    """Get filepath of FastText word vectors with subword n-grams.
+    
+    Args:
+        filepath (str): Path to a word2vec format file, such as
+            'fasttext.fi.all.1045M.100d.bin.gz'.
+    
+    Returns:
+        str: Path like 'fasttext.fi.all.1045M.100d.kv'.
     """
-    with open(filepath, 'rb') as f_in:
-        with gzip.open(f'{filepath}.gz', 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    if remove_original:
-        os.remove(filepath)
+    return get_bundle_dir(filepath)[:-len('.bundle')] + '.kv'
 
 
 def save_word_vectors(sentlines_path, out_dir, model,
-                      save_vec=False, compress=True):
+                      save_vec=False, compress=True, codec='gzip',
+                      n_threads=None, save_bundle=True, build_ann=False,
+                      quantize=(), n_neighbors=0):
     """Save word vectors of a gensim model into a directory.
     
+    Vectors are streamed directly into the compressed output, without an
+    uncompressed temporary file.
+    
     Args:
         sentlines_path (str): Filepath of input sentence lines file.
         out_dir (str): Directory to save word embeddings into.
         model (gensim.models.*): Trained gensim model.
         save_vec (bool, optional): Whether to save vectors in text format.
             Defaults to False.
-        compress (bool, optional): Whether to Gzip the output or not. Defaults
-            to True.
+        compress (bool, optional): Whether to compress the output or not.
+            Defaults to True.
+        codec (str, optional): Compression codec, either 'gzip' for standard
+            gzip compressed in parallel blocks, or 'zstd' for faster
+            compression with the optional 'zstandard' package. Defaults to
+            'gzip'.
+        n_threads (int, optional): Number of compression threads. Defaults to
+            None, which means the number of CPUs.
+        save_bundle (bool, optional): Whether to save vectors also as a
+            memory-mapped bundle, see 'bundle.load_bundle'. Defaults to True.
+        build_ann (bool, optional): Whether to build an approximate nearest
+            neighbor index next to the binary file, see
+            'ann.load_ann_index'. Requires 'save_bundle'. Defaults to False.
+        quantize (tuple, optional): Quantized exports to save next to the
+            binary file, any of 'float16', 'int8' and 'pq', see
+            'quantize.load_quantized_index'. Requires 'save_bundle'. Defaults
+            to ().
+        n_neighbors (int, optional): Number of neighbors to precompute for
+            each word, see 'save_neighbor_table'. Requires 'save_bundle'.
+            Defaults to 0, which means no neighbor table.
+    
+    Raises:
+        ValueError: If 'build_ann', 'quantize' or 'n_neighbors' is given
+            without 'save_bundle'.
     """
+    if (build_ann or quantize or n_neighbors) and not save_bundle:
+        raise ValueError('Building ANN index, quantized exports and neighbor '
+                         'table require "save_bundle"!')
     model_name = model.__class__.__name__.lower()
     n_tokens = model.corpus_total_words
     size = model.vector_size
     (out_binary_filepath,
      out_text_filepath) = get_out_filepaths(sentlines_path, out_dir,
                                             model_name, size, n_tokens)
-    model.wv.save_word2vec_format(out_binary_filepath, binary=True)
+    outputs = [(out_binary_filepath, True)]
     if save_vec:
-        model.wv.save_word2vec_format(out_text_filepath, binary=False)
+        outputs.append((out_text_filepath, False))
+    
+    n_words = len(model.wv.vocab)
+    for filepath,binary in outputs:
+        start_time = time.perf_counter()
+        with Stage('save', model=model_name, binary=binary,
+                   codec=codec if compress else 'none', items_out=n_words):
+            fout, out_filepath = open_compressed(
+                filepath, codec=codec if compress else 'none',
+                n_threads=n_threads)
+            with fout:
+                write_word2vec_format(fout, model.wv, binary=binary)
+        logger.info(f'Saved word vectors into "{out_filepath}" in '
+                    f'{time.perf_counter() - start_time:.0f} seconds')
+    
+    if save_bundle:
+        bundle_dir = get_bundle_dir(out_binary_filepath)
+        with Stage('bundle', model=model_name, items_out=n_words):
+            write_bundle(bundle_dir, model.wv, meta={
+                'model': model_name,
+                'n_tokens': n_tokens,
+                'sentlines': os.path.basename(sentlines_path)
+            })
+        logger.info(f'Saved word vectors into bundle "{bundle_dir}"')
+    
+    if build_ann:
+        with Stage('ann', model=model_name, items_in=n_words):
+            build_ann_index(out_binary_filepath)
+    for kind in quantize:
+        with Stage('quantize', model=model_name, kind=kind,
+                   items_in=n_words):
+            export_quantized(out_binary_filepath, kind)
+    if n_neighbors:
+        with Stage('neighbors', model=model_name, items_out=n_words):
+            save_neighbor_table(out_binary_filepath, n_neighbors=n_neighbors)
+
+
+def build_shared_vocab(model, sentlines_path):
+    """Build vocabulary of a model from the shared vocabulary of a file.
+    
+    The vocabulary is counted only once per sentence lines file, after which
+    all models trained on the file reuse it instead of scanning the corpus.
+    
+    Args:
+        model (gensim.models.*): Gensim model to build the vocabulary for.
+        sentlines_path (str): Filepath of input sentence lines file.
+    """
+    with Stage('vocab', model=model.__class__.__name__.lower()) as stage:
+        words, counts, meta = get_vocab(sentlines_path)
+        model.build_vocab_from_freq(dict(zip(words, counts.tolist())),
+                                    corpus_count=meta['n_sentences'])
+        model.corpus_total_words = meta['n_tokens']
+        stage.items_in = len(words)
+        stage.items_out = len(model.wv.vocab)
+
+
+def get_n_workers(workers=None):
+    """Get number of training worker threads.
+    
+    Args:
+        workers (int, optional): Number of workers to use. Defaults to None,
+            which means the number of CPUs available to this process.
+    
+    Returns:
+        int: Number of workers.
+    """
+    if workers:
+        return workers
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
-    if compress:
-        gzip_file(out_binary_filepath)
-        if save_vec:
-            gzip_file(out_text_filepath)
+
+def train_model(model, sentlines_path, sentences=None,
+                training_mode='corpus_file'):
+    """Build vocabulary and train a gensim model.
+    
+    In 'corpus_file' mode, each worker reads and tokenizes its own part of
+    the sentence lines file without holding the GIL, so training scales with
+    the number of cores, and it should be used whenever several workers are
+    available. In 'sentences' mode, all workers are fed from one Python
+    iterator, which limits throughput to what a single thread can produce.
+    It is meant for few workers or for models that don't support
+    'corpus_file', and then 'sentences' should be a corpus.TokenCorpus,
+    which only slices memory-mapped token IDs instead of splitting lines of
+    text on every epoch.
+    
+    Args:
+        model (gensim.models.*): Gensim model to train.
+        sentlines_path (str): Filepath of input sentence lines file.
+        sentences (iterable, optional): Sentences of 'sentlines_path' as lists
+            of tokens, such as corpus.TokenCorpus. Used only in 'sentences'
+            training mode. Defaults to None, which means reading the sentence
+            lines file with LineSentence.
+        training_mode (str, optional): Either 'corpus_file' to let each worker
+            read its own part of the sentence lines file, which scales to many
+            cores, or 'sentences' to feed workers from a single iterator.
+            Defaults to 'corpus_file'.
+    
+    Returns:
+        float: Training words per second.
+    
+    Raises:
+        ValueError: If training mode is not supported.
+    """
+    model_name = model.__class__.__name__
+    build_shared_vocab(model, sentlines_path)
+    
+    if training_mode not in ('corpus_file', 'sentences'):
+        raise ValueError(f'Unknown training mode "{training_mode}", should be '
+                         'in ["corpus_file", "sentences"]!')
+    
+    n_words = model.corpus_total_words * model.epochs
+    start_time = time.perf_counter()
+    with Stage('train', model=model_name.lower(), mode=training_mode,
+               workers=model.workers, items_in=n_words):
+        if training_mode == 'corpus_file':
+            model.train(
+                corpus_file=sentlines_path,
+                total_words=model.corpus_total_words,
+                epochs=model.epochs
+            )
+        else:
+            if sentences is None:
+                sentences = LineSentence(sentlines_path)
+            model.train(
+                sentences,
+                total_examples=model.corpus_count,
+                epochs=model.epochs,
+                queue_factor=2
+            )
+    time_passed = time.perf_counter() - start_time
+    logger.info(f'{model_name} trained with {model.workers} workers in '
+                f'{time_passed:.0f} seconds, '
+                f'{n_words / time_passed:.0f} words/s')
+    return n_words / time_passed
 
 
-def create_word2vec_embeddings(sentlines_path, out_dir, size=300):
+def create_word2vec_embeddings(sentlines_path, out_dir, size=300,
+                               sentences=None, training_mode='corpus_file',
+                               workers=None, build_ann=False,
+                               quantize=(), n_neighbors=0):
     """Train Word2Vec word embeddings.
     
     Args:
         sentlines_path (str): Filepath of input sentence lines file.
         out_dir (str): Directory to save word embeddings into.
         size (int, optional): Word embeddings vector dimension. Defaults to 100.
+        sentences (iterable, optional): Sentences of 'sentlines_path' as lists
+            of tokens, such as corpus.TokenCorpus. Used only in 'sentences'
+            training mode. Defaults to None, which means reading the sentence
+            lines file with LineSentence.
+        training_mode (str, optional): Either 'corpus_file' or 'sentences'.
+            Defaults to 'corpus_file'.
+        workers (int, optional): Number of worker threads. Defaults to None,
+            which means the number of available CPUs.
+        build_ann (bool, optional): Whether to build an approximate nearest
+            neighbor index of the word vectors. Defaults to False.
+        quantize (tuple, optional): Quantized exports to save, any of
+            'float16', 'int8' and 'pq'. Defaults to ().
+        n_neighbors (int, optional): Number of neighbors to precompute for
+            each word. Defaults to 0, which means no neighbor table.
     """
-    sentences = LineSentence(sentlines_path)
     w2v = Word2Vec(
         window=5,
         size=size,
         min_count=5,
         max_vocab_size=None,
-        workers=4
+        workers=get_n_workers(workers)
     )
-    w2v.build_vocab(sentences, progress_per=1e6)
-    w2v.train(
-        sentences,
-        total_examples=w2v.corpus_count,
-        epochs=w2v.epochs,
-        queue_factor=2
-    )
-    save_word_vectors(sentlines_path, out_dir, w2v)
+    train_model(w2v, sentlines_path, sentences=sentences,
+                training_mode=training_mode)
+    save_word_vectors(sentlines_path, out_dir, w2v,
+                      build_ann=build_ann, quantize=quantize,
+                      n_neighbors=n_neighbors)
     
 
-def create_fasttext_embeddings(sentlines_path, out_dir, size=300):
+def create_fasttext_embeddings(sentlines_path, out_dir, size=300,
+                               sentences=None, training_mode='corpus_file',
+                               workers=None, build_ann=False,
+                               quantize=(), n_neighbors=0, save_model=True):
     """Train FastText word embeddings.
     
     Args:
         sentlines_path (str): Filepath of input sentence lines file.
         out_dir (str): Directory to save word embeddings into.
         size (int, optional): Word embeddings vector dimension. Defaults to 100.
+        sentences (iterable, optional): Sentences of 'sentlines_path' as lists
+            of tokens, such as corpus.TokenCorpus. Used only in 'sentences'
+            training mode. Defaults to None, which means reading the sentence
+            lines file with LineSentence.
+        training_mode (str, optional): Either 'corpus_file' or 'sentences'.
+            Defaults to 'corpus_file'.
+        workers (int, optional): Number of worker threads. Defaults to None,
+            which means the number of available CPUs.
+        build_ann (bool, optional): Whether to build an approximate nearest
+            neighbor index of the word vectors. Defaults to False.
+        quantize (tuple, optional): Quantized exports to save, any of
+            'float16', 'int8' and 'pq'. Defaults to ().
+        n_neighbors (int, optional): Number of neighbors to precompute for
+            each word. Defaults to 0, which means no neighbor table.
+        save_model (bool, optional): Whether to save the word vectors with
+            subword n-grams, which are needed for vectors of words outside of
+            the vocabulary, for example by 'serve.py'. Defaults to True.
     """
-    sentences = LineSentence(sentlines_path)
     ft = FastText(
         window=5,
         size=size,
         min_count=5,
         max_vocab_size=None,
-        workers=4
-    )
-    ft.build_vocab(sentences, progress_per=1e6)
-    ft.train(
-        sentences,
-        total_examples=ft.corpus_count,
-        epochs=ft.epochs,
-        queue_factor=2
+        workers=get_n_workers(workers)
     )
-    save_word_vectors(sentlines_path, out_dir, ft)
+    train_model(ft, sentlines_path, sentences=sentences,
+                training_mode=training_mode)
+    save_word_vectors(sentlines_path, out_dir, ft,
+                      build_ann=build_ann, quantize=quantize,
+                      n_neighbors=n_neighbors)
+    if save_model:
+        out_filepath = get_model_filepath(get_out_filepaths(
+            sentlines_path, out_dir, 'fasttext', size,
+            ft.corpus_total_words)[0])
+        ft.wv.save(out_filepath)
+        logger.info(f'Saved FastText word vectors into "{out_filepath}"')
 
 
 def create_all_embeddings(sentlines_dir='./data/processed',
-                          out_dir='./data/embeddings'):
+                          out_dir='./data/embeddings',
+                          training_mode='corpus_file',
+                          token_corpus=True,
+                          workers=None,
+                          build_ann=False,
+                          quantize=(),
+                          n_neighbors=0):
     """Train all word embeddings based on sentence line files in a directory.
     
     Args:
@@ -140,6 +450,27 @@ def create_all_embeddings(sentlines_dir='./data/processed',
             files to train models on. Defaults to './data/processed'.
         out_dir (str, optional): Directory to save word embeddings into.
             Defaults to './data/embeddings'.
+        training_mode (str, optional): Either 'corpus_file' to let each worker
+            read its own part of the sentence lines file, or 'sentences' to
+            feed workers from a single iterator, see 'train_model' for when
+            to use each. Defaults to 'corpus_file'.
+        token_corpus (bool, optional): Whether to train from a memory-mapped
+            token ID corpus of each sentence lines file, which is built once
+            and shared by all models. Used only in 'sentences' training mode,
+            where it is faster than reading the text. Defaults to True.
+        workers (int, optional): Number of worker threads. Defaults to None,
+            which means the number of available CPUs.
+        build_ann (bool, optional): Whether to build an approximate nearest
+            neighbor index next to each model, with a recall@k versus latency
+            report against exact search. Defaults to False.
+        quantize (tuple, optional): Quantized exports to save next to each
+            model, any of 'float16', 'int8' and 'pq', each with a report of
+            memory saved, neighbor overlap and similarity error. Defaults to
+            ().
+        n_neighbors (int, optional): Number of neighbors to precompute for
+            every word of each model, saved as a memory-mappable table that
+            can be resumed if interrupted. Defaults to 0, which means no
+            neighbor table.
     """
     start_time = time.perf_counter()
     
@@ -152,10 +483,23 @@ def create_all_embeddings(sentlines_dir='./data/processed',
     # Train word embeddings
     for filepath in sentline_filepaths:
         logger.info(f'Creating embeddings for sentlines {filepath}...')
+        sentences = None
+        if training_mode == 'sentences' and token_corpus:
+            sentences = get_token_corpus(filepath)
 
         # 300d
-        create_word2vec_embeddings(filepath, out_dir, size=300)
-        create_fasttext_embeddings(filepath, out_dir, size=300)
+        create_word2vec_embeddings(filepath, out_dir, size=300,
+                                   sentences=sentences,
+                                   training_mode=training_mode,
+                                   workers=workers, build_ann=build_ann,
+                                   quantize=quantize,
+                                   n_neighbors=n_neighbors)
+        create_fasttext_embeddings(filepath, out_dir, size=300,
+                                   sentences=sentences,
+                                   training_mode=training_mode,
+                                   workers=workers, build_ann=build_ann,
+                                   quantize=quantize,
+                                   n_neighbors=n_neighbors)
         
     logger.info(f'All done in {time.perf_counter() - start_time:.0f} seconds!')
 
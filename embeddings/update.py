@@ -9,15 +9,19 @@ def main():
     preprocess_all_files(
         in_filedir='./data/feed/',
         out_filepath='./data/processed/all.sl',
-        lines_per_chunk=30000,
-        create_uncased=True,
+        bytes_per_chunk=1 << 22,
+        variants=('uncased',),
         min_sent_len=5,
         tokenizer='tweet',
-        n_jobs=3
+        n_jobs=3,
+        incremental=True
     )
+    # Workers read the sentence lines files directly, which scales with the
+    # number of cores better than feeding them from a token corpus
     create_all_embeddings(
         sentlines_dir='./data/processed',
-        out_dir='./data/embeddings'
+        out_dir='./data/embeddings',
+        training_mode='corpus_file'
     )
     
 
@@ -5,8 +5,14 @@ import logging
 
 
 def get_logger():
-    """Get logger with basic setup."""
+    """Get logger with basic setup.
+    
+    Handlers are added only once, so that calling this from several modules
+    does not duplicate the log output.
+    """
     logger = logging.getLogger('')
+    if getattr(logger, '_fwe_configured', False):
+        return logger
     logger.setLevel(logging.INFO)
     fh = logging.FileHandler('run.log')
     fh.setLevel(logging.INFO)
@@ -18,4 +24,5 @@ def get_logger():
     ch.setFormatter(formatter)
     logger.addHandler(fh)
     logger.addHandler(ch)
-    return logger
\ No newline at end of file
+    logger._fwe_configured = True
+    return logger
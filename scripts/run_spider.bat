@@ -1,7 +1,6 @@
 @echo off
-set /p crawler= "Type in the crawler to start: "
-echo Starting %crawler%
+set /p crawlers= "Type in the crawlers to start, separated by spaces: "
+echo Starting %crawlers%
 cd ..
-cd crawling
-scrapy crawl %crawler%
-pause 
\ No newline at end of file
+python -m crawling.run %crawlers%
+pause
\ No newline at end of file